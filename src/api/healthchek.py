@@ -7,6 +7,7 @@ import sqlalchemy as sa
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
 
+from cache.metrics import cache_metrics
 from cache.redis import redis_cache
 from db.db import RO_ENGINE, RW_ENGINE
 
@@ -27,6 +28,14 @@ async def healthcheck():
     return JSONResponse(status_code=200, content=data)
 
 
+@router.get(
+    "/cache",
+    summary="Метрики кеша этого процесса по шаблонам ключей",
+)
+async def cache_stats():
+    return JSONResponse(status_code=200, content=cache_metrics.as_dict())
+
+
 def update(d, other):
     d.update(other)
     return d
@@ -58,4 +67,5 @@ async def check_redis() -> dict:
             get_value) == test_value else False
     except Exception as e:
         cache_is_working = str(e)
-    return {"redis": cache_is_working}
+    # open - redis недавно был недоступен, приложение к нему не обращается, пока фоновая проверка не пройдет
+    return {"redis": cache_is_working, "redis_circuit": redis_cache.breaker.state.value}
@@ -1,18 +1,24 @@
 import uuid
 
-from fastapi import APIRouter, Depends, UploadFile, status
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, Query, Request, status
+from fastapi.responses import Response
 
-from cache.redis import timed_cache
+from cache.redis import get_generation, timed_cache
 from cache.redis_keys import all_keys
+from config import settings
 from crud.file import FileCrud
 from crud.revision import RevisionCrud
 from db.models.file import FileOrderBy
 from depends.auth import get_current_user
-from schemas.file import File, SearchResult, ViewFile
+from schemas.file import (DownloadSelection, File, SearchResult, TailFile,
+                          ViewFile, ViewUnit)
 from schemas.revision import RevisionResponse
+from schemas.upload import UploadSessionStatus
 from schemas.user import User
+from services.archive import ArchiveFormat
 from services.file import DownloadFileManager, FileManager
+from services.upload import UploadSessionManager
+from utils.multipart import MultipartReader
 
 router = APIRouter()
 
@@ -22,14 +28,119 @@ router = APIRouter()
     response_model=File,
     status_code=status.HTTP_201_CREATED,
     summary="Загрузить файл в хранилище",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                        "required": ["file"],
+                    },
+                },
+            },
+        },
+    },
 )
 async def upload_file(
     path: str,
-    file: UploadFile,
+    request: Request,
     user: User = Depends(get_current_user),
 ):
     manager = FileManager(user)
-    return await manager.save_file(path, file)
+    return await manager.save_file(path, MultipartReader(request.headers.get("content-type"), request.stream()))
+
+
+@router.post(
+    "/upload/batch",
+    response_model=list[File],
+    status_code=status.HTTP_201_CREATED,
+    summary="Загрузить несколько файлов в директорию одним запросом",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {
+                            "files": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                        },
+                        "required": ["files"],
+                    },
+                },
+            },
+        },
+    },
+)
+async def upload_files(
+    path: str,
+    request: Request,
+    user: User = Depends(get_current_user),
+):
+    manager = FileManager(user)
+    return await manager.save_files(path, MultipartReader(request.headers.get("content-type"), request.stream()))
+
+
+@router.post(
+    "/upload/sessions",
+    response_model=UploadSessionStatus,
+    status_code=status.HTTP_201_CREATED,
+    summary="Начать загрузку файла по частям",
+)
+async def create_upload_session(
+    path: str,
+    size: int = Query(ge=0, description="Размер файла в байтах"),
+    name: str | None = Query(None, description="Имя файла, если path - путь до директории"),
+    user: User = Depends(get_current_user),
+) -> UploadSessionStatus:
+    manager = UploadSessionManager(user)
+    return await manager.create_session(path, size, name)
+
+
+@router.get(
+    "/upload/sessions/{session_id}",
+    response_model=UploadSessionStatus,
+    summary="Состояние загрузки файла по частям",
+)
+async def get_upload_session(
+    session_id: uuid.UUID,
+    user: User = Depends(get_current_user),
+) -> UploadSessionStatus:
+    manager = UploadSessionManager(user)
+    return await manager.get_status(session_id)
+
+
+@router.put(
+    "/upload/sessions/{session_id}/chunks/{index}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    response_class=Response,
+    summary="Загрузить чанк файла (тело запроса - содержимое чанка)",
+)
+async def upload_chunk(
+    session_id: uuid.UUID,
+    index: int,
+    request: Request,
+    user: User = Depends(get_current_user),
+) -> Response:
+    manager = UploadSessionManager(user)
+    await manager.save_chunk(session_id, index, request.stream())
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.post(
+    "/upload/sessions/{session_id}/commit",
+    response_model=File,
+    status_code=status.HTTP_201_CREATED,
+    summary="Завершить загрузку файла по частям",
+)
+async def commit_upload_session(
+    session_id: uuid.UUID,
+    user: User = Depends(get_current_user),
+) -> File:
+    manager = UploadSessionManager(user)
+    return await manager.commit(session_id)
 
 
 @router.get(
@@ -43,25 +154,67 @@ async def get_list_file(
     user: User = Depends(get_current_user),
     file_crud: FileCrud = Depends(),
 ):
-    cache_key = all_keys.file_list.substitute(user_id=user.id)
+    cache_key = all_keys.file_list.substitute(
+        user_id=user.id,
+        generation=await get_generation(user.id),
+        limit=limit,
+        offset=offset,
+    )
 
-    @timed_cache(cache_key=cache_key, time=5 * 60)
+    @timed_cache(
+        cache_key=cache_key,
+        time=settings.CACHE_TTL_SECONDS,
+        schema=list[File],
+        stale_time=settings.CACHE_STALE_SECONDS,
+        negative_time=settings.CACHE_NEGATIVE_TTL_SECONDS,
+    )
     async def cached(*args, **kwargs):
         return [file async for file in file_crud.get(user_id=user.id, limit=limit, offset=offset)]
 
     return await cached()  # type: ignore
 
 
-@router.get(
+@router.api_route(
     "/download",
+    methods=["GET", "HEAD"],
     summary="Скачать файл или директорию",
 )
 async def download_file(
     path: str,
+    request: Request,
+    format: ArchiveFormat | None = Query(None, description="Формат архива, если не указан - по заголовку Accept или zip"),
+    user: User = Depends(get_current_user),
+) -> Response:
+    manager = DownloadFileManager(user)
+    return await manager.get_file_or_directory(path, request.headers, format, request.method)
+
+
+@router.post(
+    "/download",
+    summary="Скачать несколько файлов и директорий одним архивом",
+)
+async def download_selection(
+    data: DownloadSelection,
+    request: Request,
+    format: ArchiveFormat | None = Query(None, description="Формат архива, если не указан - по заголовку Accept или zip"),
     user: User = Depends(get_current_user),
-) -> StreamingResponse:
+) -> Response:
     manager = DownloadFileManager(user)
-    return await manager.get_file_or_directory(path)
+    return await manager.get_selection(data.items, request.headers, format)
+
+
+@router.api_route(
+    "/raw/{file_id}",
+    methods=["GET", "HEAD"],
+    summary="Скачать файл без архивации (поддерживает Range и условные запросы)",
+)
+async def raw_file(
+    file_id: uuid.UUID,
+    request: Request,
+    user: User = Depends(get_current_user),
+) -> Response:
+    manager = DownloadFileManager(user)
+    return await manager.get_raw_file(file_id, request.headers, request.method)
 
 
 @router.get(
@@ -80,15 +233,23 @@ async def search_files(
 
     cache_key = all_keys.search_files.substitute(
         user_id=user.id,
+        generation=await get_generation(user.id),
         path=path,
         extension=extension,
         order_by=order_by,
         limit=limit,
     )
 
-    @timed_cache(cache_key=cache_key, time=5 * 60)
+    @timed_cache(
+        cache_key=cache_key,
+        time=settings.CACHE_TTL_SECONDS,
+        schema=list[File],
+        stale_time=settings.CACHE_STALE_SECONDS,
+        negative_time=settings.CACHE_NEGATIVE_TTL_SECONDS,
+    )
     async def cached(*args, **kwargs):
-        file_list = [
+        # кешируется сам список: пустой кешируется как отрицательный результат, на меньшее время
+        return [
             file
             async for file in file_crud.search(
                 user_id=user.id,
@@ -98,9 +259,8 @@ async def search_files(
                 limit=limit
             )
         ]
-        return SearchResult(**{"matches": file_list})
 
-    return await cached()  # type: ignore
+    return SearchResult(**{"matches": await cached()})
 
 
 @router.get(
@@ -117,11 +277,18 @@ async def revision_files(
 
     cache_key = all_keys.revision_files.substitute(
         user_id=user.id,
+        generation=await get_generation(user.id),
         path=path,
         limit=limit,
     )
 
-    @timed_cache(cache_key=cache_key, time=5 * 60)
+    @timed_cache(
+        cache_key=cache_key,
+        time=settings.CACHE_TTL_SECONDS,
+        schema=list[RevisionResponse],
+        stale_time=settings.CACHE_STALE_SECONDS,
+        negative_time=settings.CACHE_NEGATIVE_TTL_SECONDS,
+    )
     async def cached(*args, **kwargs):
         return await revision_crud.get_revision(path=path, user_id=user.id, limit=limit)
 
@@ -135,13 +302,28 @@ async def revision_files(
 )
 async def file_view(
     file_id: uuid.UUID,
+    offset: int = Query(0, ge=0, description="С какой строки (байта) начать"),
+    limit: int | None = Query(None, ge=1, description="Сколько строк (байт) отдать"),
+    unit: ViewUnit = Query(ViewUnit.lines, description="Страница в строках или в байтах"),
     user: User = Depends(get_current_user),
 ) -> ViewFile:
-    cache_key = all_keys.file_view.substitute(user_id=user.id, file_id=file_id)
+    # страница читается с диска за O(размер страницы), в redis ее не кладем: после перезаписи файла кеш устарел бы
+    manager = DownloadFileManager(user)
+    return await manager.get_file_content(file_id, offset, limit, unit)
 
-    @timed_cache(cache_key=cache_key, time=5 * 60)
-    async def cached(*args, **kwargs):
-        manager = DownloadFileManager(user)
-        return await manager.get_file_content(file_id)
 
-    return await cached()  # type: ignore
+@router.get(
+    "/tail/{file_id}",
+    response_model=TailFile,
+    summary="Последние строки файла, с follow - и то, что дописывается в новых ревизиях (server-sent events)",
+)
+async def file_tail(
+    file_id: uuid.UUID,
+    lines: int | None = Query(None, ge=1, description="Сколько последних строк отдать"),
+    follow: bool = Query(False, description="Следить за файлом: text/event-stream с дописанными данными"),
+    user: User = Depends(get_current_user),
+):
+    manager = DownloadFileManager(user)
+    if follow:
+        return await manager.follow_file(file_id, lines)
+    return await manager.tail_file(file_id, lines)
@@ -0,0 +1,107 @@
+"""Бенчмарк записи загружаемых файлов.
+
+Сравнивает прежнюю запись (каждый чанк - отдельный вызов aiofiles, хеш считается в event loop)
+с текущей `StreamWriter` (буфер, запись и хеш одним вызовом в пуле потоков) при N одновременных клиентах.
+Помимо пропускной способности меряется загрузка event loop: доля процессорного времени потока
+event loop за время загрузок и средняя задержка таймера, который тикает параллельно с загрузками -
+столько же ждали бы остальные запросы.
+
+Запуск из каталога src:
+
+    python -m benchmarks.upload --clients 1 4 16 --size-mb 64 --algorithm md5 sha256 blake2b
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+
+import aiofiles
+
+from services.storage import StreamWriter
+from utils.hashing import is_available, new_hasher
+
+NETWORK_CHUNK_SIZE = 64 * 1024
+TICK = 0.005
+
+
+async def client_stream(size: int) -> AsyncIterator[bytes]:
+    """Тело запроса, приходит чанками как из сокета."""
+    chunk = os.urandom(NETWORK_CHUNK_SIZE)
+    for _ in range(size // NETWORK_CHUNK_SIZE):
+        yield chunk
+        # отдаем управление, как при ожидании следующего пакета
+        await asyncio.sleep(0)
+
+
+async def save_inline(stream: AsyncIterator[bytes], path: str, algorithm: str) -> str:
+    """Прежняя реализация."""
+    hasher = new_hasher(algorithm)
+    async with aiofiles.open(path, 'wb') as f:
+        async for content in stream:
+            hasher.update(content)
+            await f.write(content)
+    return hasher.hexdigest()
+
+
+async def save_offloaded(stream: AsyncIterator[bytes], path: str, algorithm: str) -> str:
+    """Текущая реализация."""
+    async with StreamWriter(path, hasher=new_hasher(algorithm)) as writer:
+        async for content in stream:
+            await writer.write(content)
+    return writer.hexdigest()
+
+
+async def measure_lag(stop: asyncio.Event) -> float:
+    """Среднее опоздание таймера, в секундах."""
+    lags = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+    return sum(lags) / len(lags)
+
+
+async def run(
+    save: Callable[[AsyncIterator[bytes], str, str], Awaitable[str]],
+    clients: int,
+    size: int,
+    algorithm: str,
+    directory: str,
+) -> tuple[float, float, float]:
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+    started = time.perf_counter()
+    # процессорное время только потока event loop, без пула потоков
+    loop_cpu = time.thread_time()
+    await asyncio.gather(*(
+        save(client_stream(size), os.path.join(directory, str(i)), algorithm) for i in range(clients)
+    ))
+    elapsed = time.perf_counter() - started
+    loop_cpu = time.thread_time() - loop_cpu
+    stop.set()
+    lag = await lag_task
+    return clients * size / elapsed / 1024 / 1024, loop_cpu / elapsed * 100, lag * 1000
+
+
+async def main(args: argparse.Namespace) -> None:
+    size = args.size_mb * 1024 * 1024
+    print(f'{"algorithm":<10} {"clients":>7} {"mode":<10} {"MB/s":>9} {"loop cpu, %":>12} {"lag, ms":>8}')
+    with tempfile.TemporaryDirectory() as directory:
+        for algorithm in args.algorithm:
+            if not is_available(algorithm):
+                print(f'{algorithm:<10} недоступен')
+                continue
+            for clients in args.clients:
+                for mode, save in (('inline', save_inline), ('offloaded', save_offloaded)):
+                    throughput, loop_cpu, lag = await run(save, clients, size, algorithm, directory)
+                    print(f'{algorithm:<10} {clients:>7} {mode:<10} {throughput:>9.1f} {loop_cpu:>12.0f} {lag:>8.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--algorithm', nargs='+', default=['md5', 'sha256', 'blake2b', 'xxh3_128'])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,86 @@
+"""Предохранитель (circuit breaker) для внешнего сервиса.
+
+Пока сервис отвечает, вызовы идут как есть. После failure_threshold ошибок подряд предохранитель
+размыкается: вызовы сразу завершаются CircuitOpenError, не дожидаясь таймаутов, а в фоне раз
+в reset_seconds сервис проверяется probe. Первая успешная проверка замыкает предохранитель.
+"""
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    closed = 'closed'
+    open = 'open'
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут, сервис не вызывается."""
+
+
+@dataclass
+class CircuitBreaker:
+    """
+    Attributes:
+        probe: проверка сервиса, вызывается в фоне, пока предохранитель разомкнут
+        errors: ошибки, которые считаются отказом сервиса (остальные - ошибки запроса, сервис жив)
+        failure_threshold (int): после скольких отказов подряд размыкаться, 0 - никогда
+        reset_seconds (float): как часто проверять сервис, пока предохранитель разомкнут
+    """
+    probe: Callable[[], Awaitable[Any]]
+    errors: tuple[type[BaseException], ...]
+    failure_threshold: int
+    reset_seconds: float
+    state: CircuitState = field(default=CircuitState.closed, init=False)
+    failures: int = field(default=0, init=False)
+    _probe_task: asyncio.Task | None = field(default=None, init=False, repr=False)
+
+    @property
+    def is_closed(self) -> bool:
+        return self.state == CircuitState.closed
+
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        if not self.is_closed:
+            raise CircuitOpenError('circuit is open')
+        try:
+            result = await func(*args, **kwargs)
+        except self.errors:
+            self.record_failure()
+            raise
+        self.failures = 0
+        return result
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.is_closed and self.failure_threshold and self.failures >= self.failure_threshold:
+            logger.warning('circuit opened after %s failures', self.failures)
+            self.state = CircuitState.open
+            self._probe_task = asyncio.create_task(self._probe())
+
+    def close(self) -> None:
+        self.state = CircuitState.closed
+        self.failures = 0
+
+    async def stop(self) -> None:
+        """Останавливает фоновую проверку, например при остановке приложения."""
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.wait([self._probe_task])
+            self._probe_task = None
+
+    async def _probe(self) -> None:
+        while not self.is_closed:
+            await asyncio.sleep(self.reset_seconds)
+            try:
+                await self.probe()
+            except Exception as e:
+                logger.debug('probe failed: %s', e)
+            else:
+                logger.warning('circuit closed')
+                self.close()
+        self._probe_task = None
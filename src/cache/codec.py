@@ -0,0 +1,83 @@
+"""Сериализация значений кеша.
+
+Значение пишется в json (orjson) и читается обратно через pydantic по схеме, которую знает вызывающий код.
+В начале записи - версия схемы: после деплоя, в котором схема поменялась, старые записи
+не читаются (промах кеша), а не превращаются в объекты новой версии с неверными полями.
+Большие значения сжимаются: zstd, если он установлен, иначе zlib.
+Пустые значения ([], None) пишутся отдельной пометкой и читаются без схемы: так кешируются "не найдено".
+"""
+import hashlib
+import zlib
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, cast
+
+from pydantic import parse_obj_as, schema_json_of
+from pydantic.json import pydantic_encoder
+
+from schemas.base import dumps, loads
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# меняется вместе с форматом записи, входит в версию схемы
+CODEC_VERSION = 1
+VERSION_SIZE = 8
+# как сжато тело записи, байт сразу после версии
+RAW = b'j'
+ZLIB = b'z'
+ZSTD = b'Z'
+# пустое значение, тело - его json как есть
+EMPTY = b'-'
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+# decode вернул MISSING - записи нет или ее нельзя прочитать, значение нужно пересчитать
+MISSING: Any = object()
+
+
+@lru_cache(maxsize=None)
+def schema_version(schema: Any) -> bytes:
+    """Отпечаток json schema типа: меняется, если поменялись поля, их типы или вложенные схемы."""
+    schema_json = f'{CODEC_VERSION}:{schema_json_of(schema)}'
+    return hashlib.sha1(schema_json.encode()).hexdigest()[:VERSION_SIZE].encode()
+
+
+@dataclass
+class CacheCodec:
+    """Кодирует значения типа schema для хранения в кеше.
+
+    Attributes:
+        schema: тип значения, например list[File]
+        compress_min_size (int): значения от этого размера в байтах сжимаются, 0 - не сжимать
+    """
+    schema: Any
+    compress_min_size: int = 0
+
+    def encode(self, value: Any) -> bytes:
+        data = cast(bytes, dumps(value, default=pydantic_encoder, to_bytes=True))
+        compression = RAW if value else EMPTY
+        if value and self.compress_min_size and len(data) >= self.compress_min_size:
+            if zstandard is not None:
+                data, compression = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), ZSTD
+            else:
+                data, compression = zlib.compress(data, ZLIB_LEVEL), ZLIB
+        return schema_version(self.schema) + compression + data
+
+    def decode(self, data: bytes | None) -> Any:
+        """Значение из записи, MISSING - записи нет или она другой версии схемы или формата."""
+        if not data or data[:VERSION_SIZE] != schema_version(self.schema):
+            return MISSING
+        compression, body = data[VERSION_SIZE:VERSION_SIZE + 1], data[VERSION_SIZE + 1:]
+        if compression == EMPTY:
+            return loads(body)
+        if compression == ZSTD:
+            if zstandard is None:
+                return MISSING
+            body = zstandard.ZstdDecompressor().decompress(body)
+        elif compression == ZLIB:
+            body = zlib.decompress(body)
+        elif compression != RAW:
+            return MISSING
+        return parse_obj_as(self.schema, loads(body))
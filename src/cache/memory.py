@@ -0,0 +1,98 @@
+"""Кеш в памяти процесса."""
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any
+
+
+class LRUCache:
+    """Словарь ограниченного размера, при переполнении вытесняются давно не использованные ключи."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        return self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class LocalCache:
+    """Кеш в памяти процесса перед redis: ограничен по суммарному размеру, у каждой записи свой TTL.
+
+    Размер записи передается снаружи (длина ее записи в redis): считать размер объектов в памяти дорого и неточно.
+    `epoch` меняется при каждой инвалидации: значение, прочитанное из redis до инвалидации,
+    не должно попасть в кеш после нее.
+    Пока кеш выключен (`enabled`), он ничего не хранит и не отдает.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.enabled = False
+        self.epoch = 0
+        self._size = 0
+        # ключ: (время истечения, размер, значение)
+        self._data: OrderedDict[Hashable, tuple[float, int, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key) if self.enabled else None
+        if entry is None:
+            return default
+        expires, _, value = entry
+        if expires <= time.monotonic():
+            self._remove(key)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, size: int, ttl: float, epoch: int | None = None) -> None:
+        """Кладет значение на ttl секунд. Если передан epoch и с тех пор была инвалидация - не кладет."""
+        if not self.enabled or (epoch is not None and epoch != self.epoch):
+            return
+        if size > self.max_bytes or ttl <= 0:
+            return
+        self._remove(key)
+        self._data[key] = (time.monotonic() + ttl, size, value)
+        self._size += size
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._data)))
+
+    def invalidate(self, key: Hashable) -> None:
+        self.epoch += 1
+        self._remove(key)
+
+    def clear(self) -> None:
+        self.epoch += 1
+        self._data.clear()
+        self._size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        if (entry := self._data.pop(key, None)) is not None:
+            self._size -= entry[1]
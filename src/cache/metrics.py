@@ -0,0 +1,156 @@
+"""Метрики кеша по шаблонам ключей.
+
+Для каждого шаблона ключа (см. cache.redis_keys) считается, чем закончились обращения к кешу,
+сколько длились запросы в redis, кодирование и декодирование значений и сколько байт записано.
+Метрики хранятся в памяти процесса: у каждого воркера свои.
+"""
+import bisect
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import Enum
+from time import perf_counter
+from typing import Any
+
+from config import settings
+
+# границы корзин гистограмм времени, в секундах
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# шаблон ключей, собранных не через KeyTemplate
+OTHER_TEMPLATE = 'other'
+DEBUG_HEADER = b'x-cache'
+
+
+class CacheOutcome(str, Enum):
+    # значение из памяти процесса
+    local = 'local'
+    # свежее значение из redis
+    hit = 'hit'
+    # устаревшее значение из redis, пересчитывается в фоне
+    stale = 'stale'
+    # значение посчитал другой процесс, пока этот ждал
+    waited = 'waited'
+    # значение посчитано в этом запросе
+    miss = 'miss'
+    # запрос дождался загрузки, которую начал другой запрос этого процесса
+    coalesced = 'coalesced'
+
+
+@dataclass
+class Histogram:
+    # количество наблюдений в каждой корзине TIME_BUCKETS, последняя - больше всех границ
+    counts: list[int] = field(default_factory=lambda: [0] * (len(TIME_BUCKETS) + 1))
+    count: int = 0
+    sum: float = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(TIME_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def as_dict(self) -> dict[str, Any]:
+        # корзины накопительные, как в prometheus: сколько наблюдений не больше границы
+        cumulative, total = {}, 0
+        for bound, count in zip([*map(str, TIME_BUCKETS), '+Inf'], self.counts):
+            total += count
+            cumulative[bound] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+@dataclass
+class CacheStats:
+    outcomes: Counter[CacheOutcome] = field(default_factory=Counter)
+    # ошибки redis, в том числе отказы при разомкнутом предохранителе
+    errors: int = 0
+    redis: Histogram = field(default_factory=Histogram)
+    encode: Histogram = field(default_factory=Histogram)
+    decode: Histogram = field(default_factory=Histogram)
+    stored: int = 0
+    stored_bytes: int = 0
+
+    @property
+    def hit_ratio(self) -> float | None:
+        """Доля обращений, на которые значение не считалось."""
+        total = sum(self.outcomes.values())
+        if not total:
+            return None
+        return 1 - self.outcomes[CacheOutcome.miss] / total
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            'outcomes': {outcome.value: self.outcomes[outcome] for outcome in CacheOutcome},
+            'hit_ratio': self.hit_ratio,
+            'errors': self.errors,
+            'redis_seconds': self.redis.as_dict(),
+            'encode_seconds': self.encode.as_dict(),
+            'decode_seconds': self.decode.as_dict(),
+            'stored': self.stored,
+            'stored_bytes': self.stored_bytes,
+        }
+
+
+class CacheMetrics:
+    """Метрики кеша процесса: шаблон ключа - его CacheStats."""
+
+    def __init__(self):
+        self._stats: dict[str, CacheStats] = {}
+
+    def get(self, template: str) -> CacheStats:
+        if (stats := self._stats.get(template)) is None:
+            stats = self._stats[template] = CacheStats()
+        return stats
+
+    def record(self, template: str, outcome: CacheOutcome) -> None:
+        """Учитывает обращение к кешу, если включен отладочный заголовок - добавляет его в заголовок ответа."""
+        self.get(template).outcomes[outcome] += 1
+        if (outcomes := request_outcomes.get()) is not None:
+            outcomes.append(f'{template}={outcome.value}')
+
+    def as_dict(self) -> dict[str, Any]:
+        return {template: stats.as_dict() for template, stats in sorted(self._stats.items())}
+
+    def clear(self) -> None:
+        self._stats.clear()
+
+
+class CacheDebugHeaderMiddleware:
+    """Если включен CACHE_DEBUG_HEADER, добавляет в ответ заголовок X-Cache: чем закончились обращения к кешу.
+
+    Например "get_current_user=local, file_list_v2=miss". ASGI middleware, а не BaseHTTPMiddleware:
+    потоковые ответы (архивы, server-sent events) проходят без лишних задач и очередей.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not settings.CACHE_DEBUG_HEADER:
+            return await self.app(scope, receive, send)
+
+        outcomes: list[str] = []
+
+        async def send_with_header(message):
+            if message['type'] == 'http.response.start' and outcomes:
+                message['headers'] = [*message.get('headers', []), (DEBUG_HEADER, ', '.join(outcomes).encode())]
+            await send(message)
+
+        token = request_outcomes.set(outcomes)
+        try:
+            await self.app(scope, receive, send_with_header)
+        finally:
+            request_outcomes.reset(token)
+
+
+# исходы обращений к кешу в текущем запросе, None - отладочный заголовок выключен
+request_outcomes: ContextVar[list[str] | None] = ContextVar('request_outcomes', default=None)
+cache_metrics = CacheMetrics()
@@ -1,23 +1,84 @@
-import pickle
+import asyncio
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
 from logging import getLogger
+from typing import Any
 
-from redis import Redis
 from redis import asyncio as aioredis
+from redis import exceptions
+from redis.asyncio.client import Pipeline, PubSub
+from redis.exceptions import RedisError
 
+from cache.breaker import CircuitBreaker, CircuitOpenError
+from cache.codec import MISSING, CacheCodec
+from cache.memory import LocalCache
+from cache.metrics import (OTHER_TEMPLATE, CacheOutcome, CacheStats,
+                           cache_metrics)
+from cache.redis_keys import all_keys
 from config import settings
 
 logger = getLogger("redis")
 
+# отказы redis, после нескольких подряд предохранитель перестает к нему обращаться
+REDIS_FAILURES = (exceptions.ConnectionError, exceptions.TimeoutError, OSError)
+# ошибки, при которых кеш работает так, как будто его нет
+REDIS_ERRORS = (RedisError, OSError, CircuitOpenError)
+# через сколько секунд переподписываться на инвалидации, если redis недоступен
+LISTEN_RETRY_SECONDS = 1
+# как часто проверять, посчитал ли значение процесс, который держит блокировку
+LOCK_POLL_SECONDS = 0.05
+# блокировку снимает только тот, кто ее взял: она могла истечь и достаться другому
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
 
-def setup_redis() -> Redis:
+
+class BreakerRedis(aioredis.Redis):
+    """Клиент redis с предохранителем: пока redis недоступен, команды сразу завершаются CircuitOpenError."""
+    breaker: CircuitBreaker
+
+    async def execute_command(self, *args, **options):
+        return await self.breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> 'BreakerPipeline':
+        pipeline = BreakerPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipeline.breaker = self.breaker
+        return pipeline
+
+    async def probe(self) -> None:
+        """Проверка доступности в обход предохранителя."""
+        await super().execute_command('PING')
+
+
+class BreakerPipeline(Pipeline):
+    breaker: CircuitBreaker
+
+    async def execute(self, raise_on_error: bool = True):
+        return await self.breaker.call(super().execute, raise_on_error)
+
+
+def setup_redis() -> BreakerRedis:
     """
     Создаем пул соединений к редису
     :return: Redis-object
     """
     logger.debug('creating redis connection pool')
-    redis = aioredis.from_url(settings.REDIS_DSN, socket_timeout=0.5)
+    pool = aioredis.ConnectionPool.from_url(settings.REDIS_DSN, socket_timeout=0.5, socket_connect_timeout=0.5)
+    redis = BreakerRedis(connection_pool=pool)
+    redis.breaker = CircuitBreaker(
+        probe=redis.probe,
+        errors=REDIS_FAILURES,
+        failure_threshold=settings.REDIS_BREAKER_FAILURES,
+        reset_seconds=settings.REDIS_BREAKER_RESET_SECONDS,
+    )
     logger.debug('redis connection pool was created')
-    return redis  # type: ignore
+    return redis
 
 
 async def teardown_redis():
@@ -27,31 +88,399 @@ async def teardown_redis():
     logger.debug('closing redis connection pool')
     # к моменту вызова teardown_redis глобальный объект redis_cache определен
     # и находится в области видимости данной функции, поэтому просто делаем:
-    await redis_cache.close()
+    await redis_cache.breaker.stop()
+    await redis_cache.close(close_connection_pool=True)
     logger.debug('redis connection pool was closed')
 
 
-def timed_cache(cache_key: str, time: int):
+@dataclass
+class _CachePolicy:
+    codec: CacheCodec
+    # шаблон ключа и его метрики
+    template: str
+    stats: CacheStats
+    # через сколько секунд значение устаревает и сколько еще после этого отдается, пока пересчитывается
+    time: int
+    stale_time: int
+    # сколько секунд хранится пустое значение, 0 - пустые значения не кешируются
+    negative_time: int
+
+    def fresh_time(self, value: Any) -> int:
+        return self.time if value else self.negative_time
+
+    def ttl(self, value: Any) -> int:
+        """Сколько значение хранится в redis: пока оно свежее и, если оно не пустое, еще stale_time."""
+        return self.time + self.stale_time if value else self.negative_time
+
+    def fresh_for(self, value: Any, ttl_ms: int) -> float:
+        """Сколько секунд значение, которому в redis осталось жить ttl_ms, еще свежее."""
+        return ttl_ms / 1000 - (self.stale_time if value else 0)
+
+
+def timed_cache(cache_key: str, time: int, schema: Any, stale_time: int = 0, negative_time: int = 0):
+    """Кеширует результат в redis и в памяти процесса.
+
+    Из памяти процесса отдается тот же объект, без декодирования, поэтому результат нельзя менять.
+    Одновременные промахи по одному ключу считаются один раз: в процессе - одной задачей,
+    между процессами - тем, кто взял блокировку в redis, остальные ждут его результат.
+
+    Args:
+        cache_key (str): ключ в redis
+        time (int): через сколько секунд значение устаревает
+        schema: тип результата, по нему значение читается из redis (см. CacheCodec)
+        stale_time (int): сколько секунд после этого устаревшее значение еще отдается сразу,
+            а пересчитывается в фоне. Ждать пересчета приходится, только когда истекло и это время
+        negative_time (int): сколько секунд хранится пустой результат ([], None - "не найдено"),
+            0 - пустые результаты не кешируются. Устаревшим пустой результат не отдается
+    """
+    template = getattr(cache_key, 'template', OTHER_TEMPLATE)
+    policy = _CachePolicy(
+        codec=CacheCodec(schema, settings.CACHE_COMPRESS_MIN_KB * 1024),
+        template=template,
+        stats=cache_metrics.get(template),
+        time=time,
+        stale_time=stale_time,
+        negative_time=negative_time,
+    )
+
     def wrap(func):
         async def wrapped(*args, **kwargs):
-            cached_result = None
-            try:
-                cached_result = await redis_cache.get(cache_key)
-            except TimeoutError as e:
-                logger.error(str(e))
-            if cached_result:
-                return pickle.loads(cached_result)
-            func_result = await func(*args, **kwargs)
-            if func_result:
-                cached = pickle.dumps(func_result)
-                try:
-                    await redis_cache.set(name=cache_key, value=cached, ex=time)
-                except TimeoutError as e:
-                    logger.error(str(e))
-            return func_result
+            local_result = local_cache.get(cache_key, MISSING)
+            if local_result is not MISSING:
+                cache_metrics.record(template, CacheOutcome.local)
+                return local_result
+
+            coalesced = (load := _loads.get(cache_key)) is not None
+            if load is None:
+                load = asyncio.create_task(_load(cache_key, policy, partial(func, *args, **kwargs)))
+                _loads[cache_key] = load
+                load.add_done_callback(partial(_load_done, cache_key))
+            # запрос, который начал загрузку, может отключиться - остальные все равно дождутся результата
+            result, outcome = await asyncio.shield(load)
+            cache_metrics.record(template, CacheOutcome.coalesced if coalesced else outcome)
+            return result
 
         return wrapped
     return wrap
 
 
+async def _load(cache_key: str, policy: _CachePolicy, func) -> tuple[Any, CacheOutcome]:
+    epoch = local_cache.epoch
+    if (cached := await _get_cached(cache_key, policy)) is not None:
+        result, size, fresh_for = cached
+        if fresh_for > 0:
+            _set_local(cache_key, result, size, fresh_for, epoch)
+            return result, CacheOutcome.hit
+        _schedule_refresh(cache_key, policy, func)
+        return result, CacheOutcome.stale
+
+    lock_key = all_keys.cache_lock.substitute(key=cache_key)
+    token = uuid.uuid4().hex
+    locked = await _lock(lock_key, token, policy.stats)
+    if locked is False and (waited := await _wait_cached(cache_key, lock_key, policy)) is not None:
+        result, size = waited
+        _set_local(cache_key, result, size, policy.fresh_time(result), epoch)
+        return result, CacheOutcome.waited
+
+    try:
+        return await _compute(cache_key, policy, func, epoch), CacheOutcome.miss
+    finally:
+        if locked:
+            await _unlock(lock_key, token, policy.stats)
+
+
+async def _compute(cache_key: str, policy: _CachePolicy, func, epoch: int):
+    """Считает значение и кладет его в redis (вместе с временем, когда устаревшее значение еще отдается) и в память."""
+    func_result = await func()
+    if ttl := policy.ttl(func_result):
+        with policy.stats.encode.time():
+            cached = policy.codec.encode(func_result)
+        try:
+            with _redis_call(policy.stats):
+                await redis_cache.set(name=cache_key, value=cached, ex=ttl)
+        except REDIS_ERRORS as e:
+            _log_error(e)
+        else:
+            policy.stats.stored += 1
+            policy.stats.stored_bytes += len(cached)
+        _set_local(cache_key, func_result, len(cached), policy.fresh_time(func_result), epoch)
+    return func_result
+
+
+def _schedule_refresh(cache_key: str, policy: _CachePolicy, func) -> None:
+    if cache_key in _refreshes:
+        return
+    refresh = asyncio.create_task(_refresh(cache_key, policy, func))
+    _refreshes[cache_key] = refresh
+    refresh.add_done_callback(lambda _: _refreshes.pop(cache_key, None))
+
+
+async def _refresh(cache_key: str, policy: _CachePolicy, func) -> None:
+    """Пересчитывает устаревшее значение в фоне. Если его уже пересчитывает другой процесс - ничего не делает."""
+    epoch = local_cache.epoch
+    lock_key = all_keys.cache_lock.substitute(key=cache_key)
+    token = uuid.uuid4().hex
+    if not await _lock(lock_key, token, policy.stats):
+        return
+    try:
+        result = await _compute(cache_key, policy, func, epoch)
+        if not policy.ttl(result):
+            # пустой результат не кешируется, но и старое значение отдавать больше нельзя
+            with _redis_call(policy.stats):
+                await redis_cache.delete(cache_key)
+    except Exception:
+        logger.exception('failed to refresh %s', cache_key)
+    finally:
+        await _unlock(lock_key, token, policy.stats)
+
+
+async def _lock(lock_key: str, token: str, stats: CacheStats) -> bool | None:
+    """Берет блокировку пересчета. None - redis недоступен, блокировку взять нельзя."""
+    try:
+        with _redis_call(stats):
+            return bool(await redis_cache.set(lock_key, token, nx=True, ex=settings.CACHE_LOCK_SECONDS))
+    except REDIS_ERRORS as e:
+        _log_error(e)
+        return None
+
+
+async def _unlock(lock_key: str, token: str, stats: CacheStats) -> None:
+    try:
+        with _redis_call(stats):
+            await redis_cache.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+    except REDIS_ERRORS as e:
+        _log_error(e)
+
+
+async def _get_cached(cache_key: str, policy: _CachePolicy) -> tuple[Any, int, float] | None:
+    """Значение из redis, его размер и сколько секунд оно еще свежее (<= 0 - устарело, но еще отдается).
+
+    Запись другой версии схемы считается промахом.
+    """
+    try:
+        with _redis_call(policy.stats):
+            async with redis_cache.pipeline(transaction=False) as pipe:
+                cached_result, ttl = await pipe.get(cache_key).pttl(cache_key).execute()
+    except REDIS_ERRORS as e:
+        _log_error(e)
+        return None
+    if (result := _decode(cached_result, policy)) is not MISSING:
+        return result, len(cached_result), policy.fresh_for(result, ttl)
+    return None
+
+
+async def _wait_cached(cache_key: str, lock_key: str, policy: _CachePolicy) -> tuple[Any, int] | None:
+    """Ждет, пока значение посчитает процесс, который держит блокировку.
+
+    None - если блокировку отпустили без значения (пустой результат мог не кешироваться) или она истекла.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.CACHE_LOCK_SECONDS
+    while loop.time() < deadline:
+        await asyncio.sleep(LOCK_POLL_SECONDS)
+        try:
+            with _redis_call(policy.stats):
+                async with redis_cache.pipeline(transaction=False) as pipe:
+                    cached_result, locked = await pipe.get(cache_key).exists(lock_key).execute()
+        except REDIS_ERRORS as e:
+            _log_error(e)
+            return None
+        if (result := _decode(cached_result, policy)) is not MISSING:
+            return result, len(cached_result)
+        if not locked:
+            return None
+    return None
+
+
+def _decode(cached_result: bytes | None, policy: _CachePolicy) -> Any:
+    if not cached_result:
+        return MISSING
+    with policy.stats.decode.time():
+        return policy.codec.decode(cached_result)
+
+
+@contextmanager
+def _redis_call(stats: CacheStats) -> Iterator[None]:
+    """Время запроса в redis и его ошибки - в метрики шаблона ключа."""
+    try:
+        with stats.redis.time():
+            yield
+    except REDIS_ERRORS:
+        stats.errors += 1
+        raise
+
+
+def _load_done(cache_key: str, load: asyncio.Task) -> None:
+    _loads.pop(cache_key, None)
+    if not load.cancelled():
+        # ошибку получают те, кто ждал загрузку, если все ушли - не пишем в лог "never retrieved"
+        load.exception()
+
+
+async def get_generation(user_id: uuid.UUID) -> int:
+    """Текущее поколение кеша пользователя, входит в ключи кешей его файлов."""
+    key = all_keys.cache_generation.substitute(user_id=user_id)
+    generation: int | None = local_cache.get(key)
+    if generation is not None:
+        return generation
+    epoch = local_cache.epoch
+    try:
+        generation = int(await redis_cache.get(key) or 0)
+    except REDIS_ERRORS as e:
+        _log_error(e)
+        return 0
+    _set_local(key, generation, len(key), settings.LOCAL_CACHE_TTL_SECONDS, epoch)
+    return generation
+
+
+async def bump_generation(user_id: uuid.UUID) -> None:
+    """Начинает новое поколение кеша пользователя: закешированные списки и поиски больше не читаются.
+
+    Старые ключи никто не удаляет, они истекают по TTL.
+    """
+    key = all_keys.cache_generation.substitute(user_id=user_id)
+    try:
+        await redis_cache.incr(key)
+    except REDIS_ERRORS as e:
+        _log_error(e)
+    await invalidate_local([key])
+
+
+async def invalidate_local(keys: list[str]) -> None:
+    """Сбрасывает ключи в памяти этого процесса и, через pub/sub, всех остальных."""
+    for key in keys:
+        local_cache.invalidate(key)
+    try:
+        async with redis_cache.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.publish(all_keys.cache_invalidation.substitute(), key)
+            await pipe.execute()
+    except REDIS_ERRORS as e:
+        _log_error(e)
+
+
+async def listen_invalidations() -> None:
+    """Сбрасывает в памяти процесса ключи, которые инвалидировали другие процессы.
+
+    Кеш в памяти включен, только пока процесс подписан: пропущенная инвалидация оставила бы
+    в нем устаревшие данные, поэтому при потере подписки он очищается.
+    """
+    channel = all_keys.cache_invalidation.substitute()
+    while True:
+        if not redis_cache.breaker.is_closed:
+            await asyncio.sleep(LISTEN_RETRY_SECONDS)
+            continue
+        pubsub = redis_cache.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            local_cache.enabled = True
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=LISTEN_RETRY_SECONDS)
+                if message is not None:
+                    local_cache.invalidate(message['data'].decode())
+        except REDIS_ERRORS as e:
+            _log_error(e)
+        finally:
+            local_cache.enabled = False
+            local_cache.clear()
+            await pubsub.close()
+        await asyncio.sleep(LISTEN_RETRY_SECONDS)
+
+
+def start_invalidation_listener() -> None:
+    global _listener
+    if settings.LOCAL_CACHE_SIZE_MB and _listener is None:
+        _listener = asyncio.create_task(listen_invalidations())
+
+
+async def stop_invalidation_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        await asyncio.wait([_listener])
+        _listener = None
+
+
+def _log_error(e: Exception) -> None:
+    # пока предохранитель разомкнут, каждый запрос получал бы эту ошибку - в лог она уже попала при размыкании
+    if not isinstance(e, CircuitOpenError):
+        logger.error(str(e))
+
+
+def _set_local(key: str, value, size: int, time: float, epoch: int) -> None:
+    # в памяти держим не дольше LOCAL_CACHE_TTL_SECONDS: это предел устаревания, если инвалидация не дошла
+    local_cache.set(key, value, size, min(time, settings.LOCAL_CACHE_TTL_SECONDS), epoch)
+
+
+async def publish_many(messages: dict[str, str]) -> None:
+    """Рассылает сообщения подписчикам каналов одним запросом.
+
+    Подписчики перепроверяют состояние и без сообщений, поэтому недоступный redis запрос не ломает.
+    """
+    if not messages:
+        return
+    try:
+        async with redis_cache.pipeline(transaction=False) as pipe:
+            for channel, message in messages.items():
+                pipe.publish(channel, message)
+            await pipe.execute()
+    except REDIS_ERRORS as e:
+        _log_error(e)
+
+
+class Subscription:
+    """Подписка на канал pub/sub.
+
+    Если redis недоступен, wait просто ждет timeout: подписчик все равно перепроверяет состояние сам.
+
+    Examples:
+
+        async with Subscription(channel) as updates:
+            while True:
+                await updates.wait(15)
+                ...
+    """
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self._pubsub: PubSub | None = None
+
+    async def __aenter__(self) -> 'Subscription':
+        if not redis_cache.breaker.is_closed:
+            return self
+        pubsub = redis_cache.pubsub()
+        try:
+            await pubsub.subscribe(self.channel)
+            self._pubsub = pubsub
+        except REDIS_ERRORS as e:
+            _log_error(e)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.unsubscribe()
+                await self._pubsub.close()
+            except REDIS_ERRORS as e:
+                _log_error(e)
+
+    async def wait(self, timeout: float) -> bool:
+        """Ждет сообщение не дольше timeout секунд, True - если сообщение пришло."""
+        if self._pubsub is not None:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+                return message is not None
+            except REDIS_ERRORS as e:
+                _log_error(e)
+                self._pubsub = None
+        await asyncio.sleep(timeout)
+        return False
+
+
 redis_cache = setup_redis()
+# ключ: загрузка значения, которая сейчас идет в этом процессе
+_loads: dict[str, asyncio.Task] = {}
+# ключ: фоновый пересчет устаревшего значения
+_refreshes: dict[str, asyncio.Task] = {}
+local_cache = LocalCache(settings.LOCAL_CACHE_SIZE_MB * 1024 * 1024)
+_listener: asyncio.Task | None = None
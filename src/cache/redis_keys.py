@@ -1,14 +1,52 @@
 from string import Template
+from urllib.parse import quote
 
 from pydantic import BaseSettings
 
+# так в ключе записывается None: quote экранирует "!", поэтому ни одно значение не даст такой же строки
+NONE_VALUE = '!'
+
+
+class CacheKey(str):
+    """Ключ redis, который помнит, из какого шаблона собран: по шаблонам считаются метрики кеша."""
+    template: str
+
+
+class KeyTemplate(Template):
+    """Шаблон ключа redis, значения экранируются.
+
+    Части ключа разделены ":", а значения (пути, расширения) могут его содержать, поэтому
+    без экранирования разные параметры могли бы дать один и тот же ключ.
+    """
+
+    @property
+    def name(self) -> str:
+        """Постоянная часть шаблона до первой подстановки, например file_list_v2."""
+        return self.template.split('$', 1)[0].rstrip(':_')
+
+    def substitute(self, mapping=None, /, **kwargs) -> CacheKey:  # type: ignore
+        values = {**(mapping or {}), **kwargs}
+        key = CacheKey(super().substitute({
+            name: NONE_VALUE if value is None else quote(str(value), safe='') for name, value in values.items()
+        }))
+        key.template = self.name
+        return key
+
 
 class CommonConfig(BaseSettings):
-    file_list: Template = Template("file_list_v1_$user_id")
-    get_current_user: Template = Template("get_current_user_$token")
-    search_files: Template = Template("search_files_$user_id$path$extension$order_by$limit")
-    revision_files: Template = Template("revision_files_$user_id$path$limit")
-    file_view: Template = Template("file_view_$user_id$file_id")
+    # $generation - поколение кеша пользователя, меняется при каждой загрузке файлов
+    file_list: KeyTemplate = KeyTemplate("file_list_v2:$user_id:$generation:$limit:$offset")
+    get_current_user: KeyTemplate = KeyTemplate("get_current_user_$token")
+    search_files: KeyTemplate = KeyTemplate("search_files_v2:$user_id:$generation:$path:$extension:$order_by:$limit")
+    revision_files: KeyTemplate = KeyTemplate("revision_files_v2:$user_id:$generation:$path:$limit")
+    file: KeyTemplate = KeyTemplate("file:$user_id:$generation:$file_id")
+    cache_generation: KeyTemplate = KeyTemplate("cache_generation:$user_id")
+    # блокировка пересчета закешированного значения, чтобы на промах его считал один процесс
+    cache_lock: KeyTemplate = KeyTemplate("cache_lock:$key")
+    # канал pub/sub, в который публикуются ключи, устаревшие в кеше в памяти процессов
+    cache_invalidation: KeyTemplate = KeyTemplate("cache_invalidation")
+    # канал pub/sub, в который публикуется новая ревизия файла
+    file_updates: KeyTemplate = KeyTemplate("file_updates_$file_id")
 
 
 all_keys = CommonConfig()
@@ -2,8 +2,9 @@
 import enum
 from functools import cached_property
 
-from pydantic import BaseSettings, Field
+from pydantic import BaseSettings, Field, validator
 
+from utils.hashing import BLOB_HASH_ALGORITHMS, is_available
 from utils.logs import get_log_config
 
 
@@ -17,6 +18,13 @@ class LogLevel(enum.Enum):
     NOTSET = "NOTSET"
 
 
+class FsyncPolicy(enum.Enum):
+    """Гарантии сохранности записанных файлов при сбое."""
+    NONE = "none"  # полагаемся на ОС
+    FILE = "file"  # fsync содержимого файла
+    FILE_DIR = "file+dir"  # fsync содержимого и каталога, в который файл перенесен
+
+
 class PostgresSettings(BaseSettings):
     """Настройки Postgres."""
 
@@ -69,16 +77,74 @@ class Settings(BaseSettings):
 
     POSTGRES: PostgresSettings = PostgresSettings()
     REDIS_DSN: str = Field('redis://redis:6379/1', description='dsn для подключения к кэшу redis')
+    REDIS_BREAKER_FAILURES: int = Field(
+        5, description='после скольких ошибок redis подряд перестать к нему обращаться, 0 - не переставать',
+    )
+    REDIS_BREAKER_RESET_SECONDS: int = Field(
+        5, description='как часто проверять redis, пока к нему не обращаемся',
+    )
 
     SVC_VERSION: str = Field("latest", description="версия приложения")
     SVC_NAME: str = Field("file_server", description="название приложения")
     STATIC_ROOT: str = Field("static/", description="каталог для хранения статических файлов")
     MAX_FILE_SIZE_KB: int = Field(1024, description="максимальный размер загружаемого файла")
+    CHUNK_SIZE_KB: int = Field(64, description="размер чанка при чтении файлов с диска")
+    UPLOAD_CHUNK_SIZE_KB: int = Field(1024, description="размер чанка при загрузке файла по частям")
+    UPLOAD_BUFFER_SIZE_KB: int = Field(1024, description="размер буфера, которым загружаемые данные пишутся на диск")
+    DIRECTORY_CACHE_USERS: int = Field(1024, description="для скольких пользователей кешировать id директорий")
+    DIRECTORY_CACHE_SIZE: int = Field(1024, description="сколько id директорий кешировать на пользователя")
+    ARCHIVE_LIST_PAGE_SIZE: int = Field(1000, description="сколько файлов за запрос к БД читать при скачивании директории")
+    ARCHIVE_CACHE_SIZE_MB: int = Field(1024, description="размер кеша архивов директорий, 0 - кеш выключен")
+    ARCHIVE_CACHE_MAX_ARCHIVE_MB: int = Field(
+        256, description="директории с файлами большего суммарного размера отдаются без кеширования",
+    )
+    ARCHIVE_COMPRESS_LEVEL: int = Field(
+        6, ge=0, le=9, description="уровень deflate при архивации, 0 - файлы кладутся в архив без сжатия",
+    )
+    ARCHIVE_ZSTD_LEVEL: int = Field(3, ge=1, le=22, description="уровень сжатия zstd для архивов tar.zst")
+    ARCHIVE_COMPRESS_WORKERS: int = Field(4, ge=1, description="сколько файлов архива сжимаются одновременно")
+    VIEW_PAGE_LINES: int = Field(1000, description="сколько строк файла отдавать при просмотре, если limit не указан")
+    VIEW_MAX_PAGE_KB: int = Field(1024, description="максимальный размер страницы при просмотре файла")
+    TAIL_LINES: int = Field(100, description="сколько последних строк файла отдавать, если lines не указан")
+    TAIL_FOLLOW_INTERVAL_SECONDS: float = Field(
+        15, description="как часто при слежении за файлом перепроверять его без уведомления и слать keepalive",
+    )
+    CACHE_TTL_SECONDS: int = Field(
+        24 * 60 * 60, description="время жизни кеша списков, поиска и ревизий файлов (сбрасывается при загрузке)",
+    )
+    CACHE_STALE_SECONDS: int = Field(
+        60 * 60, description="сколько еще секунд после CACHE_TTL_SECONDS кеш отдается сразу, а пересчитывается в фоне",
+    )
+    CACHE_NEGATIVE_TTL_SECONDS: int = Field(
+        60, description="время жизни кеша пустых результатов и \"не найдено\" (сбрасывается при загрузке)",
+    )
+    CACHE_COMPRESS_MIN_KB: int = Field(1, description="значения кеша от этого размера сжимаются, 0 - не сжимать")
+    CACHE_DEBUG_HEADER: bool = Field(
+        False, description="добавлять в ответы заголовок X-Cache: чем закончились обращения к кешу",
+    )
+    LOCAL_CACHE_SIZE_MB: int = Field(64, description="размер кеша в памяти процесса перед redis, 0 - без него")
+    LOCAL_CACHE_TTL_SECONDS: int = Field(60, description="сколько секунд значение живет в кеше в памяти процесса")
+    CACHE_LOCK_SECONDS: int = Field(
+        5, description="сколько процессы ждут значение, которое после промаха кеша считает другой процесс",
+    )
+    BATCH_MAX_FILES: int = Field(1000, description="максимальное количество файлов в пакетной загрузке")
+    FSYNC_POLICY: FsyncPolicy = Field(FsyncPolicy.FILE, description="политика fsync при записи файлов")
+    FILE_HASH_ALGORITHM: str = Field(
+        "sha256", description="алгоритм хеширования содержимого файлов (ключ блоба): sha256 или blake2b",
+    )
 
     LOG: LogSettings = LogSettings()
     SECRET_KEY: str = Field(description='секретный ключ приложения')
     HASH_ALGORITHM: str = Field("HS256", description='алгоритм шифрования пароля')
     ACCESS_TOKEN_EXPIRE_MINUTES: int = Field(30, description='срок жизни токена в минутах')
 
+    @validator('FILE_HASH_ALGORITHM')
+    def check_hash_algorithm(cls, value: str) -> str:
+        if value not in BLOB_HASH_ALGORITHMS:
+            raise ValueError(f'алгоритм хеширования {value} не подходит, допустимы: {", ".join(BLOB_HASH_ALGORITHMS)}')
+        if not is_available(value):
+            raise ValueError(f'алгоритм хеширования {value} недоступен')
+        return value
+
 
 settings = Settings()
@@ -0,0 +1,49 @@
+from collections import Counter, defaultdict
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud.base import SqlalchemyCrud
+from db.models.blob import Blob
+from schemas.blob import Blob as BlobSchema
+from schemas.blob import BlobCreate
+
+
+class BlobCrud(SqlalchemyCrud):
+    model: type[Blob] = Blob   # type: ignore
+    schema = BlobSchema
+    id_name = 'hash'
+
+    async def acquire(self, data: list[BlobCreate], rw_session: AsyncSession) -> None:
+        """Регистрирует блобы (если их еще нет) и увеличивает счетчики ссылок на них.
+
+        Один и тот же блоб может встречаться в списке несколько раз - по разу на каждую ссылку.
+        """
+        refs = Counter(blob.hash for blob in data)
+        sizes = {blob.hash: blob.size for blob in data}
+        if not refs:
+            return
+        query = insert(self.model).values([
+            {"hash": blob_hash, "size": sizes[blob_hash], "refs": count} for blob_hash, count in refs.items()
+        ])
+        query = query.on_conflict_do_update(
+            index_elements=[self.model.hash],
+            set_={"refs": self.model.refs + query.excluded.refs},
+        )
+        await rw_session.execute(query)
+
+    async def release(self, hashes: list[str], rw_session: AsyncSession) -> None:
+        """Уменьшает счетчики ссылок на блобы, хеш повторяется в списке по разу на каждую ссылку.
+
+        Блобы без ссылок не удаляются сразу: их содержимое нужно старым ревизиям файлов.
+        """
+        by_count: dict[int, list[str]] = defaultdict(list)
+        for blob_hash, count in Counter(hashes).items():
+            by_count[count].append(blob_hash)
+        # обычно у каждого блоба одна ссылка, тогда это один запрос
+        for count, blob_hashes in by_count.items():
+            query = update(self.model).values(refs=func.greatest(self.model.refs - count, 0)).where(
+                self.model.hash.in_(blob_hashes),
+            )
+            await rw_session.execute(query)
@@ -1,20 +1,122 @@
 import uuid
 
-from sqlalchemy import outerjoin, select
+from sqlalchemy import (BigInteger, String, any_, cast, literal, or_,
+                        outerjoin, select)
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, insert
 from sqlalchemy.engine.row import Row
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import func
 
+from cache.memory import LRUCache
+from config import settings
 from crud.base import SqlalchemyCrud
 from db.models.directory import Directory
 from db.models.file import File
 from schemas.directory import Directory as DirectorySchema
 from schemas.user import UserStatus
 
+# пользователь: LRUCache(путь директории: id), общий для всех запросов процесса
+directory_cache = LRUCache(settings.DIRECTORY_CACHE_USERS)
+
 
 class DirectoryCrud(SqlalchemyCrud):
     model: type[Directory] = Directory   # type: ignore
     schema = DirectorySchema
 
+    async def get_or_create_many(
+        self,
+        user_id: uuid.UUID,
+        paths: list[str],
+        rw_session: AsyncSession,
+    ) -> dict[str, uuid.UUID]:
+        """Создает недостающие директории для всех переданных путей (`user/docs/a`), включая промежуточные.
+
+        Возвращает словарь путь: id для всех директорий на этих путях.
+        Если все директории уже известны процессу - запросов к БД нет, если есть в БД - один select,
+        недостающие создаются одним insert на все уровни вложенности.
+        """
+        # все предки в порядке от корня, родитель всегда раньше вложенной
+        all_paths = list(dict.fromkeys(
+            '/'.join(parts[:level]) for parts in (path.split('/') for path in paths) for level in range(1, len(parts) + 1)
+        ))
+        user_cache = self._user_cache(user_id)
+        ids = {path: user_cache.get(path) for path in all_paths}
+        if missing := {path for path, id in ids.items() if id is None}:
+            ids.update(await self._get_ids(user_id, missing, rw_session))
+
+        if missing := {path for path, id in ids.items() if id is None}:
+            # директории пользователя создаются по очереди, иначе одновременно созданная директория
+            # не даст вставить свою, а ее id уже записан как parent_id у вложенных
+            await rw_session.execute(select(func.pg_advisory_xact_lock(literal(self._lock_key(user_id), BigInteger))))
+            ids.update(await self._get_ids(user_id, missing, rw_session))
+
+            new_dirs = []
+            for path in all_paths:
+                if ids[path] is None:
+                    parent, _, name = path.rpartition('/')
+                    # id задаем сами, чтобы вложенные директории сослались на него в том же insert
+                    ids[path] = uuid.uuid4()
+                    new_dirs.append({
+                        "id": ids[path], "name": name, "path": path, "user_id": user_id,
+                        "parent_id": ids[parent] if parent else None,
+                    })
+            if new_dirs:
+                await rw_session.execute(insert(self.model).values(new_dirs))
+
+        # если транзакция откатится, в кеше останутся несуществующие id, их сбрасывает invalidate
+        for path, id in ids.items():
+            user_cache.set(path, id)
+        return ids  # type: ignore
+
+    async def get_by_path(self, user_id: uuid.UUID, path: str) -> DirectorySchema | None:
+        return await self.get_one(user_id=user_id, path=path.strip('/'))  # type: ignore
+
+    async def get_many(self, user_id: uuid.UUID, ids: list[uuid.UUID], paths: list[str]) -> list[DirectorySchema]:
+        """Директории пользователя по списку идентификаторов и путей, одним запросом."""
+        query = select(self.model).where(
+            self.model.user_id == user_id,
+            or_(
+                self.model.id == any_(cast(ids, ARRAY(UUID(as_uuid=True)))),
+                self.model.path == any_(cast([path.strip('/') for path in paths], ARRAY(String))),
+            ),
+        )
+        async with self.ro_session() as session:
+            return [self.schema.from_orm(obj) for obj in (await session.execute(query)).scalars()]
+
+    async def delete(self, id: uuid.UUID) -> DirectorySchema | None:  # type: ignore
+        directory = await super().delete(id)
+        if directory is not None:
+            self.invalidate(directory.user_id)  # type: ignore
+        return directory  # type: ignore
+
+    @staticmethod
+    def invalidate(user_id: uuid.UUID | None = None) -> None:
+        """Сбрасывает закешированные директории пользователя (или всех пользователей)."""
+        if user_id is None:
+            directory_cache.clear()
+        else:
+            directory_cache.pop(user_id)
+
+    async def _get_ids(self, user_id: uuid.UUID, paths: set[str], rw_session: AsyncSession) -> dict[str, uuid.UUID]:
+        query = select(self.model.path, self.model.id).where(
+            self.model.user_id == user_id,
+            self.model.path.in_(paths),
+        )
+        return dict((await rw_session.execute(query)).all())  # type: ignore
+
+    @staticmethod
+    def _user_cache(user_id: uuid.UUID) -> LRUCache:
+        user_cache: LRUCache | None = directory_cache.get(user_id)
+        if user_cache is None:
+            user_cache = LRUCache(settings.DIRECTORY_CACHE_SIZE)
+            directory_cache.set(user_id, user_cache)
+        return user_cache
+
+    @staticmethod
+    def _lock_key(user_id: uuid.UUID) -> int:
+        # старшие 64 бита uuid, в пространстве ключей блокировок файлов пересечения маловероятны
+        return int.from_bytes(user_id.bytes[:8], 'big', signed=True)
+
     async def get_status(self, user_id: uuid.UUID) -> UserStatus:
         query = select(
             self.model.user_id,
@@ -1,15 +1,22 @@
+import hashlib
 import logging
 import uuid
+from collections.abc import AsyncIterator
 
-from sqlalchemy import select
-from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import (BigInteger, String, any_, cast, func, literal, or_,
+                        select, tuple_)
+from sqlalchemy.dialects.postgresql import (ARRAY, UUID, aggregate_order_by,
+                                            insert)
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from crud.base import SqlalchemyCrud
+from crud.blob import BlobCrud
 from crud.revision import RevisionCrud
+from db.models.directory import Directory
 from db.models.file import File, FileOrderBy
-from schemas.base import BaseModel
+from schemas.blob import BlobCreate
 from schemas.file import File as FileSchema
+from schemas.file import FileCreate
 from schemas.revision import RevisionCreate
 from utils.functools import is_valid_uuid
 
@@ -20,23 +27,93 @@ class FileCrud(SqlalchemyCrud):
     model: type[File] = File   # type: ignore
     schema = FileSchema
 
-    async def create_or_update(self, data: BaseModel, file_hash: str) -> FileSchema:
-        query = insert(self.model).values(**data.dict(exclude_defaults=True)).on_conflict_do_update(
+    async def create_or_update_many(
+        self,
+        data: list[FileCreate],
+        hash_algorithm: str,
+        rw_session: AsyncSession,
+    ) -> list[FileSchema]:
+        """Создает или перезаписывает файлы пачкой, вместе с их ревизиями и ссылками на блобы.
+
+        Все делается в переданной сессии, количество запросов не зависит от количества файлов.
+        Если файл с тем же именем в той же директории передан несколько раз, сохраняется последний.
+        """
+        files = list({(file.directory_id, file.name): file for file in data}.values())
+        keys = [(file.name, file.directory_id) for file in files]
+
+        # загрузки по одному пути выполняются по очереди, в том числе из разных процессов.
+        # select for update тут не помогает: при создании файла блокировать еще нечего.
+        # блокировки берем в одном порядке, чтобы пачки с пересекающимися путями не ловили deadlock
+        lock_keys = sorted({self._path_lock_key(file) for file in files})
+        lock_key = func.unnest(cast(lock_keys, ARRAY(BigInteger))).column_valued('key')
+        await rw_session.execute(select(func.pg_advisory_xact_lock(lock_key)))
+
+        # блобы, на которые сейчас ссылаются файлы (если файлы уже есть)
+        old_blobs_query = select(self.model.name, self.model.directory_id, self.model.blob_hash).where(
+            tuple_(self.model.name, self.model.directory_id).in_(keys),
+        ).with_for_update()
+        old_blobs = {
+            (name, directory_id): blob_hash
+            for name, directory_id, blob_hash in await rw_session.execute(old_blobs_query)
+        }
+
+        blob_crud = BlobCrud()
+        await blob_crud.acquire([
+            BlobCreate(hash=file.blob_hash, size=file.size)
+            for file in files if file.blob_hash and file.blob_hash != old_blobs.get((file.name, file.directory_id))
+        ], rw_session=rw_session)
+
+        query = insert(self.model).values([file.dict() for file in files])
+        query = query.on_conflict_do_update(
             constraint='uix_name_directory_id',
-            set_=data.dict(exclude_defaults=True),
+            set_={column: query.excluded[column] for column in FileCreate.__fields__},
         ).returning(*self.model_columns)
+        instances = [self.schema.from_orm(instance) for instance in await rw_session.execute(query)]
+
+        await blob_crud.release([
+            old_hash
+            for file in files
+            if (old_hash := old_blobs.get((file.name, file.directory_id))) and old_hash != file.blob_hash
+        ], rw_session=rw_session)
+        # важно атомарно создать ревизии файлов в рамках той же сессии
+        # если не удастся создать ревизию, то и файл не должен сохраниться
+        await RevisionCrud().create_or_touch([
+            RevisionCreate(hash=file.blob_hash, hash_algorithm=hash_algorithm, file_id=file.id)
+            for file in instances if file.blob_hash
+        ], rw_session=rw_session)
 
-        async with self.rw_session() as session:
-            instance = (await session.execute(query)).fetchone()
-            file = self.schema.from_orm(instance)
-            # важно атомарно создать ревизию файла в рамках той же сессии
-            # если не удастся создать ревизию, то и файл  не должен сохранится
-            revision = RevisionCreate(hash=file_hash, file_id=file.id)
-            try:
-                await RevisionCrud().create(data=revision, rw_session=session)
-            except IntegrityError:
-                logger.info("Ревизия для данного файла уже существует.")
-            return file
+        # в том же порядке, в котором файлы переданы
+        by_key = {(file.name, file.directory_id): file for file in instances}
+        return [by_key[key] for key in keys]
+
+    def _under_directories(
+        self,
+        user_id: uuid.UUID,
+        directory_paths: list[str],
+        file_ids: list[uuid.UUID] | None = None,
+    ) -> list:
+        """Условия выборки файлов из поддеревьев директорий и отдельно выбранных файлов.
+
+        Каждая директория - отдельное условие с префиксом-константой (path LIKE 'a/b/%'):
+        только так поиск поддерева идет по индексу uix_directory_user_id_path, LIKE ANY(массив) индекс не использует.
+        """
+        # в LIKE обратная косая черта - экранирующий символ по умолчанию
+        selected = [
+            or_(Directory.path == path, Directory.path.like(_escape_like(path) + '/%'))
+            for path in directory_paths
+        ]
+        if file_ids:
+            selected.append(self.model.id == any_(cast(file_ids, ARRAY(UUID(as_uuid=True)))))
+        return [
+            self.model.user_id == user_id,
+            Directory.user_id == user_id,
+            or_(*selected),
+        ]
+
+    @staticmethod
+    def _path_lock_key(data: FileCreate) -> int:
+        key = f'{data.directory_id}/{data.name}'.encode()
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big', signed=True)
 
     async def search(self, user_id: uuid.UUID, path: str, extension: str, order_by: FileOrderBy, limit: int):
         # все файлы пользователя
@@ -62,3 +139,91 @@ class FileCrud(SqlalchemyCrud):
             result = await session.stream(query)
             async for obj in result.scalars():
                 yield self.schema.from_orm(obj)
+
+    async def get_directory_fingerprint(self, user_id: uuid.UUID, directory_path: str) -> tuple[str | None, int]:
+        """Отпечаток содержимого директории и суммарный размер ее файлов, одним запросом.
+
+        Отпечаток меняется, если в поддереве добавился, удалился, переместился или перезаписался
+        хоть один файл: в него входят пути, хеши содержимого и даты файлов.
+        """
+        entry = self.model.path + ':' + func.coalesce(self.model.blob_hash, cast(self.model.id, String)) + ':' + \
+            cast(self.model.created_ad, String)
+        query = select(
+            func.md5(func.string_agg(entry, aggregate_order_by(literal('\n'), self.model.path))),
+            func.coalesce(func.sum(self.model.size), 0),
+        ).join(Directory, self.model.directory_id == Directory.id).where(
+            *self._under_directories(user_id, [directory_path]),
+        )
+        async with self.ro_session() as session:
+            fingerprint, size = (await session.execute(query)).one()
+            return fingerprint, size
+
+    async def get_many(self, user_id: uuid.UUID, ids: list[uuid.UUID], paths: list[str]) -> list[FileSchema]:
+        """Файлы пользователя по списку идентификаторов и путей, одним запросом."""
+        query = select(self.model).where(
+            self.model.user_id == user_id,
+            or_(
+                self.model.id == any_(cast(ids, ARRAY(UUID(as_uuid=True)))),
+                self.model.path == any_(cast(paths, ARRAY(String))),
+            ),
+        )
+        async with self.ro_session() as session:
+            return [self.schema.from_orm(obj) for obj in (await session.execute(query)).scalars()]
+
+    def get_under_directory(
+        self,
+        user_id: uuid.UUID,
+        directory_path: str,
+        page_size: int,
+    ) -> AsyncIterator[FileSchema]:
+        """Все файлы директории и ее поддиректорий, по порядку путей."""
+        return self.get_selection(user_id, [directory_path], [], page_size)
+
+    async def get_selection(
+        self,
+        user_id: uuid.UUID,
+        directory_paths: list[str],
+        file_ids: list[uuid.UUID],
+        page_size: int,
+    ) -> AsyncIterator[FileSchema]:
+        """Все файлы из поддеревьев директорий и отдельно выбранные файлы, по порядку путей.
+
+        Файл, который попадает под несколько условий, возвращается один раз.
+        Читаются страницами, каждая в своей короткой сессии: соединение с БД не держится,
+        пока клиент скачивает архив. Страница - диапазон индекса ix_file_user_id_path из `page_size`
+        файлов пользователя, из него берутся выбранные: каждая страница читает не больше `page_size`
+        строк, как бы далеко от начала она ни была, а не сортирует заново все оставшиеся файлы.
+        """
+        selected = self._under_directories(user_id, directory_paths, file_ids)
+        # выбранное лежит между первым и последним выбранным путем, остальные файлы пользователя не читаем
+        bounds_query = select(func.min(self.model.path), func.max(self.model.path)).join(
+            Directory, self.model.directory_id == Directory.id,
+        ).where(*selected)
+        async with self.ro_session() as session:
+            first_path, last_path = (await session.execute(bounds_query)).one()
+        if first_path is None:
+            return
+
+        query = select(self.model).join(Directory, self.model.directory_id == Directory.id).where(
+            *selected,
+        ).order_by(self.model.path)
+        page_start = self.model.path >= first_path
+        while True:
+            # конец страницы - page_size-й по порядку файл пользователя, одним проходом по индексу
+            page_end_query = select(self.model.path).where(
+                self.model.user_id == user_id, page_start, self.model.path <= last_path,
+            ).order_by(self.model.path).offset(page_size - 1).limit(1)
+            async with self.ro_session() as session:
+                page_end = (await session.execute(page_end_query)).scalar() or last_path
+                page = (await session.execute(
+                    query.where(page_start, self.model.path <= page_end),
+                )).scalars().all()
+            for obj in page:
+                yield self.schema.from_orm(obj)
+            if page_end == last_path:
+                return
+            page_start = self.model.path > page_end
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
@@ -1,12 +1,15 @@
 import uuid
 
 from sqlalchemy import join, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import func
 
 from crud.base import SqlalchemyCrud
 from db.models.file import File
 from db.models.revision import Revision
 from schemas.revision import Revision as RevisionSchema
-from schemas.revision import RevisionResponse
+from schemas.revision import RevisionCreate, RevisionResponse
 from utils.functools import is_valid_uuid
 
 
@@ -14,6 +17,19 @@ class RevisionCrud(SqlalchemyCrud):
     model: type[Revision] = Revision   # type: ignore
     schema = RevisionSchema
 
+    async def create_or_touch(self, data: list[RevisionCreate], rw_session: AsyncSession) -> None:
+        """Создает ревизии, а если такое содержимое у файла уже было - делает ее последней."""
+        if not data:
+            return
+        query = insert(self.model).values([revision.dict() for revision in data]).on_conflict_do_update(
+            constraint='uix_hash_file_id',
+            set_={"modified_at": func.now()},
+        )
+        await rw_session.execute(query)
+
+    async def get_latest(self, file_id: uuid.UUID) -> RevisionSchema | None:
+        return await self.get_one(file_id=file_id, order_by=[self.model.modified_at.desc()])  # type: ignore
+
     async def get_revision(self, path: str, user_id: uuid.UUID, limit: int) -> list[RevisionResponse]:
         query = select(
             File.id,
@@ -22,6 +38,7 @@ class RevisionCrud(SqlalchemyCrud):
             File.created_ad,
             self.model.id.label("rev_id"),
             self.model.hash,
+            self.model.hash_algorithm,
             self.model.modified_at
         ).select_from(
             join(self.model, File)
@@ -0,0 +1,31 @@
+import uuid
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from crud.base import SqlalchemyCrud
+from db.models.upload import UploadChunk, UploadSession
+from schemas.upload import UploadSession as UploadSessionSchema
+
+
+class UploadSessionCrud(SqlalchemyCrud):
+    model: type[UploadSession] = UploadSession   # type: ignore
+    schema = UploadSessionSchema
+
+    async def add_chunk(self, session_id: uuid.UUID, index: int) -> None:
+        """Отмечает чанк загруженным, повторная загрузка того же чанка допустима."""
+        query = insert(UploadChunk).values(session_id=session_id, index=index).on_conflict_do_nothing()
+        async with self.rw_session() as session:
+            await session.execute(query)
+
+    async def remove_chunk(self, session_id: uuid.UUID, index: int) -> None:
+        """Снимает отметку о загрузке чанка, например если его содержимое перезаписано неудачной повторной загрузкой."""
+        query = delete(UploadChunk).where(UploadChunk.session_id == session_id, UploadChunk.index == index)
+        async with self.rw_session() as session:
+            await session.execute(query)
+
+    async def get_chunks(self, session_id: uuid.UUID) -> list[int]:
+        query = select(UploadChunk.index).where(UploadChunk.session_id == session_id).order_by(UploadChunk.index)
+        async with self.ro_session() as session:
+            result = await session.execute(query)
+            return list(result.scalars())
@@ -0,0 +1,29 @@
+"""file user_id path index
+
+Revision ID: b6d41f0e92a7
+Revises: 7f3c457b3ec7
+Create Date: 2026-10-18 21:02:14.518305
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b6d41f0e92a7'
+down_revision = '7f3c457b3ec7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # файлы под директорией выбираются через directory.path, поиск по префиксу пути файла больше не нужен,
+    # а для сортировки и диапазонов по path индекс с varchar_pattern_ops не подходит
+    op.drop_index('ix_file_user_id_path_pattern', table_name='file', postgresql_ops={'path': 'varchar_pattern_ops'})
+    op.create_index('ix_file_user_id_path', 'file', ['user_id', 'path'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_file_user_id_path', table_name='file')
+    op.create_index(
+        'ix_file_user_id_path_pattern', 'file', ['user_id', 'path'], unique=False,
+        postgresql_ops={'path': 'varchar_pattern_ops'},
+    )
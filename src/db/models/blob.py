@@ -0,0 +1,13 @@
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String
+from sqlalchemy.sql import func
+
+from db.base import Base
+
+
+class Blob(Base):
+    __tablename__ = 'blob'
+
+    hash = Column(String(128), primary_key=True, comment='Хеш содержимого, по нему блоб лежит на диске')
+    size = Column(BigInteger, nullable=False, comment='Размер содержимого')
+    refs = Column(Integer, nullable=False, default=0, comment='Количество файлов, ссылающихся на блоб')
+    created_ad = Column(DateTime(timezone=True), default=func.now(), nullable=False, comment='Дата создания')
@@ -1,6 +1,6 @@
 import uuid
 
-from sqlalchemy import Column, DateTime, ForeignKey, String, UniqueConstraint
+from sqlalchemy import Column, DateTime, ForeignKey, Index, String
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import func
 
@@ -10,11 +10,14 @@ from db.base import Base
 class Directory(Base):
     __tablename__ = 'directory'
     __table_args__ = (
-        UniqueConstraint('name', 'user_id', name='uix_name_user_id'),
+        # pattern_ops - чтобы тот же индекс работал для выборки поддерева по префиксу пути (path LIKE 'a/b/%')
+        Index('uix_directory_user_id_path', 'user_id', 'path', unique=True,
+              postgresql_ops={'path': 'varchar_pattern_ops'}),
     )
 
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4, nullable=False)
     name = Column(String(100), nullable=False, index=True, comment='Имя директории')
+    path = Column(String(500), nullable=False, comment='Полный путь директории, начиная с корневой директории пользователя')
     created_ad = Column(DateTime(timezone=True), default=func.now(), nullable=False, comment='Дата создания')
     user_id = Column(UUID(as_uuid=True), ForeignKey('user.id', ondelete="CASCADE"),
                      nullable=False, comment='Связь с пользователем')
@@ -1,7 +1,7 @@
 import uuid
 from enum import Enum
 
-from sqlalchemy import (Column, DateTime, ForeignKey, Integer, String,
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer, String,
                         UniqueConstraint)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import func
@@ -19,6 +19,8 @@ class File(Base):
     __tablename__ = 'file'
     __table_args__ = (
         UniqueConstraint('name', 'directory_id', name='uix_name_directory_id'),
+        # файлы пользователя по порядку путей: страницы выборки файлов для архива - диапазоны этого индекса
+        Index('ix_file_user_id_path', 'user_id', 'path'),
     )
 
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4, nullable=False)
@@ -31,3 +33,5 @@ class File(Base):
                           nullable=False, comment='Связь с директорией')
     user_id = Column(UUID(as_uuid=True), ForeignKey('user.id', ondelete="CASCADE"),
                      nullable=False, comment='Связь с пользователем')
+    blob_hash = Column(String(128), ForeignKey('blob.hash'), index=True,
+                       comment='Содержимое файла в хранилище блобов, у старых файлов пусто')
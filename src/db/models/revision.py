@@ -15,6 +15,7 @@ class Revision(Base):
 
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4, nullable=False)
     hash = Column(String(500), nullable=False, comment='Хеш ревизии файла')
+    hash_algorithm = Column(String(32), nullable=False, server_default='md5', comment='Алгоритм хеширования')
     modified_at = Column(DateTime(timezone=True), onupdate=func.now(), default=func.now(),
                          nullable=False, comment='Дата модификации файла')
     file_id = Column(UUID(as_uuid=True), ForeignKey('file.id', ondelete="CASCADE"),
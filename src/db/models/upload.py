@@ -0,0 +1,29 @@
+import uuid
+
+from sqlalchemy import (BigInteger, Column, DateTime, ForeignKey, Integer,
+                        String)
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.sql import func
+
+from db.base import Base
+
+
+class UploadSession(Base):
+    __tablename__ = 'upload_session'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4, nullable=False)
+    path = Column(String(500), nullable=False, comment='Путь до файла относительно хранилища')
+    name = Column(String(100), nullable=False, comment='Имя файла')
+    size = Column(BigInteger, nullable=False, comment='Размер файла')
+    chunk_size = Column(Integer, nullable=False, comment='Размер чанка, последний может быть меньше')
+    created_ad = Column(DateTime(timezone=True), default=func.now(), nullable=False, comment='Дата создания')
+    user_id = Column(UUID(as_uuid=True), ForeignKey('user.id', ondelete="CASCADE"),
+                     nullable=False, comment='Связь с пользователем')
+
+
+class UploadChunk(Base):
+    __tablename__ = 'upload_chunk'
+
+    session_id = Column(UUID(as_uuid=True), ForeignKey('upload_session.id', ondelete="CASCADE"),
+                        primary_key=True, comment='Связь с сессией загрузки')
+    index = Column(Integer, primary_key=True, comment='Номер чанка')
@@ -62,7 +62,7 @@ async def get_current_user(
     """Зависимость, вернет пользователя если токен валиден."""
     cache_key = all_keys.get_current_user.substitute(token=token)
 
-    @timed_cache(cache_key=cache_key, time=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+    @timed_cache(cache_key=cache_key, time=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60, schema=User)
     async def cached(*args, **kwargs):
         try:
             payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.HASH_ALGORITHM])
@@ -1,11 +1,20 @@
 from logging import getLogger
 
 from api import file_router, router_healthcheck, user_router
+from cache.metrics import CacheDebugHeaderMiddleware
+from cache.redis import (start_invalidation_listener,
+                         stop_invalidation_listener, teardown_redis)
 from utils.helpers import configure_app
 
 logger = getLogger("main")
 app = configure_app()
 
+app.add_middleware(CacheDebugHeaderMiddleware)
+
 app.include_router(router_healthcheck, tags=["healthcheck"], prefix="/ping")
 app.include_router(file_router, tags=["files"], prefix="/files")
 app.include_router(user_router, tags=["users"])
+
+app.add_event_handler("startup", start_invalidation_listener)
+app.add_event_handler("shutdown", stop_invalidation_listener)
+app.add_event_handler("shutdown", teardown_redis)
@@ -0,0 +1,13 @@
+from datetime import datetime
+
+from schemas.base import BaseModel
+
+
+class BlobCreate(BaseModel):
+    hash: str
+    size: int
+
+
+class Blob(BlobCreate):
+    refs: int
+    created_ad: datetime
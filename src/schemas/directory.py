@@ -6,6 +6,7 @@ from schemas.base import BaseModel, IdSchema
 
 class DirectoryCreate(BaseModel):
     name: str
+    path: str
     user_id: uuid.UUID
     parent_id: uuid.UUID | None = None
 
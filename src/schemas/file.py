@@ -1,6 +1,10 @@
 import uuid
 from datetime import datetime
+from enum import Enum
 
+from pydantic import Field
+
+from config import settings
 from schemas.base import BaseModel, IdSchema
 
 
@@ -11,6 +15,7 @@ class FileCreate(BaseModel):
     user_id: uuid.UUID
     created_ad: datetime
     directory_id: uuid.UUID
+    blob_hash: str | None = None
 
 
 class File(FileCreate, IdSchema):
@@ -21,9 +26,30 @@ class UploadFileBody(BaseModel):
     path: str
 
 
+class DownloadSelection(BaseModel):
+    items: list[str] = Field(
+        ..., min_items=1, max_items=settings.BATCH_MAX_FILES, description="Пути или идентификаторы файлов и директорий",
+    )
+
+
 class SearchResult(BaseModel):
     matches: list[File]
 
 
+class TailFile(IdSchema):
+    content: str
+    offset: int = Field(0, description="Смещение начала content в байтах")
+    size: int = Field(0, description="Размер файла в байтах")
+
+
+class ViewUnit(str, Enum):
+    lines = "lines"
+    bytes = "bytes"
+
+
 class ViewFile(IdSchema):
     content: str
+    offset: int = Field(0, description="С какой строки (байта) начинается страница")
+    next_offset: int | None = Field(None, description="Смещение следующей страницы, null - файл прочитан до конца")
+    size: int = Field(0, description="Размер файла в байтах")
+    lines: int | None = Field(None, description="Количество строк в файле (при просмотре по строкам)")
@@ -6,6 +6,7 @@ from schemas.base import BaseModel, IdSchema
 
 class RevisionCreate(BaseModel):
     hash: str
+    hash_algorithm: str
     file_id: uuid.UUID
 
 
@@ -20,4 +21,5 @@ class RevisionResponse(BaseModel):
     path: str
     rev_id: uuid.UUID
     hash: str
+    hash_algorithm: str
     modified_at: datetime
@@ -0,0 +1,39 @@
+import uuid
+from datetime import datetime
+
+from pydantic import Field
+
+from schemas.base import BaseModel, IdSchema
+
+
+class UploadSessionCreate(BaseModel):
+    path: str
+    name: str
+    size: int
+    chunk_size: int
+    user_id: uuid.UUID
+
+
+class UploadSession(UploadSessionCreate, IdSchema):
+    created_ad: datetime
+
+    @property
+    def chunks(self) -> int:
+        """Количество чанков, на которые делится файл."""
+        return -(-self.size // self.chunk_size)
+
+    def chunk_range(self, index: int) -> tuple[int, int]:
+        """Смещение и размер чанка в файле."""
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+
+class UploadSessionStatus(BaseModel):
+    id: uuid.UUID
+    path: str
+    name: str
+    size: int
+    chunk_size: int
+    chunks: int = Field(description='Количество чанков, на которые делится файл')
+    received: list[int] = Field(description='Номера уже загруженных чанков')
+    created_ad: datetime
@@ -0,0 +1,578 @@
+"""Потоковая запись архивов.
+
+Архив формируется по мере чтения файлов с диска и отдается клиенту чанками,
+поэтому расход памяти на запрос не зависит от размера архива.
+Уже сжатые форматы кладутся в zip без сжатия, остальные файлы сжимаются
+в пуле потоков по несколько штук одновременно.
+Tar (без сжатия, gzip или zstd) почти не тратит CPU и подходит для выгрузки больших директорий.
+"""
+import asyncio
+import mimetypes
+import os
+import stat as st
+import struct
+import tarfile
+import time
+import zlib
+from collections import deque
+from collections.abc import AsyncIterable, AsyncIterator, Iterable
+from contextlib import suppress
+from dataclasses import dataclass
+from enum import Enum
+from typing import BinaryIO, NamedTuple, Protocol
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# признак того, что значение не поместилось в 32 бита и лежит в zip64 extra
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+# 4.5 - минимальная версия формата с поддержкой zip64
+ZIP_VERSION = 45
+# создано в unix, нужно чтобы распаковщики учитывали external_attr
+ZIP_CREATE_SYSTEM = 3
+# 0x08 - размеры и crc записаны в data descriptor после данных, 0x800 - имя в utf-8
+ZIP_FLAGS = 0x08 | 0x800
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR = struct.Struct('<IIQQ')
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_RECORD_SIGNATURE = 0x06064b50
+ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+ZIP64_END_LOCATOR_SIGNATURE = 0x07064b50
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD_SIGNATURE = 0x06054b50
+ZIP64_EXTRA_TAG = 0x0001
+# права для файлов, которые кладутся в архив без stat
+DEFAULT_FILE_MODE = st.S_IFREG | 0o644
+
+# форматы, которые уже сжаты: deflate тратит на них CPU и почти ничего не выигрывает
+COMPRESSED_EXTENSIONS = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.jar', '.apk',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub',
+})
+COMPRESSED_MIME_TYPES = frozenset({
+    'application/zip', 'application/gzip', 'application/x-7z-compressed', 'application/x-rar-compressed',
+    'application/x-bzip2', 'application/x-xz', 'application/zstd',
+})
+# по этому куску начала файла оценивается, стоит ли его сжимать
+SAMPLE_SIZE = 64 * 1024
+# если пробный кусок сжался хуже, файл кладется в архив без сжатия
+MIN_COMPRESS_RATIO = 0.9
+# сколько сжатых чанков одной записи может ждать отправки, ограничивает память на запись
+QUEUE_CHUNKS = 4
+
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+# архив tar заканчивается двумя пустыми блоками
+TAR_END = bytes(2 * TAR_BLOCK_SIZE)
+
+
+class ArchiveFormat(str, Enum):
+    zip = "zip"  # type: ignore
+    tar = "tar"
+    tar_gz = "tar.gz"
+    tar_zst = "tar.zst"
+
+    @property
+    def media_type(self) -> str:
+        return ARCHIVE_MEDIA_TYPES[self]
+
+    @property
+    def is_available(self) -> bool:
+        return self != ArchiveFormat.tar_zst or zstandard is not None
+
+
+ARCHIVE_MEDIA_TYPES = {
+    ArchiveFormat.zip: 'application/x-zip-compressed',
+    ArchiveFormat.tar: 'application/x-tar',
+    ArchiveFormat.tar_gz: 'application/gzip',
+    ArchiveFormat.tar_zst: 'application/zstd',
+}
+# типы из заголовка Accept, по которым выбирается формат архива
+ACCEPT_FORMATS = {
+    'application/zip': ArchiveFormat.zip,
+    'application/x-zip-compressed': ArchiveFormat.zip,
+    'application/x-tar': ArchiveFormat.tar,
+    'application/gzip': ArchiveFormat.tar_gz,
+    'application/x-gzip': ArchiveFormat.tar_gz,
+    'application/x-gtar': ArchiveFormat.tar_gz,
+    'application/zstd': ArchiveFormat.tar_zst,
+}
+
+
+class StreamCompressor(Protocol):
+    def compress(self, data: bytes, /) -> bytes:
+        ...
+
+    def flush(self) -> bytes:
+        ...
+
+
+class ArchiveMember(NamedTuple):
+    """Файл, который нужно положить в архив."""
+    path: str
+    arcname: str
+    # если время модификации известно заранее, stat на диске не делается
+    mtime: float | None = None
+
+
+class EntryCompressor:
+    """Сжатие одной записи архива и ее crc и размеры.
+
+    Не зависит от положения записи в архиве, поэтому записи можно сжимать параллельно,
+    а в архив они попадут в исходном порядке.
+    """
+
+    def __init__(self, compress_type: int = ZIP_DEFLATED, compresslevel: int = zlib.Z_DEFAULT_COMPRESSION):
+        self.compress_type = compress_type
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self._compressor = None
+        if compress_type == ZIP_DEFLATED:
+            self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self.compress_size += len(data)
+        return data
+
+    def flush(self) -> bytes:
+        """Возвращает остаток сжатых данных, повторный вызов возвращает пустые байты."""
+        if self._compressor is None:
+            return b''
+        tail = self._compressor.flush()
+        self._compressor = None
+        self.compress_size += len(tail)
+        return tail
+
+
+@dataclass
+class ZipEntry:
+    """Метаданные записи, нужные для центрального каталога."""
+    name: bytes
+    dos_time: int
+    dos_date: int
+    compress_type: int
+    external_attr: int
+    header_offset: int
+    crc: int = 0
+    compress_size: int = 0
+    file_size: int = 0
+
+
+class ZipStream:
+    """Потоковый writer zip архива (zip64 + data descriptor).
+
+    Ничего не пишет сам, а возвращает байты, которые нужно отдать клиенту.
+    Размеры и crc записи становятся известны только после ее сжатия,
+    поэтому они пишутся в data descriptor после данных, а не в локальный заголовок.
+
+    Examples:
+
+        archive = ZipStream()
+        yield archive.start_entry('a.txt', mtime, mode)
+        yield archive.write(b'data')
+        yield archive.finish_entry()
+        yield archive.close()
+    """
+
+    def __init__(self, compresslevel: int = zlib.Z_DEFAULT_COMPRESSION):
+        self.compresslevel = compresslevel
+        self._offset = 0
+        self._entries: list[ZipEntry] = []
+        self._current: ZipEntry | None = None
+        self._compressor: EntryCompressor | None = None
+
+    def start_entry(
+        self,
+        arcname: str,
+        mtime: float,
+        mode: int,
+        compress_type: int = ZIP_DEFLATED,
+        compressor: EntryCompressor | None = None,
+    ) -> bytes:
+        """Начинает новую запись, возвращает ее локальный заголовок.
+
+        Если передан compressor, данные записи сжимаются снаружи и передаются в `write_compressed`.
+        """
+        if self._current is not None:
+            raise ValueError('Предыдущая запись архива не завершена')
+
+        self._compressor = compressor or EntryCompressor(compress_type, self.compresslevel)
+        compress_type = self._compressor.compress_type
+        name = _normalize_arcname(arcname).encode('utf-8')
+        dos_time, dos_date = _dos_date_time(mtime)
+        self._current = ZipEntry(
+            name=name,
+            dos_time=dos_time,
+            dos_date=dos_date,
+            compress_type=compress_type,
+            external_attr=(mode & 0xFFFF) << 16,
+            header_offset=self._offset,
+        )
+
+        # размеры пока неизвестны: в заголовке маркеры zip64, в extra нули
+        extra = struct.pack('<HHQQ', ZIP64_EXTRA_TAG, 16, 0, 0)
+        header = LOCAL_HEADER.pack(
+            LOCAL_HEADER_SIGNATURE, ZIP_VERSION, ZIP_FLAGS, compress_type, dos_time, dos_date,
+            0, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra),
+        ) + name + extra
+        return self._tell(header)
+
+    def write(self, data: bytes) -> bytes:
+        """Добавляет данные в текущую запись, возвращает сжатую часть."""
+        if self._current is None:
+            raise ValueError('Нет открытой записи архива')
+        return self._tell(self._compressor.compress(data))  # type: ignore
+
+    def write_compressed(self, data: bytes) -> bytes:
+        """Добавляет в текущую запись данные, уже сжатые ее compressor."""
+        if self._current is None:
+            raise ValueError('Нет открытой записи архива')
+        return self._tell(data)
+
+    def finish_entry(self) -> bytes:
+        """Завершает текущую запись, возвращает остаток данных и data descriptor."""
+        entry, compressor = self._current, self._compressor
+        if entry is None or compressor is None:
+            raise ValueError('Нет открытой записи архива')
+
+        tail = compressor.flush()
+        entry.crc = compressor.crc
+        entry.compress_size = compressor.compress_size
+        entry.file_size = compressor.file_size
+        self._entries.append(entry)
+        self._current = None
+        self._compressor = None
+
+        descriptor = DATA_DESCRIPTOR.pack(
+            DATA_DESCRIPTOR_SIGNATURE, entry.crc, entry.compress_size, entry.file_size,
+        )
+        return self._tell(tail + descriptor)
+
+    def close(self) -> bytes:
+        """Возвращает центральный каталог и конец архива."""
+        if self._current is not None:
+            raise ValueError('Последняя запись архива не завершена')
+
+        cd_offset = self._offset
+        central_dir = b''.join(self._central_header(entry) for entry in self._entries)
+        cd_size = len(central_dir)
+        count = len(self._entries)
+
+        end = b''
+        if count >= ZIP64_COUNT_LIMIT or cd_size >= ZIP64_LIMIT or cd_offset >= ZIP64_LIMIT:
+            zip64_offset = cd_offset + cd_size
+            end += ZIP64_END_RECORD.pack(
+                ZIP64_END_RECORD_SIGNATURE, ZIP64_END_RECORD.size - 12,
+                ZIP_CREATE_SYSTEM << 8 | ZIP_VERSION, ZIP_VERSION, 0, 0, count, count, cd_size, cd_offset,
+            )
+            end += ZIP64_END_LOCATOR.pack(ZIP64_END_LOCATOR_SIGNATURE, 0, zip64_offset, 1)
+            count = min(count, ZIP64_COUNT_LIMIT)
+            cd_size = min(cd_size, ZIP64_LIMIT)
+            cd_offset = min(cd_offset, ZIP64_LIMIT)
+
+        end += END_RECORD.pack(END_RECORD_SIGNATURE, 0, 0, count, count, cd_size, cd_offset, 0)
+        return self._tell(central_dir + end)
+
+    @staticmethod
+    def _central_header(entry: ZipEntry) -> bytes:
+        # в zip64 extra попадают только те значения, которые не влезли в 32 бита
+        zip64_fields = []
+        file_size, compress_size, header_offset = entry.file_size, entry.compress_size, entry.header_offset
+        if file_size >= ZIP64_LIMIT:
+            zip64_fields.append(file_size)
+            file_size = ZIP64_LIMIT
+        if compress_size >= ZIP64_LIMIT:
+            zip64_fields.append(compress_size)
+            compress_size = ZIP64_LIMIT
+        if header_offset >= ZIP64_LIMIT:
+            zip64_fields.append(header_offset)
+            header_offset = ZIP64_LIMIT
+
+        extra = b''
+        if zip64_fields:
+            extra = struct.pack(f'<HH{len(zip64_fields)}Q', ZIP64_EXTRA_TAG, 8 * len(zip64_fields), *zip64_fields)
+
+        return CENTRAL_HEADER.pack(
+            CENTRAL_HEADER_SIGNATURE, ZIP_CREATE_SYSTEM << 8 | ZIP_VERSION, ZIP_VERSION, ZIP_FLAGS,
+            entry.compress_type, entry.dos_time, entry.dos_date, entry.crc, compress_size, file_size,
+            len(entry.name), len(extra), 0, 0, 0, entry.external_attr, header_offset,
+        ) + entry.name + extra
+
+    def _tell(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+
+async def stream_zip(
+    members: Iterable[ArchiveMember] | AsyncIterable[ArchiveMember],
+    chunk_size: int,
+    compresslevel: int = zlib.Z_DEFAULT_COMPRESSION,
+    workers: int = 1,
+) -> AsyncIterator[bytes]:
+    """Формирует zip архив из файлов на диске, отдавая его по частям.
+
+    Следующие `workers` файлов читаются и сжимаются в пуле потоков, пока отдается текущий
+    (zlib отпускает GIL, так что сжатие идет параллельно), порядок записей в архиве сохраняется.
+    В памяти на каждый файл не больше QUEUE_CHUNKS сжатых чанков и состояние компрессора.
+    Список файлов тоже может приходить по частям (асинхронный итератор).
+    """
+    archive = ZipStream(compresslevel)
+    pending: deque[_MemberJob] = deque()
+    try:
+        async for member in _aiter(members):
+            pending.append(_MemberJob.start(member, chunk_size, compresslevel))
+            if len(pending) >= workers:
+                async for data in pending[0].write_to(archive):
+                    yield data
+                pending.popleft()
+        while pending:
+            async for data in pending[0].write_to(archive):
+                yield data
+            pending.popleft()
+        yield archive.close()
+    finally:
+        # клиент отключился или файл не прочитался - текущий и остальные файлы дальше не сжимаем.
+        # Задача из pending убирается только после того, как файл записан в архив, иначе при
+        # отключении посреди файла она осталась бы ждать места в очереди с открытым файлом
+        for job in pending:
+            job.task.cancel()
+        if pending:
+            await asyncio.wait([job.task for job in pending])
+
+
+def compress_type_for(arcname: str, sample: bytes, compresslevel: int = zlib.Z_DEFAULT_COMPRESSION) -> int:
+    """Выбирает способ сжатия записи по имени файла и пробному куску его начала."""
+    if compresslevel == 0 or not sample:
+        return ZIP_STORED
+    if os.path.splitext(arcname)[1].lower() in COMPRESSED_EXTENSIONS:
+        return ZIP_STORED
+    mime_type = mimetypes.guess_type(arcname)[0] or ''
+    if mime_type in COMPRESSED_MIME_TYPES or mime_type.startswith('video/'):
+        return ZIP_STORED
+    sample = sample[:SAMPLE_SIZE]
+    if len(zlib.compress(sample, 1)) > len(sample) * MIN_COMPRESS_RATIO:
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+@dataclass
+class _MemberJob:
+    """Чтение и сжатие одного файла архива в фоне."""
+    member: ArchiveMember
+    queue: asyncio.Queue
+    task: asyncio.Task
+
+    @classmethod
+    def start(cls, member: ArchiveMember, chunk_size: int, compresslevel: int) -> '_MemberJob':
+        queue: asyncio.Queue = asyncio.Queue(QUEUE_CHUNKS)
+        task = asyncio.create_task(_compress_member(member, chunk_size, compresslevel, queue))
+        return cls(member, queue, task)
+
+    async def write_to(self, archive: ZipStream) -> AsyncIterator[bytes]:
+        """Пишет сжатый файл в архив по мере готовности чанков."""
+        mtime, mode, compressor = await self._get()
+        yield archive.start_entry(self.member.arcname, mtime, mode, compressor=compressor)
+        while (data := await self._get()) is not None:
+            if data:
+                yield archive.write_compressed(data)
+        yield archive.finish_entry()
+
+    async def _get(self):
+        item = await self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+async def _compress_member(member: ArchiveMember, chunk_size: int, compresslevel: int, queue: asyncio.Queue) -> None:
+    try:
+        file, mtime, mode, chunk = await _open_member_in_thread(member, chunk_size)
+        try:
+            compress_type = await asyncio.to_thread(compress_type_for, member.arcname, chunk, compresslevel)
+            compressor = EntryCompressor(compress_type, compresslevel)
+            await queue.put((mtime, mode, compressor))
+            while chunk:
+                # сжатие текущего чанка и чтение следующего - один переход в пул потоков
+                data, chunk = await asyncio.to_thread(_compress_chunk, file, compressor, chunk, chunk_size)
+                await queue.put(data)
+            await queue.put(None)
+        finally:
+            await asyncio.to_thread(file.close)
+    except Exception as exc:
+        # ошибку поднимет тот, кто пишет архив, когда дойдет до этого файла
+        await queue.put(exc)
+
+
+async def _open_member_in_thread(member: ArchiveMember, chunk_size: int) -> tuple[BinaryIO, float, int, bytes]:
+    opening = asyncio.ensure_future(asyncio.to_thread(_open_member, member, chunk_size))
+    try:
+        return await asyncio.shield(opening)
+    except asyncio.CancelledError:
+        # поток откроет файл и после отмены задачи: дожидаемся его и закрываем
+        with suppress(Exception):
+            file, *_ = await opening
+            await asyncio.to_thread(file.close)
+        raise
+
+
+def _open_member(member: ArchiveMember, chunk_size: int) -> tuple[BinaryIO, float, int, bytes]:
+    file = open(member.path, 'rb')
+    try:
+        if member.mtime is None:
+            stat = os.fstat(file.fileno())
+            mtime, mode = stat.st_mtime, stat.st_mode
+        else:
+            mtime, mode = member.mtime, DEFAULT_FILE_MODE
+        return file, mtime, mode, file.read(chunk_size)  # type: ignore
+    except BaseException:
+        file.close()
+        raise
+
+
+def _compress_chunk(file: BinaryIO, compressor: EntryCompressor, chunk: bytes, chunk_size: int) -> tuple[bytes, bytes]:
+    return compressor.compress(chunk), file.read(chunk_size)
+
+
+async def stream_tar(
+    members: Iterable[ArchiveMember] | AsyncIterable[ArchiveMember],
+    chunk_size: int,
+    compressor: StreamCompressor | None = None,
+) -> AsyncIterator[bytes]:
+    """Формирует tar архив из файлов на диске, отдавая его по частям.
+
+    Без сжатия прочитанные чанки отдаются как есть. Со сжатием (gzip, zstd) весь поток
+    сжимается целиком, блоками не меньше chunk_size в пуле потоков.
+    """
+    blocks = _tar_blocks(members, chunk_size)
+    if compressor is None:
+        async for block in blocks:
+            yield block
+        yield TAR_END
+        return
+
+    buffer = bytearray()
+    async for block in blocks:
+        buffer += block
+        if len(buffer) >= chunk_size:
+            data, buffer = bytes(buffer), bytearray()
+            if data := await asyncio.to_thread(compressor.compress, data):
+                yield data
+    yield await asyncio.to_thread(_compress_tail, compressor, bytes(buffer + TAR_END))
+
+
+def tar_compressor(
+    archive_format: ArchiveFormat,
+    compresslevel: int,
+    zstd_level: int,
+    workers: int = 1,
+) -> StreamCompressor | None:
+    if archive_format == ArchiveFormat.tar_gz:
+        # 16 + MAX_WBITS - поток в формате gzip с заголовком и crc
+        return zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if archive_format == ArchiveFormat.tar_zst:
+        # zstd сам сжимает поток в нескольких потоках
+        compressor: StreamCompressor = zstandard.ZstdCompressor(level=zstd_level, threads=workers).compressobj()
+        return compressor
+    return None
+
+
+def format_from_accept(accept: str | None) -> ArchiveFormat | None:
+    """Формат архива из заголовка Accept с учетом q, недоступные на сервере форматы пропускаются."""
+    if not accept:
+        return None
+    accepted = []
+    for item in accept.split(','):
+        media_type, *params = (part.strip() for part in item.split(';'))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        archive_format = ACCEPT_FORMATS.get(media_type.lower())
+        if archive_format is not None and archive_format.is_available and quality > 0:
+            accepted.append((quality, archive_format))
+    if not accepted:
+        return None
+    # sort устойчивый: при равном q побеждает тот, кто указан раньше
+    return sorted(accepted, key=lambda item: -item[0])[0][1]
+
+
+async def _tar_blocks(
+    members: Iterable[ArchiveMember] | AsyncIterable[ArchiveMember],
+    chunk_size: int,
+) -> AsyncIterator[bytes]:
+    async for member in _aiter(members):
+        file, mtime, mode, chunk = await asyncio.to_thread(_open_member, member, chunk_size)
+        try:
+            size = (await asyncio.to_thread(os.fstat, file.fileno())).st_size
+            info = tarfile.TarInfo(_normalize_arcname(member.arcname))
+            info.size, info.mtime, info.mode = size, int(mtime), st.S_IMODE(mode)
+            # pax заголовки - для длинных путей и имен не в ascii
+            yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+            # в заголовке уже записан размер, поэтому отдаем ровно size байт
+            remaining = size
+            while chunk and remaining:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+                yield chunk
+                chunk = await asyncio.to_thread(file.read, min(chunk_size, remaining)) if remaining else b''
+            if remaining:
+                raise OSError(f'Файл {member.path} изменился во время архивации')
+            if padding := -size % TAR_BLOCK_SIZE:
+                yield bytes(padding)
+        finally:
+            await asyncio.to_thread(file.close)
+
+
+def _compress_tail(compressor: StreamCompressor, data: bytes) -> bytes:
+    return compressor.compress(data) + compressor.flush()
+
+
+async def _aiter(members: Iterable[ArchiveMember] | AsyncIterable[ArchiveMember]) -> AsyncIterator[ArchiveMember]:
+    if isinstance(members, AsyncIterable):
+        async for member in members:
+            yield member
+    else:
+        for member in members:
+            yield member
+
+
+def _normalize_arcname(arcname: str) -> str:
+    """Приводит имя к виду, который ожидают распаковщики (как zipfile.ZipInfo)."""
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    arcname = arcname.lstrip(os.sep)
+    if os.altsep:
+        arcname = arcname.lstrip(os.altsep).replace(os.altsep, '/')
+    return arcname.replace(os.sep, '/')
+
+
+def _dos_date_time(mtime: float) -> tuple[int, int]:
+    """Время модификации в формате MS-DOS, zip не умеет даты раньше 1980 года."""
+    year, month, day, hour, minute, second = time.localtime(mtime)[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    dos_time = second // 2 | minute << 5 | hour << 11
+    dos_date = day | month << 5 | (year - 1980) << 9
+    return dos_time, dos_date
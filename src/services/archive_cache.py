@@ -0,0 +1,178 @@
+"""Кеш готовых архивов директорий.
+
+Архив директории определяется отпечатком ее содержимого (пути, хеши и даты файлов), поэтому
+повторное скачивание неизмененной директории - это отдача готового файла, без повторного сжатия.
+Размер кеша ограничен, давно не скачанные архивы вытесняются первыми.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections.abc import AsyncIterable, AsyncIterator
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import BinaryIO
+
+from aiofiles import os as aio_os
+
+from config import FsyncPolicy, settings
+from services.archive import ArchiveMember, stream_zip
+
+logger = logging.getLogger(__name__)
+
+ARCHIVES_DIR = 'archives'
+TEMP_DIR = 'tmp'
+# архив, который только что отдавали, не вытесняем: его еще может читать другой запрос
+EVICTION_GRACE_SECONDS = 60
+
+
+@dataclass
+class _Build:
+    """Идущая сборка архива: временный файл, который дописывается, и сколько байт в нем уже на диске."""
+    fingerprint: str
+    temp_path: str
+    size: int = 0
+    task: asyncio.Future = field(init=False)
+    # выставляется после каждого записанного блока и в конце сборки, затем заменяется новым
+    progress: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def notify(self) -> None:
+        self.progress.set()
+        self.progress = asyncio.Event()
+
+
+# отпечаток: сборка архива, одновременные запросы одной директории ждут одну сборку
+_builds: dict[str, _Build] = {}
+
+
+@dataclass
+class ArchiveCache:
+    base_dir: str
+    max_size: int
+
+    @property
+    def root(self) -> str:
+        return os.path.join(self.base_dir, ARCHIVES_DIR)
+
+    def archive_path(self, fingerprint: str) -> str:
+        return os.path.join(self.root, f'{fingerprint}.zip')
+
+    async def get(self, fingerprint: str) -> str | None:
+        """Путь до готового архива, если он есть в кеше."""
+        path = self.archive_path(fingerprint)
+        try:
+            # время модификации - время последнего использования, по нему вытесняем
+            await asyncio.to_thread(os.utime, path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    async def build(self, fingerprint: str, members: AsyncIterable[ArchiveMember]) -> str:
+        """Собирает архив и кладет его в кеш, если сборка этого архива уже идет - дожидается ее."""
+        build = self._start(fingerprint, members)
+        # сборка не прерывается, если клиент, который ее начал, отключился
+        return await asyncio.shield(build.task)
+
+    async def stream(self, fingerprint: str, members: AsyncIterable[ArchiveMember]) -> AsyncIterator[bytes]:
+        """Отдает архив по мере сборки, параллельно он пишется в кеш.
+
+        Архив читается из временного файла сборки вслед за записью, поэтому одновременные запросы
+        одной директории отдают одну сборку, а медленный или отключившийся клиент ее не задерживает.
+        """
+        build = self._start(fingerprint, members)
+        chunk_size = settings.CHUNK_SIZE_KB * 1024
+        file: BinaryIO | None = None
+        offset = 0
+        try:
+            while True:
+                progress = build.progress
+                if offset < build.size:
+                    if file is None:
+                        file = await asyncio.to_thread(self._open_build, build)
+                    data = await asyncio.to_thread(file.read, min(chunk_size, build.size - offset))
+                    offset += len(data)
+                    yield data
+                elif build.task.done():
+                    # ошибка сборки обрывает ответ: клиент не должен принять неполный архив за целый
+                    build.task.result()
+                    return
+                else:
+                    await progress.wait()
+        finally:
+            if file is not None:
+                await asyncio.to_thread(file.close)
+
+    def _start(self, fingerprint: str, members: AsyncIterable[ArchiveMember]) -> _Build:
+        if (build := _builds.get(fingerprint)) is None:
+            build = _Build(fingerprint, os.path.join(self.root, TEMP_DIR, uuid.uuid4().hex))
+            build.task = asyncio.ensure_future(self._build(build, members))
+            build.task.add_done_callback(lambda _: self._finish(build))
+            _builds[fingerprint] = build
+        return build
+
+    @staticmethod
+    def _finish(build: _Build) -> None:
+        _builds.pop(build.fingerprint, None)
+        # будим тех, кто читает архив, чтобы они увидели конец сборки
+        build.notify()
+
+    async def _build(self, build: _Build, members: AsyncIterable[ArchiveMember]) -> str:
+        await aio_os.makedirs(os.path.dirname(build.temp_path), exist_ok=True)
+        try:
+            file = await asyncio.to_thread(open, build.temp_path, 'wb', buffering=0)
+            try:
+                archive = stream_zip(
+                    members,
+                    chunk_size=settings.CHUNK_SIZE_KB * 1024,
+                    compresslevel=settings.ARCHIVE_COMPRESS_LEVEL,
+                    workers=settings.ARCHIVE_COMPRESS_WORKERS,
+                )
+                async for data in archive:
+                    await asyncio.to_thread(_write_all, file, data)
+                    build.size += len(data)
+                    build.notify()
+                if settings.FSYNC_POLICY != FsyncPolicy.NONE:
+                    await asyncio.to_thread(os.fsync, file.fileno())
+            finally:
+                await asyncio.to_thread(file.close)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                await aio_os.remove(build.temp_path)
+            raise
+
+        path = self.archive_path(build.fingerprint)
+        await aio_os.replace(build.temp_path, path)
+        await asyncio.to_thread(self._evict)
+        return path
+
+    def _open_build(self, build: _Build) -> BinaryIO:
+        try:
+            return open(build.temp_path, 'rb')
+        except FileNotFoundError:
+            # сборка уже закончилась и перенесла архив в кеш, открытый раньше файл читался бы дальше и так
+            return open(self.archive_path(build.fingerprint), 'rb')
+
+    def _evict(self) -> None:
+        """Удаляет самые давно использованные архивы, пока кеш не уложится в размер."""
+        with os.scandir(self.root) as entries:
+            archives = [(entry.stat(), entry.path) for entry in entries if entry.is_file()]
+        total = sum(stat.st_size for stat, _ in archives)
+        grace = time.time() - EVICTION_GRACE_SECONDS
+        for stat, path in sorted(archives, key=lambda archive: archive[0].st_mtime):
+            if total <= self.max_size or stat.st_mtime > grace:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # уже вытеснил другой процесс
+                pass
+            total -= stat.st_size
+            logger.debug('archive %s evicted from cache', path)
+
+
+def _write_all(file: BinaryIO, data: bytes) -> None:
+    # файл без буфера: все записанное сразу видно тем, кто читает архив вслед за сборкой
+    view = memoryview(data)
+    while view:
+        view = view[file.write(view):]
@@ -1,30 +1,54 @@
-import hashlib
+import asyncio
 import logging
 import os
 import uuid
-import zipfile
+from collections.abc import AsyncIterable, AsyncIterator
+from contextlib import suppress
 from dataclasses import dataclass
 from datetime import datetime
-from io import BytesIO
+from typing import NamedTuple
 
-import aiofiles
 from aiofiles import os as aio_os
-from fastapi import UploadFile
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.exc import IntegrityError
+from starlette.datastructures import Headers
 
+from cache.redis import (Subscription, bump_generation, get_generation,
+                         publish_many, timed_cache)
+from cache.redis_keys import all_keys
 from config import settings
 from crud.directory import DirectoryCrud
 from crud.file import FileCrud
 from crud.revision import RevisionCrud
-from schemas.directory import DirectoryCreate
-from schemas.file import File, FileCreate, ViewFile
+from schemas.directory import Directory
+from schemas.file import File, FileCreate, TailFile, ViewFile, ViewUnit
 from schemas.user import User
-from utils.exc import LargeFileError, NotFoundError, WrongFileFormatError
+from services.archive import (ArchiveFormat, ArchiveMember, format_from_accept,
+                              stream_tar, stream_zip, tar_compressor)
+from services.archive_cache import ArchiveCache
+from services.line_index import LineIndex
+from services.storage import BlobStorage, StreamWriter
+from utils.exc import (ArchiveFormatUnavailableError, FileNameRequiredError,
+                       FileRequiredError, LargeFileError, NotFoundError,
+                       TooManyFilesError, WrongFileFormatError)
 from utils.functools import is_valid_uuid
+from utils.hashing import new_hasher
+from utils.multipart import MultipartReader, Part
+from utils.responses import (FileRangeResponse, http_date, is_not_modified,
+                             make_etag, parse_range, sse_event)
 
 logger = logging.getLogger(__name__)
 
+ARCHIVE_FILENAME = "archive"
+
+
+class StoredFile(NamedTuple):
+    """Содержимое уже в хранилище, осталось зарегистрировать файл в БД."""
+    path: str
+    name: str
+    size: int
+    hash: str
+
 
 @dataclass
 class FileManager:
@@ -36,25 +60,92 @@ class FileManager:
     file_crud: FileCrud = FileCrud()
     revision_crud: RevisionCrud = RevisionCrud()
 
-    async def save_file(self, in_path: str, file: UploadFile) -> File:
-        file_path, file_name = self._get_file_data(in_path, file.filename)
-        full_path = os.path.join(self.base_dir, file_path)
-
-        directory_id = await self._create_dirs(file_path)
-        file_size, file_hash = await self._save_file(file, full_path)
-        file_data = {
-            "name": file_name,
-            "path": full_path,
-            "size": file_size,
-            "created_ad": datetime.now(),
-            "directory_id": directory_id,
-            "user_id": self.user.id,
-        }
-        return await self._create_file(file_data, file_hash)
-
-    async def _create_file(self, file_data: dict, file_hash: str) -> File:
-        file = FileCreate(**file_data)
-        return await self.file_crud.create_or_update(file, file_hash)
+    @property
+    def storage(self) -> BlobStorage:
+        return BlobStorage(self.base_dir)
+
+    async def save_file(self, in_path: str, reader: MultipartReader) -> File:
+        # тело запроса читаем потоком, без промежуточного временного файла starlette
+        async for part in reader:
+            if part.name == 'file' and part.filename is not None:
+                file_path, file_name = self._get_file_data(in_path, part.filename)
+                return (await self._create_files([await self._store_part(file_path, file_name, part)]))[0]
+        raise FileRequiredError
+
+    async def save_files(self, in_path: str, reader: MultipartReader) -> list[File]:
+        """Пакетная загрузка: все файлы запроса регистрируются в БД одной транзакцией.
+
+        Имя файла в части может содержать относительный путь (`docs/a.txt`), он откладывается от `in_path`.
+        """
+        stored: list[StoredFile] = []
+        async for part in reader:
+            if part.name != 'files' or part.filename is None:
+                continue
+            if len(stored) == settings.BATCH_MAX_FILES:
+                raise TooManyFilesError
+            file_path, file_name = self._get_batch_file_data(in_path, part.filename)
+            stored.append(await self._store_part(file_path, file_name, part))
+
+        if not stored:
+            raise FileRequiredError
+        return await self._create_files(stored)
+
+    async def _store_part(self, file_path: str, file_name: str, part: Part) -> StoredFile:
+        temp_path = await self.storage.temp_path()
+        file_size, file_hash = await self._save_stream(part, temp_path)
+        # если такое содержимое уже есть, повторно оно не сохраняется
+        await self.storage.store(temp_path, file_hash)
+        return StoredFile(file_path, file_name, file_size, file_hash)
+
+    async def _create_file(self, file_path: str, file_name: str, file_size: int, file_hash: str) -> File:
+        return (await self._create_files([StoredFile(file_path, file_name, file_size, file_hash)]))[0]
+
+    async def _create_files(self, stored: list[StoredFile]) -> list[File]:
+        try:
+            files = await self._register_files(stored)
+        except IntegrityError:
+            # id директорий закешированы в процессе: директорию могли удалить,
+            # а транзакция, которая ее создала, - откатиться. Перечитываем из БД
+            self.directory_crud.invalidate(self.user.id)
+            files = await self._register_files(stored)
+
+        # закешированные списки, поиски и ревизии пользователя больше не актуальны
+        await bump_generation(self.user.id)
+        # тем, кто следит за файлами (tail с follow), сообщаем о новых ревизиях
+        await publish_many({
+            all_keys.file_updates.substitute(file_id=file.id): file.blob_hash or '' for file in files
+        })
+        return files
+
+    async def _register_files(self, stored: list[StoredFile]) -> list[File]:
+        """Создает директории, файлы и ревизии в одной транзакции."""
+        async with self.file_crud.rw_session() as session:
+            directory_ids = await self.directory_crud.get_or_create_many(
+                self.user.id, [os.path.dirname(file.path) for file in stored], rw_session=session,
+            )
+            files = [
+                FileCreate(
+                    name=file.name,
+                    # путь логический, само содержимое хранится в хранилище блобов по хешу
+                    path=os.path.join(self.base_dir, file.path),
+                    size=file.size,
+                    created_ad=datetime.now(),
+                    directory_id=directory_ids[os.path.dirname(file.path)],
+                    user_id=self.user.id,
+                    blob_hash=file.hash,
+                )
+                for file in stored
+            ]
+            return await self.file_crud.create_or_update_many(  # type: ignore
+                files, settings.FILE_HASH_ALGORITHM, rw_session=session,
+            )
+
+    def _get_batch_file_data(self, in_path: str, file_name: str) -> tuple[str, str]:
+        """Путь для файла пакетной загрузки: `in_path` - директория, имя файла может содержать подкаталоги."""
+        parts = [part for part in file_name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+        if not parts:
+            raise FileNameRequiredError
+        return os.path.join(self.user.username, in_path.strip('/'), *parts), parts[-1]
 
     def _get_file_data(self, in_path: str, file_name: str) -> tuple[str, str]:
         """ Метод для получения пути для сохранения файла и его имени."""
@@ -71,53 +162,25 @@ class FileManager:
         file_name = file_path.split('/')[-1]
         return file_path, file_name
 
-    async def _create_dirs(self, file_path: str) -> uuid.UUID | None:
-        # собираем список директорий включая вложенные
-        dirs = file_path.split('/')[:-1]
-
-        parent_id = None
-        parent_dir_name = ''
-        for directory in dirs:
-            # создаем директорию на диске
-            await self._create_dir_on_disk(directory, parent_dir_name)
-            # создаем директорию в БД (нужно создавать последовательно так как нужен parent_id)
-            directory_model = DirectoryCreate(name=directory, user_id=self.user.id, parent_id=parent_id)
-            try:
-                new_directory = await self.directory_crud.create(directory_model)
-            except IntegrityError:
-                # если директория уже существует, получаем ее
-                new_directory = await self.directory_crud.get_one(name=directory)  # type: ignore
-            # только что созданная становится родительской для следующей
-            parent_id = new_directory.id  # type: ignore
-            parent_dir_name = os.path.join(parent_dir_name, directory)
-
-        return parent_id
-
-    async def _create_dir_on_disk(self, dir_name: str, parent_path: str = '') -> None:
-        """Метод для создания директорий пользователя, если они не существуют."""
-        path = os.path.join(parent_path, dir_name)
-        full_path = os.path.join(self.base_dir, path)
-        await aio_os.makedirs(full_path, exist_ok=True)
-
     @staticmethod
-    async def _save_file(file: UploadFile, path: str) -> tuple[int, str]:
+    async def _save_stream(stream: AsyncIterable[bytes], path: str) -> tuple[int, str]:
         max_file_size = settings.MAX_FILE_SIZE_KB * 1024
-        real_file_size = 0
-        hash_md5 = hashlib.md5()
-
-        async with aiofiles.open(path, 'wb') as out_file:
-            # читаем файл чанками
-            while content := await file.read(1024):
-                # проверяем фактический размер файла
-                real_file_size += len(content)
-                if real_file_size > max_file_size:
-                    # удаляем файл, если превысил допустимый размер
-                    await aio_os.remove(path)
-                    raise LargeFileError
-                await out_file.write(content)
-                hash_md5.update(content)
-
-        return real_file_size, hash_md5.hexdigest()
+
+        try:
+            async with StreamWriter(path, hasher=new_hasher(settings.FILE_HASH_ALGORITHM)) as writer:
+                async for content in stream:
+                    # проверяем фактический размер файла до записи
+                    if writer.size + len(content) > max_file_size:
+                        raise LargeFileError
+                    await writer.write(content)
+        except BaseException:
+            # удаляем недописанный файл, в том числе если превысил допустимый размер
+            # файл мог так и не создаться, тогда поднимаем исходную ошибку, а не FileNotFoundError
+            with suppress(FileNotFoundError):
+                await aio_os.remove(path)
+            raise
+
+        return writer.size, writer.hexdigest()
 
     @staticmethod
     def _is_dir_path(path: str) -> bool:
@@ -141,58 +204,236 @@ class DownloadFileManager:
 
     directory_crud: DirectoryCrud = DirectoryCrud()
     file_crud: FileCrud = FileCrud()
+    revision_crud: RevisionCrud = RevisionCrud()
 
-    async def get_file_or_directory(self, path: str) -> StreamingResponse:
+    @property
+    def storage(self) -> BlobStorage:
+        return BlobStorage(self.base_dir)
+
+    @property
+    def archive_cache(self) -> ArchiveCache:
+        return ArchiveCache(self.base_dir, settings.ARCHIVE_CACHE_SIZE_MB * 1024 * 1024)
+
+    async def get_file_or_directory(
+        self,
+        path: str,
+        headers: Headers,
+        archive_format: ArchiveFormat | None = None,
+        method: str | None = None,
+    ) -> Response:
+        """Отдает файл или директорию архивом.
+
+        Формат архива берется из параметра, если его нет - из заголовка Accept, по умолчанию zip.
+        """
+        archive_format = self._archive_format(headers, archive_format)
         if is_valid_uuid(path):
             # если передан идентификатор
-            file_list = await self._get_file_list_by_id(path)
+            target = await self._find_by_id(path)
         else:
             # если передан путь
-            file_list = await self._get_file_list_by_path(path)
+            target = await self._find_by_path(path)
+
+        if isinstance(target, File):
+            return self._archive_files(target, archive_format)
+        if archive_format == ArchiveFormat.zip:
+            return await self._zip_directory(target, headers, method)
+        # tar собирается почти без затрат CPU, его не кешируем
+        return self._archive_files(self._get_file_list_for_directory(target), archive_format)
+
+    async def get_selection(
+        self,
+        items: list[str],
+        headers: Headers,
+        archive_format: ArchiveFormat | None = None,
+    ) -> Response:
+        """Отдает несколько файлов и директорий (пути или идентификаторы) одним архивом.
+
+        Выбранное ищется одним запросом по файлам и одним по директориям, содержимое читается
+        одним постраничным запросом: файл, выбранный и сам, и через директорию, попадет в архив один раз.
+        Все файлы лежат в архиве по полным путям, как при скачивании директории.
+        """
+        archive_format = self._archive_format(headers, archive_format)
+        ids = [uuid.UUID(item) for item in items if is_valid_uuid(item)]
+        paths = [item for item in items if not is_valid_uuid(item)]
+        files = await self.file_crud.get_many(self.user.id, ids, paths)
+        directories = await self.directory_crud.get_many(self.user.id, ids, [self._directory_path(path) for path in paths])
+
+        found: set[uuid.UUID] = {file.id for file in files} | {directory.id for directory in directories}
+        found_paths = {file.path for file in files} | {directory.path for directory in directories}
+        for item in items:
+            if is_valid_uuid(item):
+                if uuid.UUID(item) not in found:
+                    raise NotFoundError(error_message=item)
+            elif item not in found_paths and self._directory_path(item) not in found_paths:
+                raise NotFoundError(error_message=item)
+
+        file_list = self.file_crud.get_selection(
+            self.user.id,
+            [directory.path for directory in directories],
+            [file.id for file in files],  # type: ignore
+            settings.ARCHIVE_LIST_PAGE_SIZE,
+        )
+        return self._archive_files(file_list, archive_format)
+
+    async def get_raw_file(self, id: uuid.UUID, headers: Headers, method: str | None = None) -> Response:
+        """Отдает сам файл без архивации, с поддержкой Range и условных запросов."""
+        file = await self.file_crud.get_one(id=id, user_id=self.user.id)
+        if not file:
+            raise NotFoundError
+
+        # ETag - хеш последней ревизии, поэтому на 304 ответ диск не нужен
+        revision = await self.revision_crud.get_latest(file.id)  # type: ignore
+        etag = make_etag(revision.hash) if revision else None  # type: ignore
+        last_modified = revision.modified_at if revision else file.created_ad  # type: ignore
+        validators = {"last-modified": http_date(last_modified)}
+        if etag:
+            validators["etag"] = etag
+
+        if is_not_modified(headers, etag, last_modified):
+            return Response(status_code=304, headers=validators)
+
+        return FileRangeResponse(
+            self.storage.file_path(file),  # type: ignore
+            size=file.size,  # type: ignore
+            byte_range=parse_range(headers, file.size, etag),  # type: ignore
+            headers=validators,
+            filename=file.name,  # type: ignore
+            # на HEAD запрос отдаются только заголовки
+            method=method,
+        )
 
-        return self._zip_files(file_list)
+    async def get_file_content(
+        self,
+        id: uuid.UUID,
+        offset: int = 0,
+        limit: int | None = None,
+        unit: ViewUnit = ViewUnit.lines,
+    ) -> ViewFile:
+        """Страница содержимого текстового файла, по строкам или по байтам.
+
+        Страница не больше VIEW_MAX_PAGE_KB, с диска читается только она, а не весь файл.
+        """
+        file = await self._get_file(id)
+        max_bytes = settings.VIEW_MAX_PAGE_KB * 1024
+        index = self._line_index(file)  # type: ignore
+        try:
+            # пытаемся прочитать страницу файла с диска
+            if unit == ViewUnit.bytes:
+                page = await asyncio.to_thread(index.read_bytes, offset, min(limit or max_bytes, max_bytes))
+            else:
+                page = await asyncio.to_thread(index.read_lines, offset, limit or settings.VIEW_PAGE_LINES, max_bytes)
+        except UnicodeDecodeError:
+            # если это бинарный файл, просмотр недоступен
+            raise WrongFileFormatError
+        return ViewFile(
+            id=file.id,  # type: ignore
+            content=page.content,
+            offset=offset,
+            next_offset=page.next_offset,
+            size=file.size,  # type: ignore
+            lines=page.lines,
+        )
 
-    async def get_file_content(self, id: uuid.UUID) -> ViewFile:
-        # получаем файл из БД
-        if file := await self.file_crud.get_one(id=id, user_id=self.user.id):
+    async def tail_file(self, id: uuid.UUID, lines: int | None = None) -> TailFile:
+        """Последние строки текстового файла, файл читается с конца."""
+        file = await self._get_file(id)
+        return await self._tail(file, lines or settings.TAIL_LINES)
+
+    async def follow_file(self, id: uuid.UUID, lines: int | None = None) -> StreamingResponse:
+        """Последние строки файла, а затем то, что дописано в его новых ревизиях (server-sent events).
+
+        События: `tail` - хвост файла (в начале и если файл переписан), `append` - дописанное в конец,
+        `deleted` - файл удален. Без изменений раз в TAIL_FOLLOW_INTERVAL_SECONDS приходит keepalive.
+        """
+        file = await self.file_crud.get_one(id=id, user_id=self.user.id)
+        if not file:
+            raise NotFoundError
+        return StreamingResponse(
+            self._follow(file, lines or settings.TAIL_LINES),  # type: ignore
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    async def _tail(self, file: File, lines: int) -> TailFile:
+        try:
+            offset, content = await asyncio.to_thread(
+                self._line_index(file).read_tail, lines, settings.VIEW_MAX_PAGE_KB * 1024,
+            )
+        except UnicodeDecodeError:
+            # если это бинарный файл, просмотр недоступен
+            raise WrongFileFormatError
+        return TailFile(id=file.id, content=content, offset=offset, size=file.size)
+
+    async def _follow(self, file: File, lines: int) -> AsyncIterator[str]:
+        yield sse_event('tail', await self._tail(file, lines))
+        # о новых ревизиях сообщают через redis, но файл перепроверяется и без сообщений:
+        # сообщение могло потеряться, а redis - быть недоступен
+        async with Subscription(all_keys.file_updates.substitute(file_id=file.id)) as updates:
+            while True:
+                await updates.wait(settings.TAIL_FOLLOW_INTERVAL_SECONDS)
+                current = await self.file_crud.get_one(id=file.id, user_id=self.user.id)
+                if not current:
+                    yield sse_event('deleted')
+                    return
+                if (current.blob_hash, current.size) == (file.blob_hash, file.size):  # type: ignore
+                    yield ': keepalive\n\n'
+                    continue
+
+                try:
+                    event, page = await self._follow_update(file, current)  # type: ignore
+                except WrongFileFormatError:
+                    yield sse_event('error')
+                    return
+                file = current  # type: ignore
+                yield sse_event(event, page)
+
+    async def _follow_update(self, previous: File, current: File) -> tuple[str, TailFile]:
+        """Что отправить следящему за файлом: дописанное в конец или, если файл переписан, его хвост."""
+        index = self._line_index(current)
+        appended = current.size - previous.size
+        if 0 < appended <= settings.VIEW_MAX_PAGE_KB * 1024 and await asyncio.to_thread(
+            index.is_appended, self.storage.file_path(previous), previous.size,
+        ):
             try:
-                # пытаемся прочитать файл с диска
-                content = await self._get_content(file)  # type: ignore
+                page = await asyncio.to_thread(index.read_bytes, previous.size, appended)
             except UnicodeDecodeError:
-                # если это бинарный файл, просмотр недоступен
                 raise WrongFileFormatError
-            return ViewFile(id=file.id, content=content)  # type: ignore
-        raise NotFoundError
+            return 'append', TailFile(id=current.id, content=page.content, offset=previous.size, size=current.size)
+        return 'tail', await self._tail(current, settings.TAIL_LINES)
+
+    def _line_index(self, file: File) -> LineIndex:
+        return LineIndex(self.storage.file_path(file), self.storage.line_index_path(file))
+
+    def _get_file_list_for_directory(self, directory: Directory) -> AsyncIterator[File]:
+        """Все файлы начиная с переданной директории, читаются из БД по мере формирования архива."""
+        return self.file_crud.get_under_directory(self.user.id, directory.path, settings.ARCHIVE_LIST_PAGE_SIZE)
+
+    async def _get_file(self, id: uuid.UUID) -> File:
+        """Файл пользователя из кеша или БД. "Не найдено" тоже кешируется: несуществующие файлы часто опрашивают."""
+        cache_key = all_keys.file.substitute(
+            user_id=self.user.id,
+            generation=await get_generation(self.user.id),
+            file_id=id,
+        )
+
+        @timed_cache(
+            cache_key=cache_key,
+            time=settings.CACHE_TTL_SECONDS,
+            schema=File | None,
+            negative_time=settings.CACHE_NEGATIVE_TTL_SECONDS,
+        )
+        async def cached():
+            return await self.file_crud.get_one(id=id, user_id=self.user.id)
 
-    async def _get_file_list_for_directory(self, name: str, parent_id: uuid.UUID) -> list[str]:
-        """Метод собирает абсолютные пути до всех файлов начиная с переданной директории."""
-        dirs_list = await self._get_path_to_dir(name, parent_id)
-        dirs_list.reverse()
-        path = '/'.join(dirs_list)
-
-        path = os.path.join(self.base_dir, path)
-        file_list = []
-        for root, _, files in os.walk(path):
-            # если в каталоге есть файлы
-            if files:
-                for file in files:
-                    file_list.append(os.path.join(root, file))
-        return file_list
-
-    async def _get_path_to_dir(self, dir_name: str, parent_id: uuid.UUID) -> list[str]:
-        """Рекурсивно собираем названия всех директорий от корня до нужной."""
-        if not parent_id:
-            # базовый случай, директория корневая
-            return [dir_name]
-
-        parent = await self.directory_crud.get_one(id=parent_id)
-        # уходим в рекурсию
-        return [dir_name] + await self._get_path_to_dir(parent.name, parent.parent_id)  # type: ignore
-
-    async def _get_file_list_by_id(self, id: str) -> list[str] | File:
+        file: File | None = await cached()
+        if not file:
+            raise NotFoundError
+        return file
+
+    async def _find_by_id(self, id: str) -> Directory | File:
         # пробуем найти директорию
         if directory := await self.directory_crud.get_one(id=id, user_id=self.user.id):
-            return await self._get_file_list_for_directory(directory.name, directory.parent_id)  # type: ignore
+            return directory  # type: ignore
 
         # пробуем найти файл
         if file := await self.file_crud.get_one(id=id, user_id=self.user.id):
@@ -200,40 +441,113 @@ class DownloadFileManager:
 
         raise NotFoundError
 
-    async def _get_file_list_by_path(self, path: str) -> list[str] | File:
+    async def _find_by_path(self, path: str) -> Directory | File:
         # пробуем найти файл с переданным путем
         if file := await self.file_crud.get_one(path=path, user_id=self.user.id):
             return file  # type: ignore
 
-        if path.endswith('/'):
-            path = path[:-1]
-        # пробуем найти директорию соответсвующую переданному пути
-        dir_name = path.split('/')[-1]
-        if directory := await self.directory_crud.get_one(name=dir_name, user_id=self.user.id):
-            return await self._get_file_list_for_directory(directory.name, directory.parent_id)  # type: ignore
+        if directory := await self.directory_crud.get_by_path(self.user.id, self._directory_path(path)):
+            return directory
 
         raise NotFoundError
 
-    @staticmethod
-    async def _get_content(file: File) -> str:
-        path = file.path
-        async with aiofiles.open(path, 'r') as f:
-            return await f.read()
+    def _directory_path(self, path: str) -> str:
+        """Путь директории передается так же, как у файлов - от base_dir, в БД он хранится без base_dir."""
+        if path.startswith(self.base_dir):
+            path = path[len(self.base_dir):]
+        return path.strip('/')
 
     @staticmethod
-    def _zip_files(file_list: list[str] | File) -> StreamingResponse:
-        io = BytesIO()
-        zip_filename = "archive.zip"
-
-        with zipfile.ZipFile(io, mode='w', compression=zipfile.ZIP_DEFLATED) as zip:
-            if isinstance(file_list, File):
-                zip.write(file_list.path, arcname=file_list.name)
-            else:
-                for fpath in file_list:
-                    zip.write(fpath)
+    def _archive_format(headers: Headers, archive_format: ArchiveFormat | None) -> ArchiveFormat:
+        archive_format = archive_format or format_from_accept(headers.get('accept')) or ArchiveFormat.zip
+        if not archive_format.is_available:
+            raise ArchiveFormatUnavailableError
+        return archive_format
+
+    def _archive_member(self, file: File, arcname: str) -> ArchiveMember:
+        # время модификации берем из БД, на диске открывается только само содержимое
+        return ArchiveMember(path=self.storage.file_path(file), arcname=arcname, mtime=file.created_ad.timestamp())
+
+    def _archive_files(
+        self,
+        file_list: AsyncIterator[File] | File,
+        archive_format: ArchiveFormat = ArchiveFormat.zip,
+    ) -> StreamingResponse:
+        if isinstance(file_list, File):
+            members: list[ArchiveMember] | AsyncIterator[ArchiveMember] = [self._archive_member(file_list, file_list.name)]
+        else:
+            members = self._archive_members(file_list)
 
         return StreamingResponse(
-            iter([io.getvalue()]),
-            media_type="application/x-zip-compressed",
-            headers={"Content-Disposition": f"attachment;filename={zip_filename}"}
+            self._stream_archive(members, archive_format),
+            media_type=archive_format.media_type,
+            # формат архива мог быть выбран по заголовку Accept
+            headers={"Content-Disposition": self._content_disposition(archive_format), "Vary": "Accept"},
+        )
+
+    @staticmethod
+    def _stream_archive(
+        members: list[ArchiveMember] | AsyncIterator[ArchiveMember],
+        archive_format: ArchiveFormat,
+    ) -> AsyncIterator[bytes]:
+        chunk_size = settings.CHUNK_SIZE_KB * 1024
+        if archive_format == ArchiveFormat.zip:
+            return stream_zip(
+                members,
+                chunk_size=chunk_size,
+                compresslevel=settings.ARCHIVE_COMPRESS_LEVEL,
+                workers=settings.ARCHIVE_COMPRESS_WORKERS,
+            )
+        compressor = tar_compressor(
+            archive_format,
+            compresslevel=settings.ARCHIVE_COMPRESS_LEVEL,
+            zstd_level=settings.ARCHIVE_ZSTD_LEVEL,
+            workers=settings.ARCHIVE_COMPRESS_WORKERS,
         )
+        return stream_tar(members, chunk_size=chunk_size, compressor=compressor)
+
+    @staticmethod
+    def _content_disposition(archive_format: ArchiveFormat) -> str:
+        return f"attachment;filename={ARCHIVE_FILENAME}.{archive_format.value}"
+
+    async def _zip_directory(self, directory: Directory, headers: Headers, method: str | None = None) -> Response:
+        """Архив директории берется из кеша, если содержимое директории с прошлой сборки не менялось."""
+        cache = self.archive_cache
+        if not cache.max_size:
+            return self._archive_files(self._get_file_list_for_directory(directory))
+
+        fingerprint, size = await self.file_crud.get_directory_fingerprint(self.user.id, directory.path)
+        if not fingerprint or size > settings.ARCHIVE_CACHE_MAX_ARCHIVE_MB * 1024 * 1024:
+            # пустые и слишком большие директории не кешируем
+            return self._archive_files(self._get_file_list_for_directory(directory))
+
+        # с другим уровнем сжатия получится другой архив, у него должен быть другой ETag
+        fingerprint = f'{fingerprint}-{settings.ARCHIVE_COMPRESS_LEVEL}'
+        etag = make_etag(fingerprint)
+        if is_not_modified(headers, etag, None):
+            return Response(status_code=304, headers={"etag": etag, "Vary": "Accept"})
+
+        response_headers = {"etag": etag, "Content-Disposition": self._content_disposition(ArchiveFormat.zip), "Vary": "Accept"}
+        path = await cache.get(fingerprint)
+        if path is None and method == 'HEAD':
+            # размер архива станет известен только после сборки, зато следующий GET отдаст его из кеша
+            path = await cache.build(fingerprint, self._archive_members(self._get_file_list_for_directory(directory)))
+        if path is None:
+            # архива в кеше нет: отдаем его по мере сборки, Range поддерживается, когда архив уже в кеше
+            members = self._archive_members(self._get_file_list_for_directory(directory))
+            return StreamingResponse(
+                cache.stream(fingerprint, members), media_type=ArchiveFormat.zip.media_type, headers=response_headers,
+            )
+        archive_size = (await aio_os.stat(path)).st_size
+        return FileRangeResponse(
+            path,
+            size=archive_size,
+            byte_range=parse_range(headers, archive_size, etag),
+            media_type=ArchiveFormat.zip.media_type,
+            headers=response_headers,
+            method=method,
+        )
+
+    async def _archive_members(self, files: AsyncIterator[File]) -> AsyncIterator[ArchiveMember]:
+        async for file in files:
+            yield self._archive_member(file, file.path)
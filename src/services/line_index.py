@@ -0,0 +1,179 @@
+"""Постраничное чтение текстовых файлов.
+
+Чтобы страница из середины большого файла читалась без просмотра всего, что до нее,
+для содержимого один раз строится индекс: смещение начала каждой LINE_INDEX_STRIDE-й строки.
+Содержимое блоба не меняется, поэтому индекс строится один раз на ревизию и лежит рядом с блобом.
+Файл и индекс читаются через mmap, страница стоит O(размер страницы).
+"""
+import codecs
+import mmap
+import os
+import struct
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import NamedTuple
+
+# в индекс попадает каждая LINE_INDEX_STRIDE-я строка: индекс во столько же раз меньше,
+# а от ближайшей точки индекса до нужной строки остается не больше LINE_INDEX_STRIDE - 1 строк
+LINE_INDEX_STRIDE = 64
+# размер файла, количество строк
+INDEX_HEADER = struct.Struct('<QQ')
+INDEX_OFFSET = struct.Struct('<Q')
+# в utf-8 символ занимает до 4 байт
+MAX_CHAR_SIZE = 4
+# сколько байт перед концом старого содержимого сравнивается, чтобы понять, что файл дописан, а не переписан
+APPEND_CHECK_SIZE = 4 * 1024
+
+
+class TextPage(NamedTuple):
+    content: str
+    # смещение следующей страницы, None - файл прочитан до конца
+    next_offset: int | None
+    # количество строк в файле, известно при чтении по строкам
+    lines: int | None = None
+
+
+@dataclass
+class LineIndex:
+    path: str
+    index_path: str
+
+    def build(self) -> None:
+        """Строит индекс, если его еще нет. Индекс пишется во временный файл и переносится на место атомарно."""
+        if os.path.exists(self.index_path):
+            return
+
+        size, offsets = 0, [0]
+        lines = 0
+        with self._mmap(self.path) as data:
+            if data is not None:
+                size = len(data)
+                position = data.find(b'\n')
+                while position != -1:
+                    lines += 1
+                    if lines % LINE_INDEX_STRIDE == 0:
+                        offsets.append(position + 1)
+                    position = data.find(b'\n', position + 1)
+                # последняя строка без перевода строки тоже строка
+                if size and data[size - 1:] != b'\n':
+                    lines += 1
+
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = f'{self.index_path}.{uuid.uuid4().hex}'
+        with open(temp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(size, lines))
+            f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+        os.replace(temp_path, self.index_path)
+
+    def read_lines(self, offset: int, limit: int, max_bytes: int) -> TextPage:
+        """Строки [offset, offset + limit), но не больше max_bytes байт. Индекс строится при первом чтении."""
+        self.build()
+        with self._mmap(self.index_path) as index, self._mmap(self.path) as data:
+            _, lines = INDEX_HEADER.unpack_from(index)  # type: ignore
+            if data is None or offset >= lines:
+                return TextPage('', None, lines)
+
+            checkpoint = offset // LINE_INDEX_STRIDE
+            start = INDEX_OFFSET.unpack_from(index, INDEX_HEADER.size + checkpoint * INDEX_OFFSET.size)[0]  # type: ignore
+            for _ in range(offset - checkpoint * LINE_INDEX_STRIDE):
+                start = data.find(b'\n', start) + 1
+
+            end, read = start, 0
+            while read < limit and end < len(data):
+                # перевод строки ищем только в пределах страницы, длинная строка не читается целиком
+                page_end = min(start + max_bytes, len(data))
+                position = data.find(b'\n', end, page_end)
+                if position != -1:
+                    end = position + 1
+                elif page_end == len(data):
+                    end = page_end
+                elif read:
+                    break
+                else:
+                    # строка длиннее страницы - отдаем ее начало, целиком ее можно прочитать по байтам
+                    content = _decode(data[start:page_end], final=False)[0]
+                    return TextPage(content, offset + 1 if offset + 1 < lines else None, lines)
+                read += 1
+
+            next_offset = offset + read if offset + read < lines else None
+            return TextPage(_decode(data[start:end], final=True)[0], next_offset, lines)
+
+    def read_bytes(self, offset: int, limit: int) -> TextPage:
+        """Байты [offset, offset + limit), границы сдвигаются так, чтобы не резать символы."""
+        with self._mmap(self.path) as data:
+            if data is None or offset >= len(data):
+                return TextPage('', None)
+
+            # начало страницы попало в середину символа - пропускаем его хвост
+            start = offset
+            while start < min(offset + MAX_CHAR_SIZE - 1, len(data)) and _is_continuation(data[start]):
+                start += 1
+            end = min(offset + max(limit, MAX_CHAR_SIZE), len(data))
+            content, consumed = _decode(data[start:end], final=end == len(data))
+            end = start + consumed
+            return TextPage(content, end if end < len(data) else None)
+
+    def read_tail(self, lines: int, max_bytes: int) -> tuple[int, str]:
+        """Последние lines строк, но не больше max_bytes байт. Файл читается с конца, индекс не нужен.
+
+        Returns:
+            tuple[int, str]: смещение начала в байтах и текст
+        """
+        with self._mmap(self.path) as data:
+            if data is None:
+                return 0, ''
+
+            size = len(data)
+            stop = max(size - max_bytes, 0)
+            # перевод строки в конце файла не начинает новую строку
+            position = size - 1 if data[size - 1] == ord('\n') else size
+            start = stop
+            for _ in range(lines):
+                position = data.rfind(b'\n', stop, position)
+                if position == -1:
+                    break
+                start = position + 1
+
+            # если строки не влезли в max_bytes, начало может попасть в середину символа
+            while start < min(stop + MAX_CHAR_SIZE - 1, size) and _is_continuation(data[start]):
+                start += 1
+            return start, _decode(data[start:], final=True)[0]
+
+    def is_appended(self, previous_path: str, previous_size: int) -> bool:
+        """Похоже ли содержимое на previous_path, дописанное в конец: хвосты старого содержимого совпадают."""
+        start = max(previous_size - APPEND_CHECK_SIZE, 0)
+        with open(self.path, 'rb') as current, open(previous_path, 'rb') as previous:
+            if os.fstat(current.fileno()).st_size < previous_size:
+                return False
+            current.seek(start)
+            previous.seek(start)
+            return current.read(previous_size - start) == previous.read(previous_size - start)
+
+    @staticmethod
+    @contextmanager
+    def _mmap(path: str) -> Iterator[mmap.mmap | None]:
+        """Файл через mmap только для чтения, пустой файл отобразить нельзя - для него None."""
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                yield None
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+
+def _is_continuation(byte: int) -> bool:
+    return byte & 0xC0 == 0x80
+
+
+def _decode(data: bytes, final: bool) -> tuple[str, int]:
+    """Декодирует utf-8, недописанный символ в конце (если final=False) не считается ошибкой.
+
+    Returns:
+        tuple[str, int]: текст и количество байт, которые в него вошли
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    content = decoder.decode(data, final=final)
+    pending, _ = decoder.getstate()
+    return content, len(data) - len(pending)
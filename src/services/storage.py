@@ -0,0 +1,187 @@
+"""Контентно-адресуемое хранилище блобов.
+
+Содержимое файлов хранится один раз на каждый уникальный хеш, независимо от того,
+сколько файлов (у скольких пользователей) на него ссылается. `File.path` остается
+логическим путем, а физическое расположение вычисляется по `File.blob_hash`.
+"""
+import asyncio
+import filecmp
+import os
+import uuid
+from dataclasses import dataclass
+from typing import BinaryIO
+
+from aiofiles import os as aio_os
+
+from config import FsyncPolicy, settings
+from schemas.file import File
+from utils.exc import BlobCollisionError
+from utils.hashing import Hasher
+
+BLOBS_DIR = 'blobs'
+TEMP_DIR = 'tmp'
+LINE_INDEX_DIR = 'lines'
+LINE_INDEX_SUFFIX = '.lines'
+
+
+@dataclass
+class BlobStorage:
+    base_dir: str
+
+    @property
+    def root(self) -> str:
+        return os.path.join(self.base_dir, BLOBS_DIR)
+
+    def blob_path(self, blob_hash: str) -> str:
+        """Путь до блоба, раскладываем по двум уровням каталогов, чтобы в одном каталоге не было миллионов файлов."""
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    def file_path(self, file: File) -> str:
+        """Физический путь до содержимого файла, у файлов загруженных до хранилища блобов это `File.path`."""
+        if file.blob_hash:
+            return self.blob_path(file.blob_hash)
+        return file.path
+
+    def line_index_path(self, file: File) -> str:
+        """Путь до индекса строк содержимого файла: у блоба - рядом с ним, у старых файлов - по id файла."""
+        if file.blob_hash:
+            return self.blob_path(file.blob_hash) + LINE_INDEX_SUFFIX
+        return os.path.join(self.root, LINE_INDEX_DIR, f'{file.id}{LINE_INDEX_SUFFIX}')
+
+    async def temp_path(self, name: str | None = None) -> str:
+        """Путь для записи нового содержимого, пока его хеш еще неизвестен.
+
+        Лежит на той же файловой системе, что и блобы, поэтому перенос на место - это rename без копирования.
+        """
+        temp_dir = os.path.join(self.root, TEMP_DIR)
+        await aio_os.makedirs(temp_dir, exist_ok=True)
+        return os.path.join(temp_dir, name or uuid.uuid4().hex)
+
+    async def store(self, temp_path: str, blob_hash: str) -> bool:
+        """Переносит записанное содержимое в хранилище.
+
+        Блоб с тем же хешем общий для всех пользователей, поэтому перед тем, как выбросить новое содержимое,
+        оно побайтно сравнивается с сохраненным: иначе подобранная коллизия хеша подменила бы чужой файл.
+
+        Returns:
+            bool: False если такое содержимое уже было в хранилище и повторно не сохранялось
+        """
+        path = self.blob_path(blob_hash)
+        if await aio_os.path.exists(path):
+            same = await asyncio.to_thread(filecmp.cmp, temp_path, path, shallow=False)
+            await aio_os.remove(temp_path)
+            if not same:
+                raise BlobCollisionError(error_message=blob_hash)
+            return False
+
+        blob_dir = os.path.dirname(path)
+        dir_created = not await aio_os.path.exists(blob_dir)
+        await aio_os.makedirs(blob_dir, exist_ok=True)
+        # rename атомарный: читатели видят либо старое состояние, либо полностью записанный блоб
+        await aio_os.replace(temp_path, path)
+
+        if settings.FSYNC_POLICY == FsyncPolicy.FILE_DIR:
+            # чтобы rename пережил сбой, сбрасываем на диск каталог блоба,
+            # а если каталоги только что созданы - и их родителей
+            dirs = [blob_dir]
+            if dir_created:
+                dirs += [os.path.dirname(blob_dir), self.root]
+            await asyncio.to_thread(_fsync_dirs, dirs)
+        return True
+
+
+def _fsync_dirs(paths: list[str]) -> None:
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class StreamWriter:
+    """Пишет поток байт в файл крупными блоками.
+
+    Запросы приходят мелкими чанками, поэтому данные копятся в буфере. Заполненный буфер
+    хешируется и пишется на диск одним вызовом в пуле потоков, а event loop тем временем
+    принимает следующий блок: хеширование больших файлов не блокирует остальные запросы.
+
+    Examples:
+
+        async with StreamWriter(path, hasher=new_hasher('sha256')) as writer:
+            async for chunk in stream:
+                await writer.write(chunk)
+        writer.hexdigest()
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str = 'wb',
+        offset: int = 0,
+        hasher: Hasher | None = None,
+        buffer_size: int | None = None,
+    ):
+        self.path = path
+        self.size = 0
+        self.hasher = hasher
+        self._mode = mode
+        self._offset = offset
+        self._file: BinaryIO | None = None
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size or settings.UPLOAD_BUFFER_SIZE_KB * 1024
+        self._pending: asyncio.Future | None = None
+
+    async def __aenter__(self) -> 'StreamWriter':
+        self._file = await asyncio.to_thread(self._open)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None:
+                await self.flush()
+                await self._wait_pending()
+                if settings.FSYNC_POLICY != FsyncPolicy.NONE:
+                    await asyncio.to_thread(self._sync)
+            elif self._pending is not None:
+                # файл закрываем только после записи блока, исходную ошибку не подменяем
+                await asyncio.wait([self._pending])
+        finally:
+            await asyncio.to_thread(self._file.close)  # type: ignore
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        # одновременно в пуле не больше одного блока, порядок записи и хеширования сохраняется
+        await self._wait_pending()
+        if self._buffer:
+            block, self._buffer = self._buffer, bytearray()
+            self._pending = asyncio.ensure_future(asyncio.to_thread(self._write_block, block))
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()  # type: ignore
+
+    async def _wait_pending(self) -> None:
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            await pending
+
+    def _open(self) -> BinaryIO:
+        file = open(self.path, self._mode)
+        if self._offset:
+            file.seek(self._offset)
+        return file  # type: ignore
+
+    def _sync(self) -> None:
+        self._file.flush()  # type: ignore
+        os.fsync(self._file.fileno())  # type: ignore
+
+    def _write_block(self, block: bytearray) -> None:
+        # hashlib отпускает GIL на больших блоках, так что хеширование идет параллельно с event loop
+        if self.hasher is not None:
+            self.hasher.update(block)
+        self._file.write(block)  # type: ignore
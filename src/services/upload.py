@@ -0,0 +1,134 @@
+"""Загрузка файла по частям.
+
+Клиент создает сессию загрузки, отправляет чанки в любом порядке (в том числе параллельно),
+при обрыве связи узнает, какие чанки уже получены, и догружает только недостающие.
+Файл регистрируется в БД один раз - при подтверждении загрузки.
+"""
+import asyncio
+import uuid
+from collections.abc import AsyncIterator
+from contextlib import suppress
+from dataclasses import dataclass
+
+import aiofiles
+from aiofiles import os as aio_os
+
+from config import settings
+from crud.upload import UploadSessionCrud
+from schemas.file import File
+from schemas.upload import (UploadSession, UploadSessionCreate,
+                            UploadSessionStatus)
+from services.file import FileManager
+from services.storage import StreamWriter
+from utils.exc import (FileNameRequiredError, LargeFileError, NotFoundError,
+                       UploadNotCompleteError, WrongChunkError)
+from utils.hashing import file_digest
+
+# суффикс собранного файла, загрузка которого подтверждается
+COMMIT_SUFFIX = '.commit'
+
+
+@dataclass
+class UploadSessionManager(FileManager):
+    """Менеджер загрузки файлов по частям."""
+    upload_crud: UploadSessionCrud = UploadSessionCrud()
+
+    async def create_session(self, in_path: str, size: int, name: str | None = None) -> UploadSessionStatus:
+        if size > settings.MAX_FILE_SIZE_KB * 1024:
+            raise LargeFileError
+        if not name and self._is_dir_path(in_path.lstrip('/')):
+            raise FileNameRequiredError
+
+        file_path, file_name = self._get_file_data(in_path, name or '')
+        session = await self.upload_crud.create(UploadSessionCreate(
+            path=file_path,
+            name=file_name,
+            size=size,
+            chunk_size=settings.UPLOAD_CHUNK_SIZE_KB * 1024,
+            user_id=self.user.id,
+        ))
+        # место под файл выделяем сразу, каждый чанк пишется по своему смещению
+        async with aiofiles.open(await self._staging_path(session), 'wb') as f:  # type: ignore
+            await f.truncate(size)
+        return self._status(session, [])  # type: ignore
+
+    async def get_status(self, session_id: uuid.UUID) -> UploadSessionStatus:
+        session = await self._get_session(session_id)
+        return self._status(session, await self.upload_crud.get_chunks(session.id))
+
+    async def save_chunk(self, session_id: uuid.UUID, index: int, stream: AsyncIterator[bytes]) -> None:
+        session = await self._get_session(session_id)
+        if not 0 <= index < session.chunks:
+            raise WrongChunkError
+
+        offset, size = session.chunk_range(index)
+        try:
+            async with StreamWriter(await self._staging_path(session), 'r+b', offset) as writer:
+                async for content in stream:
+                    if writer.size + len(content) > size:
+                        raise WrongChunkError
+                    await writer.write(content)
+            if writer.size != size:
+                raise WrongChunkError
+        except FileNotFoundError:
+            # загрузка уже завершена
+            raise NotFoundError
+        except BaseException:
+            # чанк пишется на место: если он был получен раньше, его байты уже испорчены, и его нужно загрузить заново
+            await self.upload_crud.remove_chunk(session.id, index)
+            raise
+
+        await self.upload_crud.add_chunk(session.id, index)
+
+    async def commit(self, session_id: uuid.UUID) -> File:
+        session = await self._get_session(session_id)
+        received = await self.upload_crud.get_chunks(session.id)
+        if len(received) != session.chunks:
+            raise UploadNotCompleteError
+
+        staging_path = await self._staging_path(session)
+        # собранный файл переименовывается: повторно загружаемые чанки его больше не найдут и не перепишут
+        commit_path = staging_path + COMMIT_SUFFIX
+        with suppress(FileNotFoundError):
+            # если его нет - он уже переименован прошлым подтверждением, которое не зарегистрировало файл в БД
+            await aio_os.replace(staging_path, commit_path)
+        temp_path = await self.storage.temp_path()
+        try:
+            # хеш считается на месте в пуле потоков, чтобы не блокировать event loop
+            file_hash = await asyncio.to_thread(
+                file_digest, commit_path, settings.FILE_HASH_ALGORITHM, settings.CHUNK_SIZE_KB * 1024,
+            )
+            # в хранилище уходит жесткая ссылка, без копирования: собранный файл остается,
+            # пока файл не зарегистрирован в БД, и повторное подтверждение загрузки его найдет
+            await aio_os.link(commit_path, temp_path)
+        except FileNotFoundError:
+            # загрузку уже подтвердил параллельный запрос
+            raise NotFoundError
+        await self.storage.store(temp_path, file_hash)
+
+        file = await self._create_file(session.path, session.name, session.size, file_hash)
+        await self.upload_crud.delete(session.id)
+        with suppress(FileNotFoundError):
+            await aio_os.remove(commit_path)
+        return file
+
+    async def _get_session(self, session_id: uuid.UUID) -> UploadSession:
+        if session := await self.upload_crud.get_one(id=session_id, user_id=self.user.id):
+            return session  # type: ignore
+        raise NotFoundError
+
+    async def _staging_path(self, session: UploadSession) -> str:
+        return await self.storage.temp_path(f'upload-{session.id}')
+
+    @staticmethod
+    def _status(session: UploadSession, received: list[int]) -> UploadSessionStatus:
+        return UploadSessionStatus(
+            id=session.id,
+            path=session.path,
+            name=session.name,
+            size=session.size,
+            chunk_size=session.chunk_size,
+            chunks=session.chunks,
+            received=received,
+            created_ad=session.created_ad,
+        )
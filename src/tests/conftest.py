@@ -12,8 +12,10 @@ from sqlalchemy.ext.asyncio import AsyncEngine
 from cache.redis import redis_cache
 from config import settings
 from crud.abc.postgres import Postgres
+from crud.directory import DirectoryCrud
 from db.base import meta as metadata
 from db.db import pool_kwargs
+from db.models.blob import Blob
 from db.models.directory import Directory
 from db.models.user import User
 from db.sqlalchemy.asyncpg import get_async_engine, make_sessionmaker, session
@@ -104,7 +106,13 @@ def token2():
 def make_static_dir():
     static_dir = 'tmp/'
     os.makedirs(static_dir, exist_ok=True)
-    yield static_dir
+    # содержимое файлов лежит в хранилище блобов внутри static_dir, поэтому подменяем его для всех менеджеров
+    with patch(
+            "services.file.FileManager.base_dir", new_callable=PropertyMock, return_value=static_dir
+    ), patch(
+            "services.file.DownloadFileManager.base_dir", new_callable=PropertyMock, return_value=static_dir
+    ):
+        yield static_dir
     shutil.rmtree(static_dir, ignore_errors=True)
 
 
@@ -114,6 +122,8 @@ async def clear_dirs(engine):
     yield
     async with session(make_sessionmaker(engine)) as s:
         await s.execute(delete(Directory))
+        await s.execute(delete(Blob))
+    DirectoryCrud.invalidate()
 
 
 @pytest.fixture
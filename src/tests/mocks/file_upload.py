@@ -1,12 +1,21 @@
 from config import settings
 
 
+def blob_dirs(blob_hash: str) -> dict:
+    """Структура хранилища блобов на диске, в котором лежит один блоб."""
+    return {
+        'tmp/': [], 'tmp/blobs': [], 'tmp/blobs/tmp': [], f'tmp/blobs/{blob_hash[:2]}': [],
+        f'tmp/blobs/{blob_hash[:2]}/{blob_hash[2:4]}': [blob_hash],
+    }
+
+
 def upload_result_1():
     return {
         "name": "file.txt",
         "size": 353753,
         "path": "tmp/test_user/file.txt",
-        "files_in_directories": {'tmp/': [], 'tmp/test_user': ['file.txt']},
+        "blob_hash": "98065922fd32e4eb049f835249438b60d9b35ff3d9f0654784de1e4579b34544",
+        "files_in_directories": blob_dirs("98065922fd32e4eb049f835249438b60d9b35ff3d9f0654784de1e4579b34544"),
     }
 
 
@@ -15,7 +24,8 @@ def upload_result_2():
         "name": "test.pdf",
         "size": 306207,
         "path": "tmp/test_user/file/test.pdf",
-        "files_in_directories": {'tmp/': [], 'tmp/test_user': [], 'tmp/test_user/file': ['test.pdf']},
+        "blob_hash": "c579c1d27ee686f8d546f7b36fa5829aad569f28459dbdd7547a27e1236193a6",
+        "files_in_directories": blob_dirs("c579c1d27ee686f8d546f7b36fa5829aad569f28459dbdd7547a27e1236193a6"),
     }
 
 
@@ -24,8 +34,8 @@ def upload_result_3():
         "name": "test.txt",
         "size": 176,
         "path": "tmp/test_user/docs/one/two/test.txt",
-        "files_in_directories": {'tmp/': [], 'tmp/test_user': [], 'tmp/test_user/docs': [],
-                                 'tmp/test_user/docs/one': [], 'tmp/test_user/docs/one/two': ['test.txt']},
+        "blob_hash": "590ace8570888c1ab66c0585688fc9b05777409bf06d1b1442413903c61be1ad",
+        "files_in_directories": blob_dirs("590ace8570888c1ab66c0585688fc9b05777409bf06d1b1442413903c61be1ad"),
     }
 
 
@@ -34,8 +44,8 @@ def upload_result_4():
         "name": "new.txt",
         "size": 176,
         "path": "tmp/test_user/docs/one/two/new.txt",
-        "files_in_directories": {'tmp/': [], 'tmp/test_user': [], 'tmp/test_user/docs': [],
-                                 'tmp/test_user/docs/one': [], 'tmp/test_user/docs/one/two': ['new.txt']},
+        "blob_hash": "590ace8570888c1ab66c0585688fc9b05777409bf06d1b1442413903c61be1ad",
+        "files_in_directories": blob_dirs("590ace8570888c1ab66c0585688fc9b05777409bf06d1b1442413903c61be1ad"),
     }
 
 
@@ -49,5 +59,6 @@ def upload_result_6():
         "name": "test.pdf",
         "size": 306207,
         "path": "tmp/test_user/test.pdf",
-        "files_in_directories": {'tmp/': [], 'tmp/test_user': ['test.pdf']},
+        "blob_hash": "c579c1d27ee686f8d546f7b36fa5829aad569f28459dbdd7547a27e1236193a6",
+        "files_in_directories": blob_dirs("c579c1d27ee686f8d546f7b36fa5829aad569f28459dbdd7547a27e1236193a6"),
     }
@@ -0,0 +1,286 @@
+import asyncio
+import uuid
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from httpx import AsyncClient
+
+from api.healthchek import check_redis
+from cache import redis
+from cache.breaker import CircuitBreaker, CircuitOpenError, CircuitState
+from cache.codec import MISSING, CacheCodec
+from cache.memory import LocalCache
+from cache.metrics import cache_metrics
+from cache.redis import redis_cache, timed_cache
+from cache.redis_keys import all_keys
+from config import settings
+from schemas.file import File
+
+from .conftest import base_url
+
+
+async def test_cache_codec(test_app):
+    user_id, directory_id = uuid.uuid4(), uuid.uuid4()
+    files = [
+        File(
+            id=uuid.uuid4(),
+            name=f'{i}.txt',
+            path=f'dir/{i}.txt',
+            size=i,
+            user_id=user_id,
+            created_ad=datetime(2026, 1, 1, tzinfo=timezone.utc),
+            directory_id=directory_id,
+            blob_hash='0' * 64,
+        )
+        for i in range(100)
+    ]
+    codec = CacheCodec(list[File])
+    assert codec.decode(codec.encode(files)) == files
+
+    compressed = CacheCodec(list[File], compress_min_size=1024)
+    assert len(compressed.encode(files)) < len(codec.encode(files)) / 2
+    assert compressed.decode(compressed.encode(files)) == files
+    assert codec.decode(compressed.encode(files)) == files, "сжатие определяется по записи, а не по настройке"
+
+    # записи с другой схемой и старые записи не в этом формате - промах, а не ошибка
+    assert CacheCodec(list[str]).decode(codec.encode(files)) is MISSING
+    assert codec.decode(b'\x80\x04\x95') is MISSING
+    assert CacheCodec(File | None).decode(CacheCodec(File | None).encode(None)) is None
+
+
+async def test_local_cache_limits(test_app):
+    cache = LocalCache(max_bytes=10)
+    cache.enabled = True
+    cache.set('a', 'a', size=4, ttl=60)
+    cache.set('b', 'b', size=4, ttl=60)
+    cache.get('a')
+    # не влезает в размер - вытесняется давно не использованный ключ
+    cache.set('c', 'c', size=4, ttl=60)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == ('a', None, 'c')
+    assert cache.size == 8
+
+    cache.set('d', 'd', size=1, ttl=0.01)
+    with patch('cache.memory.time.monotonic', return_value=10 ** 9):
+        assert cache.get('d') is None, "истекшее значение не должно отдаваться"
+
+    # значение, прочитанное до инвалидации, после нее не кладется
+    epoch = cache.epoch
+    cache.invalidate('a')
+    cache.set('a', 'old', size=1, ttl=60, epoch=epoch)
+    assert cache.get('a') is None
+
+    cache.enabled = False
+    assert cache.get('c') is None, "выключенный кеш ничего не отдает"
+
+
+async def test_local_cache_invalidation(test_app):
+    calls = []
+
+    @timed_cache(cache_key='test_local_cache', time=60, schema=dict[str, int])
+    async def cached():
+        calls.append(1)
+        return {'value': len(calls)}
+
+    redis.start_invalidation_listener()
+    try:
+        for _ in range(50):
+            if redis.local_cache.enabled:
+                break
+            await asyncio.sleep(0.01)
+
+        assert await cached() == {'value': 1}
+        # второй раз - из памяти процесса, даже если в redis ключа уже нет
+        await redis_cache.delete('test_local_cache')
+        assert await cached() == {'value': 1}
+        assert calls == [1]
+
+        # инвалидация из другого процесса приходит через pub/sub
+        await redis_cache.publish(all_keys.cache_invalidation.substitute(), 'test_local_cache')
+        for _ in range(50):
+            if redis.local_cache.get('test_local_cache') is None:
+                break
+            await asyncio.sleep(0.01)
+        assert await cached() == {'value': 2}
+    finally:
+        await redis.stop_invalidation_listener()
+    assert not redis.local_cache.enabled, "без подписки на инвалидации кеш в памяти выключается"
+
+
+async def test_cache_single_flight(test_app):
+    calls = []
+
+    def make_cached(key: str):
+        @timed_cache(cache_key=key, time=60, schema=list[str])
+        async def cached():
+            calls.append(key)
+            await asyncio.sleep(0.05)
+            return [str(len(calls))]
+        return cached
+
+    # одновременные промахи в процессе - один расчет
+    results = await asyncio.gather(*(make_cached('test_single_flight')() for _ in range(10)))
+    assert results == [['1']] * 10
+    assert calls == ['test_single_flight']
+
+    # значение считает другой процесс: ждем его результат, а не считаем сами
+    lock_key = all_keys.cache_lock.substitute(key='test_other_worker')
+    await redis_cache.set(lock_key, 'other', ex=5)
+
+    async def other_worker():
+        await asyncio.sleep(0.1)
+        await redis_cache.set('test_other_worker', CacheCodec(list[str]).encode(['other']), ex=60)
+
+    result, _ = await asyncio.gather(make_cached('test_other_worker')(), other_worker())
+    assert result == ['other']
+    assert calls == ['test_single_flight'], "значение должен был посчитать другой процесс"
+
+    # другой процесс отпустил блокировку без значения - считаем сами
+    lock_key = all_keys.cache_lock.substitute(key='test_released')
+    await redis_cache.set(lock_key, 'other', ex=5)
+
+    async def release():
+        await asyncio.sleep(0.1)
+        await redis_cache.delete(lock_key)
+
+    result, _ = await asyncio.gather(make_cached('test_released')(), release())
+    assert result == ['2']
+
+
+async def test_cache_stale_while_revalidate(test_app):
+    calls = []
+    refreshed = asyncio.Event()
+
+    @timed_cache(cache_key='test_stale', time=60, schema=list[str], stale_time=60)
+    async def cached():
+        calls.append(1)
+        await refreshed.wait()
+        return ['new']
+
+    # свежее значение отдается как есть
+    await redis_cache.set('test_stale', CacheCodec(list[str]).encode(['old']), ex=100)
+    assert await cached() == ['old']
+    assert not calls
+
+    # устаревшее отдается сразу, пересчитывается один раз в фоне
+    await redis_cache.set('test_stale', CacheCodec(list[str]).encode(['old']), ex=30)
+    assert await asyncio.gather(cached(), cached(), cached()) == [['old']] * 3
+    await asyncio.sleep(0.01)
+    assert calls == [1]
+
+    refreshed.set()
+    for _ in range(50):
+        if await redis_cache.get('test_stale') == CacheCodec(list[str]).encode(['new']):
+            break
+        await asyncio.sleep(0.01)
+    assert await cached() == ['new']
+    assert await redis_cache.ttl('test_stale') > 60, "после пересчета значение снова свежее"
+    assert calls == [1]
+
+
+async def test_circuit_breaker(test_app):
+    probe = AsyncMock(side_effect=[ConnectionError, None])
+    breaker = CircuitBreaker(probe=probe, errors=(ConnectionError,), failure_threshold=2, reset_seconds=0.01)
+
+    # ошибка запроса - не отказ сервиса, счетчик не растет
+    with pytest.raises(ValueError):
+        await breaker.call(AsyncMock(side_effect=ValueError))
+    failing = AsyncMock(side_effect=ConnectionError)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await breaker.call(failing)
+    assert breaker.state == CircuitState.open
+
+    with pytest.raises(CircuitOpenError):
+        await breaker.call(failing)
+    assert failing.await_count == 2, "пока предохранитель разомкнут, сервис не вызывается"
+
+    # первая проверка не прошла, вторая замыкает предохранитель
+    for _ in range(50):
+        if breaker.is_closed:
+            break
+        await asyncio.sleep(0.01)
+    assert breaker.is_closed
+    assert probe.await_count == 2
+    assert await breaker.call(AsyncMock(return_value=1)) == 1
+    await breaker.stop()
+
+
+async def test_redis_circuit_breaker(test_app):
+    breaker = redis_cache.breaker
+    calls = []
+
+    @timed_cache(cache_key='test_breaker', time=60, schema=list[str])
+    async def cached():
+        calls.append(1)
+        return ['value']
+
+    with patch.object(breaker, 'reset_seconds', 0.01):
+        with patch.object(breaker, 'probe', AsyncMock(side_effect=ConnectionError)):
+            for _ in range(settings.REDIS_BREAKER_FAILURES):
+                breaker.record_failure()
+            assert breaker.state == CircuitState.open
+
+            # кеш работает так, как будто его нет, в redis запросы не уходят
+            with patch('redis.asyncio.connection.Connection.send_packed_command') as send:
+                assert await cached() == ['value']
+                assert await cached() == ['value']
+                send.assert_not_called()
+            assert calls == [1, 1]
+            assert (await check_redis())['redis_circuit'] == 'open'
+
+        # redis снова отвечает на проверку - предохранитель замыкается
+        for _ in range(100):
+            if breaker.is_closed:
+                break
+            await asyncio.sleep(0.01)
+    assert breaker.is_closed
+    assert await cached() == ['value']
+    assert await redis_cache.exists('test_breaker')
+    assert (await check_redis())['redis_circuit'] == 'closed'
+
+
+async def test_cache_negative(test_app):
+    calls = []
+
+    def make_cached(key: str, negative_time: int):
+        @timed_cache(cache_key=key, time=60, schema=list[str], stale_time=60, negative_time=negative_time)
+        async def cached():
+            calls.append(key)
+            return []
+        return cached
+
+    # пустой результат кешируется на negative_time и не считается устаревшим
+    assert await make_cached('test_negative', 5)() == []
+    assert await make_cached('test_negative', 5)() == []
+    assert calls == ['test_negative']
+    assert 0 < await redis_cache.ttl('test_negative') <= 5
+    assert not redis._refreshes
+
+    # без negative_time пустой результат не кешируется
+    assert await make_cached('test_not_negative', 0)() == []
+    assert await make_cached('test_not_negative', 0)() == []
+    assert calls == ['test_negative', 'test_not_negative', 'test_not_negative']
+
+
+async def test_cache_metrics(test_app, token1, create_files):
+    cache_metrics.clear()
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        with patch.object(settings, 'CACHE_DEBUG_HEADER', True):
+            first = await ac.get(test_app.url_path_for('get_list_file'))
+            second = await ac.get(test_app.url_path_for('get_list_file'))
+        assert 'file_list_v2=miss' in first.headers['x-cache']
+        assert 'file_list_v2=hit' in second.headers['x-cache']
+        assert 'get_current_user=' in second.headers['x-cache']
+
+        no_header = await ac.get(test_app.url_path_for('get_list_file'))
+        assert 'x-cache' not in no_header.headers, "без CACHE_DEBUG_HEADER заголовка нет"
+
+        response = await ac.get(test_app.url_path_for('cache_stats'))
+    stats = response.json()['file_list_v2']
+    assert stats['outcomes']['miss'] == 1
+    assert stats['outcomes']['hit'] == 2
+    assert stats['hit_ratio'] == pytest.approx(2 / 3)
+    assert stats['stored'] == 1 and stats['stored_bytes'] > 0
+    assert stats['decode_seconds']['count'] == 2
+    assert stats['redis_seconds']['buckets']['+Inf'] == stats['redis_seconds']['count'] > 0
@@ -1,10 +1,23 @@
+import asyncio
+import io
 import os
+import struct
+import tarfile
+import time
 import zipfile
+import zlib
 from unittest.mock import PropertyMock, patch
 
 import pytest
 from httpx import AsyncClient
 
+from config import settings
+from services import archive
+from services.archive import (DEFAULT_FILE_MODE, LOCAL_HEADER, ZIP64_EXTRA_TAG,
+                              ZIP64_LIMIT, ZIP_DEFLATED, ZIP_STORED,
+                              ArchiveMember, ZipStream, stream_zip)
+from services.archive_cache import ArchiveCache
+
 from .conftest import base_url
 
 
@@ -29,7 +42,8 @@ async def test_download_file(path, code, result, test_app, token1, create_files)
             assert test_result == {'detail': {'code': 'NOT_FOUND', 'error': '', 'message': 'Not Found'}}
             return
 
-        assert dict(response.headers) == {
+        # архивы директорий отдаются из кеша, там еще content-length, etag и accept-ranges
+        assert {name: response.headers[name] for name in ('content-disposition', 'content-type')} == {
             'content-disposition': 'attachment;filename=archive.zip',
             'content-type': 'application/x-zip-compressed',
         }, "заголовок ответа не верный"
@@ -51,3 +65,301 @@ async def test_download_file(path, code, result, test_app, token1, create_files)
         files_in_directories = {root: files for root, _, files in os.walk(download_dir)}
         for r in result:
             assert r in files_in_directories['tmp/download/'], "количество файлов в ответе не верное"
+
+
+async def test_download_directory_pages(test_app, token1, create_files):
+    # список файлов директории читается из БД страницами, в архив попадают все файлы поддерева
+    with patch.object(settings, 'ARCHIVE_LIST_PAGE_SIZE', 1):
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            response = await ac.get(test_app.url_path_for('download_file'), params={"path": 'tmp/test_user/docs'})
+    assert response.status_code == 200, "статус код ответа не верный"
+
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
+        assert zip_ref.namelist() == [
+            'tmp/test_user/docs/one/two/new.txt', 'tmp/test_user/docs/one/two/test.pdf',
+        ], "список файлов архива не верный"
+        assert zip_ref.read('tmp/test_user/docs/one/two/new.txt') == open('tests/mocks/test.txt', 'rb').read()
+
+
+@pytest.mark.parametrize('params, headers, filename, mode', [
+    ({'format': 'tar'}, {}, 'archive.tar', 'r:'),
+    ({'format': 'tar.gz'}, {}, 'archive.tar.gz', 'r:gz'),
+    ({}, {'accept': 'application/zip;q=0.5, application/x-tar'}, 'archive.tar', 'r:'),
+    ({}, {'accept': 'application/gzip'}, 'archive.tar.gz', 'r:gz'),
+])
+async def test_download_directory_tar(params, headers, filename, mode, test_app, token1, create_files):
+    params = {"path": 'tmp/test_user/docs', **params}
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.get(test_app.url_path_for('download_file'), params=params, headers=headers)
+    assert response.status_code == 200, "статус код ответа не верный"
+    assert response.headers['content-disposition'] == f'attachment;filename={filename}'
+    assert response.headers['vary'] == 'Accept', "формат выбирается по Accept, ответ должен это указывать"
+
+    with tarfile.open(fileobj=io.BytesIO(response.content), mode=mode) as tar:
+        assert tar.getnames() == [
+            'tmp/test_user/docs/one/two/new.txt', 'tmp/test_user/docs/one/two/test.pdf',
+        ], "список файлов архива не верный"
+        assert tar.extractfile('tmp/test_user/docs/one/two/test.pdf').read() == open('tests/mocks/test.pdf', 'rb').read()
+
+
+@pytest.mark.parametrize('params, headers', [
+    ({'format': 'tar.zst'}, {}),
+    ({}, {'accept': 'application/zstd, application/x-tar;q=0.1'}),
+])
+async def test_download_directory_tar_zst(params, headers, test_app, token1, create_files):
+    zstandard = pytest.importorskip('zstandard')
+    params = {"path": 'tmp/test_user/docs', **params}
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.get(test_app.url_path_for('download_file'), params=params, headers=headers)
+    assert response.status_code == 200, "статус код ответа не верный"
+    assert response.headers['content-disposition'] == 'attachment;filename=archive.tar.zst'
+
+    with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(response.content)) as reader:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            files = {member.name: tar.extractfile(member).read() for member in tar}
+    assert list(files) == [
+        'tmp/test_user/docs/one/two/new.txt', 'tmp/test_user/docs/one/two/test.pdf',
+    ], "список файлов архива не верный"
+    assert files['tmp/test_user/docs/one/two/test.pdf'] == open('tests/mocks/test.pdf', 'rb').read()
+
+
+async def test_download_zstd_unavailable(test_app, token1, create_files):
+    params = {"path": 'tmp/test_user/docs'}
+    with patch.object(archive, 'zstandard', None):
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            response = await ac.get(test_app.url_path_for('download_file'), params={**params, 'format': 'tar.zst'})
+            assert response.status_code == 406, "без zstandard tar.zst недоступен"
+            # по Accept недоступный формат пропускается
+            response = await ac.get(
+                test_app.url_path_for('download_file'), params=params, headers={'accept': 'application/zstd, application/x-tar;q=0.1'},
+            )
+    assert response.headers['content-disposition'] == 'attachment;filename=archive.tar'
+
+
+async def test_download_directory_cache(test_app, token1, create_files):
+    params = {"path": 'tmp/test_user/docs'}
+    with patch('services.archive_cache.stream_zip', wraps=stream_zip) as build:
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            # одновременные запросы собирают архив один раз
+            first, second = await asyncio.gather(
+                ac.get(test_app.url_path_for('download_file'), params=params),
+                ac.get(test_app.url_path_for('download_file'), params=params),
+            )
+            assert build.call_count == 1, "архив должен собираться один раз"
+            assert first.content == second.content, "архивы не совпадают"
+            etag = first.headers['etag']
+
+            response = await ac.get(test_app.url_path_for('download_file'), params=params, headers={'range': 'bytes=0-9'})
+            assert response.status_code == 206, "архив из кеша должен поддерживать Range"
+            assert response.content == first.content[:10]
+            response = await ac.get(test_app.url_path_for('download_file'), params=params, headers={'if-none-match': etag})
+            assert response.status_code == 304, "для неизмененной директории ожидается 304"
+            assert build.call_count == 1, "повторное скачивание должно идти из кеша"
+
+            # после изменения директории архив собирается заново
+            await ac.post(test_app.url_path_for('upload_file'), params={'path': 'docs/new.txt'}, files={'file': b'1'})
+            response = await ac.get(test_app.url_path_for('download_file'), params=params)
+            assert response.headers['etag'] != etag, "отпечаток директории не изменился"
+            assert build.call_count == 2, "архив измененной директории должен собираться заново"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
+        assert 'tmp/test_user/docs/new.txt' in zip_ref.namelist(), "в архиве нет нового файла"
+
+
+async def test_download_directory_head(test_app, token1, create_files):
+    params = {"path": 'tmp/test_user/docs'}
+    with patch('services.archive_cache.stream_zip', wraps=stream_zip) as build:
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            head = await ac.head(test_app.url_path_for('download_file'), params=params)
+            response = await ac.get(test_app.url_path_for('download_file'), params=params)
+    assert head.status_code == 200, "статус код ответа не верный"
+    assert head.content == b'', "на HEAD запрос тело не отдается"
+    assert head.headers['content-length'] == str(len(response.content)), "заголовок content-length не верный"
+    assert head.headers['etag'] == response.headers['etag'], "etag не совпадает"
+    assert build.call_count == 1, "после HEAD архив должен отдаваться из кеша"
+
+
+async def test_archive_cache_eviction(make_static_dir):
+    cache = ArchiveCache(make_static_dir, max_size=150)
+    for fingerprint in ('old', 'new'):
+        async def members():
+            yield ArchiveMember(path='tests/mocks/test.txt', arcname='test.txt', mtime=0)
+        await cache.build(fingerprint, members())
+        # вытесняются только архивы, которые давно не использовались
+        os.utime(cache.archive_path(fingerprint), (0, 0))
+
+    assert await cache.get('old') is None, "давно использованный архив должен быть вытеснен"
+    assert await cache.get('new') == cache.archive_path('new'), "последний архив должен остаться в кеше"
+
+
+async def test_archive_cache_stream(make_static_dir):
+    cache = ArchiveCache(make_static_dir, max_size=1024 * 1024)
+    release = asyncio.Event()
+
+    async def members():
+        yield ArchiveMember(path='tests/mocks/test.pdf', arcname='test.pdf', mtime=0)
+        await release.wait()
+        yield ArchiveMember(path='tests/mocks/test.txt', arcname='test.txt', mtime=0)
+
+    first, second = cache.stream('slow', members()), cache.stream('slow', members())
+    # начало архива отдается, пока сборка еще идет: сжимаем по одному файлу, чтобы не ждать следующих
+    with patch.object(settings, 'ARCHIVE_COMPRESS_WORKERS', 1):
+        await asyncio.wait_for(anext(first), timeout=5)
+    assert await cache.get('slow') is None, "архив не должен попасть в кеш до конца сборки"
+    # отключение клиента не прерывает сборку, второй запрос дочитывает ту же сборку
+    await first.aclose()
+    release.set()
+    content = b''.join([chunk async for chunk in second])
+
+    assert content == open(cache.archive_path('slow'), 'rb').read(), "отданный архив не совпадает с архивом в кеше"
+    with zipfile.ZipFile(io.BytesIO(content)) as zip_ref:
+        assert zip_ref.namelist() == ['test.pdf', 'test.txt'], "список файлов архива не верный"
+
+
+def test_zip_stream_zip64():
+    contents = {'text.txt': b'file server ' * 1000, 'docs/noise.bin': os.urandom(1000), 'empty.txt': b''}
+    stream = ZipStream()
+    # архив как будто отдается после 5 Гб других данных: смещения записей не влезают в 32 бита
+    stream._offset = 5 * 1024 ** 3
+    data, offsets = b'', []
+    for name, content in contents.items():
+        offsets.append(len(data))
+        data += stream.start_entry(name, mtime=time.time(), mode=DEFAULT_FILE_MODE)
+        data += stream.write(content)
+        data += stream.finish_entry()
+    data += stream.close()
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_ref:
+        assert zip_ref.testzip() is None, "архив поврежден"
+        assert zip_ref.namelist() == list(contents), "список файлов архива не верный"
+        for info in zip_ref.infolist():
+            content = contents[info.filename]
+            assert info.CRC == zlib.crc32(content), "crc записи не верный"
+            assert info.file_size == len(content), "размер записи не верный"
+            assert zip_ref.read(info) == content, "содержимое записи не верное"
+            # в центральном каталоге в zip64 extra только смещение записи, размеры влезают в 32 бита
+            tag, size, header_offset = struct.unpack('<HHQ', info.extra)
+            assert (tag, size) == (ZIP64_EXTRA_TAG, 8), "нет zip64 extra со смещением записи"
+            assert header_offset >= ZIP64_LIMIT, "смещение записи не верное"
+
+    # в локальном заголовке размеры еще неизвестны: маркеры zip64 и нулевые размеры в extra
+    for name, offset in zip(contents, offsets):
+        header = LOCAL_HEADER.unpack_from(data, offset)
+        assert header[7:9] == (ZIP64_LIMIT, ZIP64_LIMIT), "в локальном заголовке нет маркеров zip64"
+        extra_offset = offset + LOCAL_HEADER.size + len(name)
+        assert struct.unpack_from('<HHQQ', data, extra_offset) == (ZIP64_EXTRA_TAG, 16, 0, 0)
+
+
+async def test_stream_zip_compression(make_static_dir):
+    text = os.path.join(make_static_dir, 'text.txt')
+    noise = os.path.join(make_static_dir, 'noise.bin')
+    with open(text, 'wb') as f:
+        f.write(b'file server ' * 100_000)
+    with open(noise, 'wb') as f:
+        f.write(os.urandom(300_000))
+    members = [
+        ArchiveMember(path=text, arcname='text.txt'),
+        ArchiveMember(path='tests/mocks/test.jpg', arcname='photo.jpg'),
+        ArchiveMember(path=noise, arcname='noise.bin'),
+        ArchiveMember(path='tests/mocks/test.txt', arcname='small.txt'),
+    ]
+
+    # записи сжимаются параллельно, но в архиве идут в исходном порядке
+    archive = b''.join([data async for data in stream_zip(members, chunk_size=64 * 1024, workers=3)])
+    with zipfile.ZipFile(io.BytesIO(archive)) as zip_ref:
+        assert zip_ref.testzip() is None, "архив поврежден"
+        assert zip_ref.namelist() == ['text.txt', 'photo.jpg', 'noise.bin', 'small.txt'], "порядок файлов нарушен"
+        compress_types = {info.filename: info.compress_type for info in zip_ref.infolist()}
+        # уже сжатые форматы и плохо сжимаемые данные кладутся как есть
+        assert compress_types == {
+            'text.txt': ZIP_DEFLATED, 'photo.jpg': ZIP_STORED, 'noise.bin': ZIP_STORED, 'small.txt': ZIP_DEFLATED,
+        }
+        with open(noise, 'rb') as f:
+            assert zip_ref.read('noise.bin') == f.read(), "содержимое файла не совпадает"
+
+    # ошибка чтения файла поднимается в том месте архива, где этот файл
+    members.insert(1, ArchiveMember(path=os.path.join(make_static_dir, 'missing.txt'), arcname='missing.txt'))
+    with pytest.raises(FileNotFoundError):
+        async for _ in stream_zip(members, chunk_size=64 * 1024, workers=3):
+            pass
+
+
+async def test_stream_zip_disconnect(make_static_dir):
+    path = os.path.join(make_static_dir, 'big.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(64 * 1024))
+    members = [ArchiveMember(path=path, arcname='big.bin'), ArchiveMember(path=path, arcname='copy.bin')]
+    jobs, files = [], []
+
+    def start(*args):
+        jobs.append(start_job(*args))
+        return jobs[-1]
+
+    def open_member(*args):
+        files.append(open_job_member(*args))
+        return files[-1]
+
+    start_job, open_job_member = archive._MemberJob.start, archive._open_member
+    with (
+        patch.object(archive._MemberJob, 'start', side_effect=start),
+        patch.object(archive, '_open_member', side_effect=open_member),
+    ):
+        for workers in (1, 2):
+            jobs.clear()
+            files.clear()
+            stream = stream_zip(members, chunk_size=1024, workers=workers)
+            # клиент отключается посреди первого файла, сжатие которого ждет места в очереди
+            for _ in range(3):
+                await anext(stream)
+            await stream.aclose()
+            assert jobs and all(job.task.done() for job in jobs), "сжатие файлов не остановлено"
+            assert files and all(file[0].closed for file in files), "файлы не закрыты"
+
+
+async def test_download_selection(test_app, token1, create_files):
+    items = [
+        create_files[0]['id'],
+        'tmp/test_user/docs/one',
+        # этот файл уже попадает в архив через директорию
+        'tmp/test_user/docs/one/two/new.txt',
+        create_files[1]['id'],
+    ]
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        # этот файл не выбран, но лежит между выбранными по порядку путей
+        response = await ac.post(
+            test_app.url_path_for('upload_file'), params={'path': 'docs/other.txt'}, files={'file': b'1'},
+        )
+        assert response.status_code == 201, "статус код ответа не верный"
+        # страницы - диапазоны файлов пользователя, в том числе без выбранных файлов
+        for page_size in (1000, 1, 2):
+            with patch.object(settings, 'ARCHIVE_LIST_PAGE_SIZE', page_size):
+                response = await ac.post(test_app.url_path_for('download_selection'), json={'items': items})
+            assert response.status_code == 200, "статус код ответа не верный"
+            with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
+                assert zip_ref.namelist() == [
+                    'tmp/test_user/docs/one/two/new.txt', 'tmp/test_user/docs/one/two/test.pdf',
+                    'tmp/test_user/file.txt',
+                ], "каждый файл должен попасть в архив один раз"
+
+        response = await ac.post(
+            test_app.url_path_for('download_selection'), params={'format': 'tar'}, json={'items': items[:1]},
+        )
+        with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+            assert tar.getnames() == ['tmp/test_user/file.txt']
+
+        response = await ac.post(
+            test_app.url_path_for('download_selection'), json={'items': [items[0], 'tmp/test_user/missing']},
+        )
+        assert response.status_code == 404, "если чего-то из выбранного нет, ожидается 404"
+        response = await ac.post(test_app.url_path_for('download_selection'), json={'items': []})
+        assert response.status_code == 422, "пустой выбор недопустим"
+
+
+async def test_download_selection_like_wildcards(test_app, token1):
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        for path in ('a_b%/x.txt', 'aXbYZ/y.txt'):
+            response = await ac.post(test_app.url_path_for('upload_file'), params={'path': path}, files={'file': b'1'})
+            assert response.status_code == 201, "статус код ответа не верный"
+        # _ и % в имени директории - обычные символы, а не шаблон LIKE
+        response = await ac.post(test_app.url_path_for('download_selection'), json={'items': ['tmp/test_user/a_b%']})
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
+        assert zip_ref.namelist() == ['tmp/test_user/a_b%/x.txt'], "в архив попали файлы другой директории"
@@ -15,3 +15,22 @@ async def test_get_file_list(test_app, token1, token2, create_files):
         test_result = response.json()
         assert response.status_code == 200, "статус код ответа не верный"
         assert len(test_result) == 0, "количество файлов в ответе не верное"
+
+
+async def test_file_list_cache(test_app, token1, create_files):
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        first_page = await ac.get(test_app.url_path_for('get_list_file'), params={'limit': 2})
+        second_page = await ac.get(test_app.url_path_for('get_list_file'), params={'limit': 2, 'offset': 2})
+        # у разных страниц разные ключи кеша
+        assert len(first_page.json()) == 2
+        assert len(second_page.json()) == 1
+
+        search = await ac.get(test_app.url_path_for('search_files'), params={'extension': 'log'})
+        assert search.json() == {'matches': []}
+
+        # загрузка начинает новое поколение кеша пользователя, закешированные ответы больше не отдаются
+        await ac.post(test_app.url_path_for('upload_file'), params={'path': 'new.log'}, files={'file': b'1'})
+        response = await ac.get(test_app.url_path_for('get_list_file'))
+        assert len(response.json()) == 4, "после загрузки список должен обновиться сразу"
+        search = await ac.get(test_app.url_path_for('search_files'), params={'extension': 'log'})
+        assert [file['name'] for file in search.json()['matches']] == ['new.log']
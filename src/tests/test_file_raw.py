@@ -0,0 +1,90 @@
+import os
+import uuid
+
+import pytest
+from httpx import AsyncClient
+
+from utils.responses import ZEROCOPY_EXTENSION, FileRangeResponse
+
+from .conftest import base_url
+
+
+@pytest.mark.parametrize('headers, code, content', [  # noqa
+    ({}, 200, b'attrs==22.1.0\niniconfig==1.1.1\npackaging==21.3\npluggy==1.0.0\npy==1.11.0\npydantic==1.10.2\n'
+              b'pyparsing==3.0.9\npytest==7.1.3\ntomli==2.0.1\ntyping_extensions==4.3.0\nXlsxWriter==3.0.3\n'),
+    ({'range': 'bytes=0-4'}, 206, b'attrs'),
+    ({'range': 'bytes=-6'}, 206, b'3.0.3\n'),
+    ({'range': 'bytes=1000-'}, 416, b''),
+])
+async def test_raw_file(headers, code, content, test_app, token1, create_files):
+    file_id = create_files[2]['id']
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.get(test_app.url_path_for('raw_file', file_id=file_id), headers=headers)
+    assert response.status_code == code, "статус код ответа не верный"
+    if code == 416:
+        assert response.headers['content-range'] == 'bytes */176', "заголовок content-range не верный"
+        return
+
+    assert response.content == content, "содержимое ответа не верное"
+    assert response.headers['accept-ranges'] == 'bytes'
+    assert response.headers['content-length'] == str(len(content))
+    assert response.headers['etag'], "у ответа нет etag"
+    if code == 206:
+        assert response.headers['content-range'].endswith('/176'), "заголовок content-range не верный"
+
+
+async def test_raw_file_head(test_app, token1, create_files):
+    file_id = create_files[2]['id']
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.head(test_app.url_path_for('raw_file', file_id=file_id))
+    assert response.status_code == 200, "статус код ответа не верный"
+    assert response.content == b'', "на HEAD запрос тело не отдается"
+    assert response.headers['content-length'] == '176', "заголовок content-length не верный"
+    assert response.headers['etag'], "у ответа нет etag"
+
+
+async def test_raw_file_not_modified(test_app, token1, create_files):
+    file_id = create_files[2]['id']
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.get(test_app.url_path_for('raw_file', file_id=file_id))
+        etag = response.headers['etag']
+        last_modified = response.headers['last-modified']
+
+        response = await ac.get(test_app.url_path_for('raw_file', file_id=file_id), headers={'if-none-match': etag})
+        assert response.status_code == 304, "для неизмененного файла ожидается 304"
+        assert response.content == b''
+
+        response = await ac.get(
+            test_app.url_path_for('raw_file', file_id=file_id), headers={'if-modified-since': last_modified},
+        )
+        assert response.status_code == 304, "для неизмененного файла ожидается 304"
+
+        response = await ac.get(
+            test_app.url_path_for('raw_file', file_id=file_id), headers={'if-none-match': '"other"'},
+        )
+        assert response.status_code == 200, "для измененного файла ожидается 200"
+
+
+async def test_raw_file_not_found(test_app, token2, create_files):
+    # чужой и несуществующий файлы не отдаем
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token2}) as ac:
+        for file_id in (create_files[2]['id'], uuid.uuid4()):
+            response = await ac.get(test_app.url_path_for('raw_file', file_id=file_id))
+            assert response.status_code == 404, "статус код ответа не верный"
+
+
+async def test_raw_file_zerocopy(make_static_dir):
+    path = os.path.join(make_static_dir, 'zerocopy.txt')
+    with open(path, 'wb') as f:
+        f.write(b'file server')
+    sent = []
+
+    async def send(message):
+        if message['type'] == ZEROCOPY_EXTENSION:
+            # сервер читает файл, пока он открыт
+            message['file'].seek(message['offset'])
+            sent.append(message['file'].read(message['count']))
+
+    scope = {'type': 'http', 'extensions': {ZEROCOPY_EXTENSION: {}}}
+    await FileRangeResponse(path, size=11, byte_range=(5, 10))(scope, None, send)
+    assert sent == [b'server'], "через zerocopy отдана не та часть файла"
@@ -22,4 +22,4 @@ async def test_revision_file(path, test_app, token1, create_files):
     keys_name = [i for i in test_result[0]]
     file_ids = [v for i in create_files for k, v in i.items() if k == 'id']
     assert test_result[0]['id'] in file_ids, "id файла не верный"
-    assert keys_name == ['id', 'name', 'created_ad', 'path', 'rev_id', 'hash', 'modified_at'], "список полей ответа не верный"
+    assert keys_name == ['id', 'name', 'created_ad', 'path', 'rev_id', 'hash', 'hash_algorithm', 'modified_at'], "список полей ответа не верный"
@@ -1,13 +1,23 @@
+import asyncio
+import hashlib
 import os
+import uuid
 from unittest.mock import PropertyMock, patch
 
 import pytest
 from httpx import AsyncClient
-from sqlalchemy import select
+from sqlalchemy import delete, select
 
+from config import FsyncPolicy, settings
+from crud.directory import DirectoryCrud
+from db.models.blob import Blob
+from db.models.directory import Directory
 from db.models.file import File
 from db.models.revision import Revision
 from db.sqlalchemy.asyncpg import make_sessionmaker, session
+from services.file import FileManager
+from services.storage import BlobStorage, StreamWriter
+from utils.multipart import MultipartReader
 
 from .conftest import base_url
 from .mocks.file_upload import (upload_result_1, upload_result_2,
@@ -61,6 +71,214 @@ async def test_upload(path, file, code, result, test_app, token1, engine, make_s
     assert test_result["name"] == result["name"], "имя файла сгенерировано не верно"
     assert test_result["path"] == result["path"], "путь до файла не верный"
     assert test_result["size"] == result["size"], "размер файла не верный"
+    assert test_result["blob_hash"] == result["blob_hash"], "хеш содержимого файла не верный"
 
     files_in_directories = {root: files for root, _, files in os.walk(make_static_dir)}
     assert files_in_directories == result["files_in_directories"], "структура созданных файлов на диске не верная"
+
+
+async def test_upload_deduplication(test_app, token1, token2, engine, make_static_dir):
+    # одинаковое содержимое у разных файлов и пользователей хранится на диске один раз
+    for token, path in ((token1, 'one.txt'), (token1, 'docs/two.txt'), (token2, 'three.txt')):
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token}) as ac:
+            response = await ac.post(
+                test_app.url_path_for('upload_file'), params={'path': path},
+                files={'file': open('tests/mocks/test.txt', "rb")},
+            )
+        assert response.status_code == 201, "статус код ответа не верный"
+
+    result = upload_result_3()
+    files_in_directories = {root: files for root, _, files in os.walk(make_static_dir)}
+    assert files_in_directories == result["files_in_directories"], "одинаковое содержимое сохранено несколько раз"
+
+    async with session(make_sessionmaker(engine)) as s:
+        blob = await s.get(Blob, result["blob_hash"])
+        assert blob is not None, "в БД не создан блоб"
+        assert blob.refs == 3, "количество ссылок на блоб не верное"
+
+
+async def test_upload_hash_collision(test_app, token1, make_static_dir):
+    # в хранилище уже лежит другое содержимое с тем же хешем (подобранная коллизия) - оно не должно подменить файл
+    content = b'victim content'
+    storage = BlobStorage(make_static_dir)
+    blob_path = storage.blob_path(hashlib.new(settings.FILE_HASH_ALGORITHM, content).hexdigest())
+    os.makedirs(os.path.dirname(blob_path))
+    with open(blob_path, 'wb') as f:
+        f.write(b'attacker content')
+
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(test_app.url_path_for('upload_file'), params={'path': 'one.txt'}, files={'file': content})
+    assert response.status_code == 409, "статус код ответа не верный"
+    with open(blob_path, 'rb') as f:
+        assert f.read() == b'attacker content'
+    assert os.listdir(os.path.join(storage.root, 'tmp')) == [], "временный файл не удален"
+
+
+@pytest.mark.parametrize('algorithm', ['sha256', 'blake2b'])
+async def test_upload_hash_algorithm(algorithm, test_app, token1, engine):
+    with open('tests/mocks/test.txt', 'rb') as f:
+        content = f.read()
+
+    with patch.object(settings, 'FILE_HASH_ALGORITHM', algorithm):
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            response = await ac.post(
+                test_app.url_path_for('upload_file'), params={'path': 'one.txt'}, files={'file': content},
+            )
+    assert response.status_code == 201, "статус код ответа не верный"
+    result = response.json()
+    assert result["blob_hash"] == hashlib.new(algorithm, content).hexdigest(), "хеш содержимого файла не верный"
+
+    async with session(make_sessionmaker(engine)) as s:
+        revision = (await s.execute(select(Revision).where(Revision.file_id == result["id"]))).scalars().first()
+        assert revision.hash_algorithm == algorithm, "алгоритм хеширования ревизии не верный"
+
+
+@pytest.mark.parametrize('fsync_policy', list(FsyncPolicy))
+async def test_upload_same_path_concurrently(fsync_policy, test_app, token1, engine):
+    # одновременные загрузки в один путь выполняются по очереди: остается один файл и одна ссылка на блоб
+    contents = [f'content {i}'.encode() for i in range(5)]
+    with patch.object(settings, 'FSYNC_POLICY', fsync_policy):
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            responses = await asyncio.gather(*(
+                ac.post(test_app.url_path_for('upload_file'), params={'path': 'one.txt'}, files={'file': content})
+                for content in contents
+            ))
+    assert [r.status_code for r in responses] == [201] * len(contents), "статус код ответа не верный"
+
+    async with session(make_sessionmaker(engine)) as s:
+        files = (await s.execute(select(File).where(File.name == 'one.txt'))).scalars().all()
+        assert len(files) == 1, "файл должен быть один"
+        refs = (await s.execute(select(Blob.hash, Blob.refs))).all()
+        assert {h: r for h, r in refs if r} == {files[0].blob_hash: 1}, "ссылка должна быть только на последний блоб"
+
+
+async def test_upload_batch(test_app, token1, engine):
+    files = [
+        ('files', ('a.txt', b'first')),
+        ('files', ('sub/b.txt', b'second')),
+        ('files', ('sub/deep/c.txt', b'first')),
+        ('files', ('../a.txt', b'third')),
+    ]
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(test_app.url_path_for('upload_files'), params={'path': 'docs'}, files=files)
+    assert response.status_code == 201, "статус код ответа не верный"
+    result = response.json()
+    assert [f['path'] for f in result] == [
+        'tmp/test_user/docs/a.txt', 'tmp/test_user/docs/sub/b.txt', 'tmp/test_user/docs/sub/deep/c.txt',
+    ], "пути до файлов не верные"
+    # файл передан дважды, сохраняется последний
+    assert result[0]['blob_hash'] == hashlib.sha256(b'third').hexdigest(), "содержимое файла не верное"
+
+    async with session(make_sessionmaker(engine)) as s:
+        revisions = (await s.execute(select(Revision))).scalars().all()
+        assert len(revisions) == 3, "для каждого файла должна быть ревизия"
+        refs = dict((await s.execute(select(Blob.hash, Blob.refs))).all())
+        assert refs == {
+            hashlib.sha256(b'first').hexdigest(): 1,
+            hashlib.sha256(b'second').hexdigest(): 1,
+            hashlib.sha256(b'third').hexdigest(): 1,
+        }, "количество ссылок на блобы не верное"
+
+
+async def test_upload_batch_without_files(test_app, token1):
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(
+            test_app.url_path_for('upload_files'), params={'path': 'docs'}, files={'file': ('a.txt', b'a')},
+        )
+    assert response.status_code == 422, "статус код ответа не верный"
+
+
+@pytest.mark.parametrize('request_kwargs', [
+    # в запросе нет части file
+    {'files': {'other': ('a.txt', b'a')}},
+    # тело не multipart
+    {'content': b'a', 'headers': {'content-type': 'text/plain'}},
+    {'content': b'a', 'headers': {'content-type': 'multipart/form-data'}},
+])
+async def test_upload_without_file(request_kwargs, test_app, token1):
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(test_app.url_path_for('upload_file'), params={'path': 'a.txt'}, **request_kwargs)
+    assert response.status_code == 422, "статус код ответа не верный"
+    assert response.json()['detail']['code'] == 'VALIDATION_ERROR', "код ошибки не верный"
+
+
+async def test_multipart_reader_skips_unread_parts():
+    boundary = 'boundary'
+    body = ''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}.txt"\r\n'
+        f'Content-Type: text/plain\r\n\r\n{content}\r\n'
+        for name, content in (('skipped', 'x' * 1000), ('file', 'содержимое'), ('tail', 'y' * 1000))
+    ).encode() + f'--{boundary}--\r\n'.encode()
+
+    async def stream():
+        # тело приходит мелкими чанками, границы частей попадают внутрь чанков
+        for i in range(0, len(body), 7):
+            yield body[i:i + 7]
+
+    parts = []
+    async for part in MultipartReader(f'multipart/form-data; boundary={boundary}', stream()):
+        # непрочитанные части пропускаются, читается только file
+        parts.append((part.name, part.filename, part.content_type))
+        if part.name == 'file':
+            assert b''.join([chunk async for chunk in part]).decode() == 'содержимое', "содержимое части не верное"
+    assert parts == [
+        ('skipped', 'skipped.txt', 'text/plain'), ('file', 'file.txt', 'text/plain'), ('tail', 'tail.txt', 'text/plain'),
+    ], "список частей не верный"
+
+
+async def test_upload_after_other_parts(test_app, token1):
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(
+            test_app.url_path_for('upload_file'),
+            params={'path': 'docs/a.txt'},
+            data={'comment': 'x' * 10_000},
+            files={'file': ('a.txt', b'content')},
+        )
+        assert response.status_code == 201, "статус код ответа не верный"
+        response = await ac.get(test_app.url_path_for('raw_file', file_id=response.json()['id']))
+    assert response.content == b'content', "содержимое файла не верное"
+
+
+async def test_upload_directory_cache(test_app, token1, engine):
+    async def upload(path: str):
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            response = await ac.post(test_app.url_path_for('upload_file'), params={'path': path}, files={'file': b'1'})
+        assert response.status_code == 201, "статус код ответа не верный"
+        return response.json()
+
+    first = await upload('a/b/c/d/one.txt')
+    # директории уже известны процессу, к БД за ними не ходим
+    with patch.object(DirectoryCrud, '_get_ids', side_effect=AssertionError('лишний запрос директорий')):
+        second = await upload('a/b/c/d/two.txt')
+    assert first['directory_id'] == second['directory_id'], "файлы должны попасть в одну директорию"
+
+    # директории удалены в обход процесса: закешированные id устарели, но загрузка проходит
+    async with session(make_sessionmaker(engine)) as s:
+        await s.execute(delete(Directory))
+    third = await upload('a/b/c/d/three.txt')
+    async with session(make_sessionmaker(engine)) as s:
+        assert await s.get(Directory, uuid.UUID(third['directory_id'])) is not None, "директория не создана"
+
+
+async def test_upload_same_directory_names(test_app, token1, engine):
+    # одноименные директории в разных местах - разные директории
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        first = await ac.post(test_app.url_path_for('upload_file'), params={'path': 'a/docs/x.txt'}, files={'file': b'1'})
+        second = await ac.post(test_app.url_path_for('upload_file'), params={'path': 'b/docs/x.txt'}, files={'file': b'2'})
+    assert first.json()['directory_id'] != second.json()['directory_id'], "директории не должны совпадать"
+
+    async with session(make_sessionmaker(engine)) as s:
+        paths = (await s.execute(select(Directory.path).order_by(Directory.path))).scalars().all()
+    assert paths == [
+        'test_user', 'test_user/a', 'test_user/a/docs', 'test_user/b', 'test_user/b/docs',
+    ], "пути директорий не верные"
+
+
+async def test_save_stream_keeps_original_error(make_static_dir):
+    async def stream():
+        yield b'file server'
+
+    # файл не создался: наружу уходит исходная ошибка, а не FileNotFoundError от удаления
+    with patch.object(StreamWriter, '_open', side_effect=PermissionError):
+        with pytest.raises(PermissionError):
+            await FileManager._save_stream(stream(), os.path.join(make_static_dir, 'not-created'))
@@ -1,6 +1,18 @@
+import asyncio
+import os
+import uuid
+from unittest.mock import patch
+
 import pytest
 from httpx import AsyncClient
 
+from config import settings
+from crud.file import FileCrud
+from crud.user import UserCrud
+from schemas.file import TailFile
+from services.file import DownloadFileManager
+from utils.responses import sse_event
+
 from .conftest import base_url
 from .mocks.file_view import file_view_result_1, file_view_result_2
 
@@ -20,3 +32,101 @@ async def test_get_file_list(file_num, code, result, test_app, token1, create_fi
             assert test_result == result, "полученная ошибка не верная"
             return
         assert test_result["content"] == result, "содержимое файла не верное"
+
+
+async def test_view_not_found_cache(test_app, token1):
+    file_id = uuid.uuid4()
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        with patch.object(FileCrud, 'get_one', autospec=True, side_effect=FileCrud.get_one) as get_one:
+            for _ in range(3):
+                response = await ac.get(test_app.url_path_for('file_view', file_id=file_id))
+                assert response.status_code == 404
+            assert get_one.call_count == 1, "\"не найдено\" должно отдаваться из кеша"
+
+            # загрузка сбрасывает и отрицательный кеш
+            await ac.post(test_app.url_path_for('upload_file'), params={'path': 'new.txt'}, files={'file': b'1'})
+            response = await ac.get(test_app.url_path_for('file_view', file_id=file_id))
+            assert response.status_code == 404
+            assert get_one.call_count == 2
+
+
+async def test_view_pages(test_app, token1, make_static_dir):
+    content = ''.join(f'строка {i}\n' for i in range(150))
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(
+            test_app.url_path_for('upload_file'), params={'path': 'log.txt'}, files={'file': content.encode()},
+        )
+        file = response.json()
+        url = test_app.url_path_for('file_view', file_id=file['id'])
+
+        # страница из середины файла, за точкой индекса строк
+        response = await ac.get(url, params={'offset': 70, 'limit': 3})
+        assert response.json() == {
+            'id': file['id'], 'content': 'строка 70\nстрока 71\nстрока 72\n',
+            'offset': 70, 'next_offset': 73, 'size': len(content.encode()), 'lines': 150,
+        }
+        assert os.path.exists(f'{make_static_dir}blobs/{file["blob_hash"][:2]}/{file["blob_hash"][2:4]}/{file["blob_hash"]}.lines')
+
+        response = await ac.get(url, params={'offset': 148})
+        assert response.json()['content'] == 'строка 148\nстрока 149\n'
+        assert response.json()['next_offset'] is None, "файл прочитан до конца"
+
+        # по байтам: начало страницы в середине символа, конец страницы не режет символ
+        response = await ac.get(url, params={'offset': 1, 'limit': 6, 'unit': 'bytes'})
+        assert response.json()['content'] == 'тр'
+        assert response.json()['next_offset'] == 6
+
+        # страница не больше VIEW_MAX_PAGE_KB
+        with patch.object(settings, 'VIEW_MAX_PAGE_KB', 1):
+            response = await ac.get(url)
+        assert len(response.json()['content'].encode()) <= 1024
+        assert response.json()['next_offset'] == len(response.json()['content'].splitlines())
+
+
+async def test_tail(test_app, token1, make_static_dir):
+    content = ''.join(f'строка {i}\n' for i in range(150))
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(
+            test_app.url_path_for('upload_file'), params={'path': 'log.txt'}, files={'file': content.encode()},
+        )
+        file_id = response.json()['id']
+
+        response = await ac.get(test_app.url_path_for('file_tail', file_id=file_id), params={'lines': 2})
+        assert response.json() == {
+            'id': file_id, 'content': 'строка 148\nстрока 149\n',
+            'offset': len(content.encode()) - len('строка 148\nстрока 149\n'.encode()), 'size': len(content.encode()),
+        }
+
+        # хвост не больше VIEW_MAX_PAGE_KB, начало не режет символ
+        with patch.object(settings, 'VIEW_MAX_PAGE_KB', 1):
+            response = await ac.get(test_app.url_path_for('file_tail', file_id=file_id), params={'lines': 1000})
+        assert content.endswith(response.json()['content'])
+        assert len(response.json()['content'].encode()) <= 1024
+
+
+async def test_tail_follow(test_app, token1, make_static_dir):
+    async def upload(content: str) -> dict:
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            response = await ac.post(
+                test_app.url_path_for('upload_file'), params={'path': 'app.log'}, files={'file': content.encode()},
+            )
+            uploaded: dict = response.json()
+            return uploaded
+
+    file = await upload('первая\nвторая\n')
+    user = await UserCrud().get_one(username='test_user')
+    with patch.object(settings, 'TAIL_FOLLOW_INTERVAL_SECONDS', 5):
+        response = await DownloadFileManager(user, base_dir=make_static_dir).follow_file(file['id'], lines=1)
+        events = response.body_iterator
+        assert await anext(events) == sse_event('tail', TailFile(id=file['id'], content='вторая\n', offset=13, size=26))
+
+        # новая ревизия дописана в конец - приходят только новые байты, сразу по уведомлению
+        await upload('первая\nвторая\nтретья\n')
+        event = await asyncio.wait_for(anext(events), 2)
+        assert event == sse_event('append', TailFile(id=file['id'], content='третья\n', offset=26, size=39))
+
+        # файл переписан - снова хвост
+        await upload('заново\n')
+        event = await asyncio.wait_for(anext(events), 2)
+        assert event == sse_event('tail', TailFile(id=file['id'], content='заново\n', offset=0, size=13))
+        await events.aclose()
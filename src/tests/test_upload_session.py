@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import os
+from unittest.mock import patch
+
+import pytest
+from httpx import AsyncClient
+
+from config import settings
+from services.storage import BlobStorage
+from services.upload import COMMIT_SUFFIX, UploadSessionManager
+
+from .conftest import base_url
+
+
+async def test_upload_session(test_app, token1):
+    with open('tests/mocks/test.pdf', 'rb') as f:
+        content = f.read()
+
+    with patch.object(settings, 'UPLOAD_CHUNK_SIZE_KB', 100):
+        async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+            response = await ac.post(
+                test_app.url_path_for('create_upload_session'), params={'path': 'docs/big.pdf', 'size': len(content)},
+            )
+            assert response.status_code == 201, "статус код ответа не верный"
+            upload = response.json()
+            assert upload['chunks'] == 3, "количество чанков не верное"
+            assert upload['received'] == [], "список загруженных чанков не верный"
+
+            def put_chunk(index: int, data: bytes):
+                url = test_app.url_path_for('upload_chunk', session_id=upload['id'], index=str(index))
+                return ac.put(url, content=data)
+
+            chunk_size = upload['chunk_size']
+            chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+
+            # чанк не того размера не принимается
+            response = await put_chunk(0, chunks[0][:10])
+            assert response.status_code == 400, "статус код ответа не верный"
+
+            # первый чанк, потом обрыв связи
+            response = await put_chunk(0, chunks[0])
+            assert response.status_code == 204, "статус код ответа не верный"
+            response = await ac.post(test_app.url_path_for('commit_upload_session', session_id=upload['id']))
+            assert response.status_code == 409, "нельзя завершить загрузку, пока загружены не все чанки"
+
+            response = await ac.get(test_app.url_path_for('get_upload_session', session_id=upload['id']))
+            assert response.json()['received'] == [0], "список загруженных чанков не верный"
+
+            # неудачная повторная загрузка портит уже полученный чанк, его нужно загрузить заново
+            response = await put_chunk(0, chunks[0][:10])
+            assert response.status_code == 400, "статус код ответа не верный"
+            response = await ac.get(test_app.url_path_for('get_upload_session', session_id=upload['id']))
+            assert response.json()['received'] == [], "испорченный чанк не должен считаться загруженным"
+            response = await put_chunk(0, chunks[0])
+            assert response.status_code == 204, "статус код ответа не верный"
+
+            # догружаем остальные параллельно и в обратном порядке
+            responses = await asyncio.gather(*(put_chunk(i, chunks[i]) for i in reversed(range(1, len(chunks)))))
+            assert [r.status_code for r in responses] == [204, 204], "статус код ответа не верный"
+
+            response = await ac.post(test_app.url_path_for('commit_upload_session', session_id=upload['id']))
+            assert response.status_code == 201, "статус код ответа не верный"
+            file = response.json()
+            assert file['path'] == 'tmp/test_user/docs/big.pdf', "путь до файла не верный"
+            assert file['size'] == len(content), "размер файла не верный"
+
+            response = await ac.get(test_app.url_path_for('raw_file', file_id=file['id']))
+            assert response.content == content, "содержимое собранного файла не верное"
+
+            response = await ac.get(test_app.url_path_for('get_upload_session', session_id=upload['id']))
+            assert response.status_code == 404, "после завершения загрузки сессия удаляется"
+
+
+async def test_upload_session_too_large(test_app, token1):
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(
+            test_app.url_path_for('create_upload_session'),
+            params={'path': 'big.pdf', 'size': settings.MAX_FILE_SIZE_KB * 1024 + 1},
+        )
+    assert response.status_code == 413, "статус код ответа не верный"
+
+
+async def test_upload_session_commit_retry(test_app, token1, make_static_dir):
+    content = b'file server ' * 100
+
+    async with AsyncClient(app=test_app, base_url=base_url, headers={'Authorization': token1}) as ac:
+        response = await ac.post(
+            test_app.url_path_for('create_upload_session'), params={'path': 'docs/retry.txt', 'size': len(content)},
+        )
+        upload = response.json()
+        response = await ac.put(
+            test_app.url_path_for('upload_chunk', session_id=upload['id'], index='0'), content=content,
+        )
+        assert response.status_code == 204, "статус код ответа не верный"
+
+        # файл не зарегистрировался в БД - загрузка остается, подтверждение можно повторить
+        url = test_app.url_path_for('commit_upload_session', session_id=upload['id'])
+        with patch.object(UploadSessionManager, '_create_file', side_effect=ConnectionError):
+            with pytest.raises(ConnectionError):
+                await ac.post(url)
+        # собранный файл не копируется: блоб - жесткая ссылка на него
+        storage = BlobStorage(make_static_dir)
+        commit_path = await storage.temp_path(f'upload-{upload["id"]}{COMMIT_SUFFIX}')
+        blob_path = storage.blob_path(hashlib.new(settings.FILE_HASH_ALGORITHM, content).hexdigest())
+        assert os.path.samefile(commit_path, blob_path), "собранный файл должен остаться до регистрации в БД"
+
+        response = await ac.post(url)
+        assert response.status_code == 201, "статус код ответа не верный"
+        assert os.listdir(os.path.dirname(commit_path)) == [], "после подтверждения собранный файл удаляется"
+
+        response = await ac.get(test_app.url_path_for('raw_file', file_id=response.json()['id']))
+        assert response.content == content, "содержимое собранного файла не верное"
@@ -32,6 +32,7 @@ async def exception_handler(request: Request, exc: Exception):
         content={'detail': exc.detail},
         headers={
             'access-control-allow-origin': '*',
+            **(exc.headers or {}),
         },
     )
 
@@ -145,7 +146,59 @@ class LargeFileError(BaseServiceException):
     message = f'Размер файла не должен превышать {settings.MAX_FILE_SIZE_KB} kb'
 
 
+class TooManyFilesError(BaseServiceException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    code = ErrorCodes.VALIDATION_ERROR
+    message = f'За один запрос можно загрузить не больше {settings.BATCH_MAX_FILES} файлов'
+
+
 class WrongFileFormatError(BaseServiceException):
     status_code = 400
     code = ErrorCodes.VALIDATION_ERROR
     message = 'Файл не является текстовым, предварительный просмотр не доступен.'
+
+
+class FileRequiredError(BaseServiceException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    code = ErrorCodes.VALIDATION_ERROR
+    message = 'Файл не передан, ожидается multipart/form-data с полем file (files для пакетной загрузки)'
+
+
+class WrongChunkError(BaseServiceException):
+    status_code = 400
+    code = ErrorCodes.VALIDATION_ERROR
+    message = 'Номер или размер чанка не соответствует сессии загрузки'
+
+
+class UploadNotCompleteError(BaseServiceException):
+    status_code = status.HTTP_409_CONFLICT
+    code = ErrorCodes.VALIDATION_ERROR
+    message = 'Загружены не все чанки файла'
+
+
+class BlobCollisionError(BaseServiceException):
+    status_code = status.HTTP_409_CONFLICT
+    code = ErrorCodes.VALIDATION_ERROR
+    message = 'Содержимое с таким хешем уже сохранено и отличается от загруженного'
+
+
+class FileNameRequiredError(BaseServiceException):
+    status_code = 400
+    code = ErrorCodes.VALIDATION_ERROR
+    message = 'Передан путь до директории, нужно указать имя файла'
+
+
+class ArchiveFormatUnavailableError(BaseServiceException):
+    status_code = status.HTTP_406_NOT_ACCEPTABLE
+    code = ErrorCodes.VALIDATION_ERROR
+    message = 'Формат архива не поддерживается сервером (для tar.zst нужен пакет zstandard)'
+
+
+class RangeNotSatisfiableError(BaseServiceException):
+    status_code = status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+    code = ErrorCodes.VALIDATION_ERROR
+    message = 'Запрошенный диапазон выходит за пределы файла'
+
+    def __init__(self, size: int) -> None:
+        super().__init__()
+        self.headers = {'content-range': f'bytes */{size}'}
@@ -0,0 +1,51 @@
+"""Хеширование содержимого файлов.
+
+Хеш содержимого - ключ блоба в хранилище, поэтому настройка `FILE_HASH_ALGORITHM` допускает
+только криптостойкие алгоритмы из BLOB_HASH_ALGORITHMS: для md5 и xxhash коллизии подбираются.
+Остальные алгоритмы `hashlib` и, если установлен пакет `xxhash`, xxh64, xxh3_64, xxh3_128
+годятся как дополнительная контрольная сумма и для бенчмарков.
+"""
+import hashlib
+from typing import Protocol, cast
+
+try:
+    import xxhash
+except ImportError:  # pragma: no cover
+    xxhash = None
+
+XXHASH_ALGORITHMS = ('xxh32', 'xxh64', 'xxh3_64', 'xxh3_128', 'xxh128')
+# алгоритмы, которыми можно считать ключ блоба
+BLOB_HASH_ALGORITHMS = ('sha256', 'blake2b')
+
+
+class Hasher(Protocol):
+    name: str
+
+    def update(self, data: bytes | bytearray, /) -> None:
+        ...
+
+    def hexdigest(self) -> str:
+        ...
+
+
+def is_available(algorithm: str) -> bool:
+    if algorithm in XXHASH_ALGORITHMS:
+        return xxhash is not None
+    return algorithm in hashlib.algorithms_available
+
+
+def new_hasher(algorithm: str) -> Hasher:
+    if algorithm in XXHASH_ALGORITHMS:
+        if xxhash is None:
+            raise ValueError(f'Для алгоритма {algorithm} нужен пакет xxhash')
+        return cast(Hasher, getattr(xxhash, algorithm)())
+    return cast(Hasher, hashlib.new(algorithm))
+
+
+def file_digest(path: str, algorithm: str, chunk_size: int) -> str:
+    """Хеш файла, читается чанками. Блокирующая функция, вызывается в пуле потоков."""
+    hasher = new_hasher(algorithm)
+    with open(path, 'rb') as f:
+        while content := f.read(chunk_size):
+            hasher.update(content)
+    return hasher.hexdigest()
@@ -0,0 +1,126 @@
+"""Потоковый разбор multipart/form-data.
+
+В отличие от `UploadFile`, тело запроса не складывается во временный файл starlette:
+данные частей отдаются по мере получения, их можно сразу писать в конечное место.
+"""
+from collections import deque
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+
+from multipart.multipart import MultipartParser, parse_options_header
+
+from utils.exc import FileRequiredError
+
+PART_BEGIN = 'part_begin'
+PART_DATA = 'part_data'
+PART_END = 'part_end'
+
+
+@dataclass
+class Part:
+    """Часть multipart запроса, данные читаются через `async for chunk in part`."""
+    name: str
+    filename: str | None
+    content_type: str
+    _reader: 'MultipartReader' = field(repr=False)
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._reader.read_part()
+
+
+class MultipartReader:
+    """Разбирает тело запроса по частям.
+
+    Examples:
+
+        async for part in MultipartReader(request.headers['content-type'], request.stream()):
+            async for chunk in part:
+                ...
+    """
+
+    def __init__(self, content_type: str | None, stream: AsyncIterator[bytes], charset: str = 'utf-8'):
+        media_type, params = parse_options_header(content_type or '')
+        if media_type != b'multipart/form-data' or b'boundary' not in params:
+            raise FileRequiredError
+
+        self.charset = charset
+        self._stream = stream.__aiter__()
+        self._events: deque[tuple[str, object]] = deque()
+        self._eof = False
+        self._in_part = False
+        self._header_field = b''
+        self._header_value = b''
+        self._headers: dict[bytes, bytes] = {}
+        self._parser = MultipartParser(params[b'boundary'], {
+            'on_part_begin': self._on_part_begin,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+        })
+
+    def __aiter__(self) -> AsyncIterator[Part]:
+        return self._parts()
+
+    async def _parts(self) -> AsyncIterator[Part]:
+        while event := await self._next_event():
+            kind, payload = event
+            if kind == PART_BEGIN:
+                self._in_part = True
+                yield payload  # type: ignore
+                # пропускаем то, что не прочитал потребитель
+                async for _ in self.read_part():
+                    pass
+
+    async def read_part(self) -> AsyncIterator[bytes]:
+        while self._in_part and (event := await self._next_event()):
+            kind, payload = event
+            if kind == PART_DATA:
+                yield payload  # type: ignore
+            elif kind == PART_END:
+                self._in_part = False
+
+    async def _next_event(self) -> tuple[str, object] | None:
+        while not self._events:
+            if self._eof:
+                return None
+            try:
+                chunk = await anext(self._stream)
+            except StopAsyncIteration:
+                self._eof = True
+                self._parser.finalize()
+                continue
+            self._parser.write(chunk)
+        return self._events.popleft()
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        filename = options.get(b'filename')
+        self._events.append((PART_BEGIN, Part(
+            name=options.get(b'name', b'').decode(self.charset, errors='replace'),
+            filename=filename.decode(self.charset, errors='replace') if filename is not None else None,
+            content_type=self._headers.get(b'content-type', b'').decode('latin-1'),
+            _reader=self,
+        )))
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        self._events.append((PART_DATA, data[start:end]))
+
+    def _on_part_end(self) -> None:
+        self._events.append((PART_END, None))
@@ -0,0 +1,141 @@
+"""Ответы для отдачи файлов с поддержкой Range и условных запросов."""
+import asyncio
+import re
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+import aiofiles
+from fastapi.responses import FileResponse
+from starlette.datastructures import Headers
+from starlette.types import Receive, Scope, Send
+
+from config import settings
+from schemas.base import BaseModel
+from utils.exc import RangeNotSatisfiableError
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# расширение ASGI, через которое сервер может отдать файл через sendfile
+ZEROCOPY_EXTENSION = 'http.response.zerocopy'
+
+
+def make_etag(value: str) -> str:
+    return f'"{value}"'
+
+
+def sse_event(event: str, data: BaseModel | None = None) -> str:
+    """Событие server-sent events, данные - json в одну строку."""
+    return f'event: {event}\ndata: {data.json() if data is not None else "{}"}\n\n'
+
+
+def http_date(value: datetime) -> str:
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def is_not_modified(headers: Headers, etag: str | None, last_modified: datetime | None) -> bool:
+    """Проверяет If-None-Match / If-Modified-Since, If-None-Match приоритетнее."""
+    if if_none_match := headers.get('if-none-match'):
+        if etag is None:
+            return False
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return '*' in tags or etag in tags
+
+    if (if_modified_since := headers.get('if-modified-since')) and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # в http дате нет долей секунды
+        return last_modified.replace(microsecond=0) <= since
+
+    return False
+
+
+def parse_range(headers: Headers, size: int, etag: str | None) -> tuple[int, int] | None:
+    """Возвращает запрошенный диапазон байт [start, end] или None, если нужно отдать файл целиком.
+
+    Поддерживается только один диапазон, на несколько диапазонов отдаем файл целиком (RFC 9110 это допускает).
+    """
+    range_header = headers.get('range')
+    if not range_header:
+        return None
+
+    # If-Range: диапазон отдаем, только если файл не изменился
+    if (if_range := headers.get('if-range')) and if_range != etag:
+        return None
+
+    match = RANGE_RE.match(range_header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+
+    if not first:
+        # bytes=-N - последние N байт
+        length = int(last)
+        if not length or not size:
+            raise RangeNotSatisfiableError(size)
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiableError(size)
+    return start, min(end, size - 1)
+
+
+class FileRangeResponse(FileResponse):
+    """Отдает файл целиком или его часть.
+
+    Если ASGI сервер поддерживает расширение zerocopy, файл отдается через sendfile
+    без копирования в user space, иначе читается чанками.
+    """
+
+    def __init__(self, path: str, size: int, byte_range: tuple[int, int] | None = None, **kwargs):
+        super().__init__(path, **kwargs)
+        self.chunk_size = settings.CHUNK_SIZE_KB * 1024
+        self.offset, last = byte_range if byte_range else (0, size - 1)
+        self.length = last - self.offset + 1
+        self.headers['accept-ranges'] = 'bytes'
+        self.headers['content-length'] = str(self.length)
+        if byte_range:
+            self.status_code = 206
+            self.headers['content-range'] = f'bytes {self.offset}-{last}/{size}'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({
+            'type': 'http.response.start',
+            'status': self.status_code,
+            'headers': self.raw_headers,
+        })
+        if self.send_header_only or not self.length:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        if ZEROCOPY_EXTENSION in scope.get('extensions', {}):
+            # открытие файла тоже обращение к диску, его не делаем в event loop
+            file = await asyncio.to_thread(open, self.path, 'rb')
+            try:
+                await send({
+                    'type': ZEROCOPY_EXTENSION,
+                    'file': file,
+                    'offset': self.offset,
+                    'count': self.length,
+                    'more_body': False,
+                })
+            finally:
+                await asyncio.to_thread(file.close)
+            return
+
+        async with aiofiles.open(self.path, 'rb') as file:
+            await file.seek(self.offset)
+            remaining = self.length
+            while remaining:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    # файл оказался короче, чем записано в БД
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': bool(remaining)})
+        if remaining:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})